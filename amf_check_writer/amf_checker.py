@@ -8,10 +8,15 @@ import subprocess
 import sys
 import re
 import argparse
+from collections import namedtuple
 
-from netCDF4 import Dataset
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
-from amf_check_writer.spreadsheet_handler import DeploymentModes
+from amf_check_writer.deployment_modes import DeploymentModes
+from amf_check_writer.check_engine import InProcessChecker, is_available
 
 
 # Regex to match filenames and extract product name
@@ -30,6 +35,20 @@ FILENAME_FORMAT_HUMAN_READABLE = (
     "<instrument_name>_<platform_name>_<YYYYMM><DD><HH><mm><SS>_<data_product>[_<option1>_<option2>]_v<version>.nc"
 )
 
+# Ways of running compliance-checker:
+#   subprocess: run the compliance-checker script for each CheckRun
+#   inprocess:  run the checks in this process (or in each worker process),
+#               loading each YAML check suite only once
+CHECK_ENGINES = ("subprocess", "inprocess")
+
+CheckRun = namedtuple("CheckRun", ["yaml_check", "fnames", "cc_args"])
+"""
+Tuple describing one invocation of compliance-checker
+:param yaml_check: name of the check suite, e.g. 'product_my-prod_land'
+:param fnames:     list of datasets to check
+:param cc_args:    command line to run
+"""
+
 
 def get_product_from_filename(path):
     """
@@ -56,6 +75,9 @@ def get_deployment_mode(path):
     :return:     Mode as a value from `DeploymentModes` enumeration
     :raises ValueError: if mode cannot be determined or is invalid
     """
+    # netCDF4 is slow to import, so only import it when a file is opened
+    from netCDF4 import Dataset
+
     fname = os.path.basename(path)
     d = Dataset(path)
     try:
@@ -72,6 +94,152 @@ def get_deployment_mode(path):
     )
 
 
+def get_check_runs(groups, yaml_dir, files_per_run, output_dir=None,
+                   output_format=None):
+    """
+    Build the compliance-checker invocations needed to check groups of
+    datasets. Groups with more than `files_per_run` datasets are split into
+    several invocations
+    :param groups:        dict mapping (product, mode) tuples to lists of
+                          datasets
+    :param yaml_dir:      directory containing YAML checks
+    :param files_per_run: maximum number of datasets per invocation
+    :param output_dir:    directory to save results in (default: print
+                          results)
+    :param output_format: output format to pass to compliance-checker
+    :return:              list of CheckRun tuples
+    """
+    runs = []
+    for product, mode in sorted(groups, key=lambda key: (key[0], key[1].value)):
+        yaml_check = "product_{prod}_{dep_m}".format(prod=product,
+                                                     dep_m=mode.value.lower())
+        fnames = groups[(product, mode)]
+        for start in range(0, len(fnames), files_per_run):
+            chunk = fnames[start:start + files_per_run]
+            cc_args = [
+                "compliance-checker",
+                "--yaml", os.path.join(yaml_dir, "AMF_{}.yml".format(yaml_check)),
+                "--test", "{}_checks".format(yaml_check)
+            ]
+
+            if output_format:
+                cc_args += ["--format", output_format]
+
+            if output_dir:
+                for fname in chunk:
+                    result_fname = "{}.cc-output".format(os.path.basename(fname))
+                    cc_args += ["--output", os.path.join(output_dir, result_fname)]
+
+            cc_args += chunk
+            runs.append(CheckRun(yaml_check, chunk, cc_args))
+    return runs
+
+
+def _run_captured(run):
+    """
+    Run compliance-checker, capturing its output
+    :return: tuple (CheckRun, exit code, output)
+    """
+    proc = subprocess.Popen(run.cc_args, stdout=subprocess.PIPE,
+                            stderr=subprocess.STDOUT)
+    output, _ = proc.communicate()
+    return run, proc.returncode, output
+
+
+# InProcessChecker used by each worker process with the in-process engine
+_worker_checker = None
+
+
+def _init_inprocess_worker():
+    global _worker_checker
+    _worker_checker = InProcessChecker()
+
+
+def _run_inprocess_captured(run):
+    """
+    Run compliance-checker in a worker process, capturing its output
+    :return: tuple (CheckRun, exit code, output)
+    """
+    captured = StringIO()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = captured
+    try:
+        code = _worker_checker.run(run.cc_args[1:])
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+
+    output = captured.getvalue()
+    if not isinstance(output, bytes):
+        output = output.encode("utf-8")
+    return run, code, output
+
+
+def run_checks(runs, jobs=1, engine="subprocess"):
+    """
+    Run compliance-checker for each CheckRun, and print the result for each
+    dataset. With more than one job, invocations run concurrently and the
+    output of each is printed in one block when it finishes
+    :param runs:   list of CheckRun tuples. The status printed for each
+                   dataset is the exit code of the run that checked it
+    :param jobs:   number of invocations to run at once
+    :param engine: one of CHECK_ENGINES
+    :return:       list of (CheckRun, exit code) tuples
+    :raises ValueError: if the engine is not recognised
+    """
+    if engine not in CHECK_ENGINES:
+        raise ValueError("Unrecognised check engine '{}'".format(engine))
+
+    results = []
+
+    def report(run, code):
+        # A run that checks several datasets only has one exit code, so a
+        # failure cannot be attributed to a single dataset
+        shared = ""
+        if len(run.fnames) > 1:
+            shared = ", shared by the {} datasets in this run".format(len(run.fnames))
+        for fname in run.fnames:
+            status = "passed" if code == 0 else "failed (exit code {}{})".format(code, shared)
+            print("{}: {}".format(fname, status))
+        sys.stdout.flush()
+        results.append((run, code))
+
+    if jobs <= 1:
+        if engine == "inprocess":
+            checker = InProcessChecker()
+        for run in runs:
+            if engine == "inprocess":
+                code = checker.run(run.cc_args[1:])
+            else:
+                code = subprocess.call(run.cc_args)
+            report(run, code)
+        return results
+
+    if engine == "inprocess":
+        # compliance-checker prints its reports to sys.stdout, so checks
+        # cannot run concurrently in threads. Each worker process keeps its own
+        # suites loaded
+        from multiprocessing import Pool
+        pool = Pool(jobs, initializer=_init_inprocess_worker)
+        run_captured = _run_inprocess_captured
+    else:
+        # Each worker thread just waits for its compliance-checker process
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(jobs)
+        run_captured = _run_captured
+    try:
+        for run, code, output in pool.imap_unordered(run_captured, runs):
+            sys.stdout.flush()
+            out = getattr(sys.stdout, "buffer", sys.stdout)
+            out.write(output)
+            out.flush()
+            report(run, code)
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument(
@@ -99,8 +267,39 @@ def main():
              "you must use 'json_new' instead of 'json' if checking multiple "
              "files"
     )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=1,
+        help="Number of compliance-checker processes to run at once "
+             "[default: %(default)s]"
+    )
+    parser.add_argument(
+        "--engine",
+        choices=CHECK_ENGINES,
+        default="subprocess",
+        help="Run the compliance-checker script for each run of datasets "
+             "('subprocess'), or run the checks in this process, loading each "
+             "YAML check suite once ('inprocess') [default: %(default)s]"
+    )
+    parser.add_argument(
+        "--files-per-run",
+        type=int,
+        default=1,
+        help="Maximum number of datasets of the same product and deployment "
+             "mode to check in each compliance-checker run. Datasets checked "
+             "in the same run share one pass/fail status [default: %(default)s]"
+    )
     args = parser.parse_args(sys.argv[1:])
 
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.files_per_run < 1:
+        parser.error("--files-per-run must be at least 1")
+    if args.engine == "inprocess" and not is_available():
+        parser.error("the in-process engine requires compliance-checker to be "
+                     "installed")
+
     # Check yaml_dir exists
     if not args.yaml_dir or not os.path.isdir(args.yaml_dir):
         raise ValueError("Please include directory of YAML checks as argument: '--yaml-dir'.") 
@@ -139,25 +338,16 @@ def main():
         print("Nothing to do")
         sys.exit(0)
 
-    for (product, mode), fnames in groups.items():
-        yaml_check = "product_{prod}_{dep_m}".format(prod=product,
-                                                     dep_m=mode.value.lower())
-        cc_args = [
-            "compliance-checker",
-            "--yaml", os.path.join(args.yaml_dir, "AMF_{}.yml".format(yaml_check)),
-            "--test", "{}_checks".format(yaml_check)
-        ]
-
-        if args.output_format:
-            cc_args += ["--format", args.output_format]
-
-        if args.output_dir:
-            for fname in fnames:
-                result_fname = "{}.cc-output".format(os.path.basename(fname))
-                cc_args += ["--output", os.path.join(args.output_dir, result_fname)]
-
-        cc_args += fnames
-        subprocess.call(cc_args)
+    runs = get_check_runs(groups, args.yaml_dir, args.files_per_run,
+                          output_dir=args.output_dir,
+                          output_format=args.output_format)
+    results = run_checks(runs, jobs=args.jobs, engine=args.engine)
+
+    failed = sum(len(run.fnames) for run, code in results if code != 0)
+    passed = sum(len(run.fnames) for run, code in results if code == 0)
+    print("{} files passed, {} failed".format(passed, failed))
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
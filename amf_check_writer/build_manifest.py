@@ -0,0 +1,165 @@
+"""
+Manifest of the files generated in an output directory, recording the hashes
+of the input TSV files each one was generated from. Used by
+SpreadsheetHandler to regenerate only the outputs whose inputs have changed
+"""
+import os
+import json
+import hashlib
+import threading
+
+from amf_check_writer.file_utils import atomic_write, file_hash
+
+
+MANIFEST_FILENAME = ".build-manifest.json"
+
+# Modules and packages (relative to the package directory) whose code
+# determines the contents of output files
+GENERATOR_SOURCES = (
+    "cvs",
+    "base_file.py",
+    "deployment_modes.py",
+    "json_output.py",
+    "pyessv_archive.py",
+    "pyessv_writer.py",
+    "spreadsheet_handler.py",
+    "yaml_check.py",
+)
+
+_generator_version = None
+
+
+def hash_sources(package_dir, sources=GENERATOR_SOURCES):
+    """
+    Return a SHA-1 hex digest of the names and contents of the Python source
+    files in `sources`, which are files or directories relative to
+    `package_dir`
+    """
+    paths = []
+    for source in sources:
+        source_path = os.path.join(package_dir, source)
+        if os.path.isdir(source_path):
+            for dirpath, dirnames, filenames in os.walk(source_path):
+                paths += [os.path.join(dirpath, fname) for fname in filenames
+                          if fname.endswith(".py")]
+        elif os.path.isfile(source_path):
+            paths.append(source_path)
+
+    sha = hashlib.sha1()
+    for path in sorted(paths):
+        sha.update(os.path.relpath(path, package_dir).encode("utf-8"))
+        sha.update(file_hash(path).encode("utf-8"))
+    return sha.hexdigest()
+
+
+def get_generator_version():
+    """
+    Return a string identifying the version of the code that generates output
+    files: a hash of the modules in GENERATOR_SOURCES. Outputs generated by a
+    different version are always regenerated
+    """
+    global _generator_version
+    if _generator_version is None:
+        package_dir = os.path.dirname(os.path.abspath(__file__))
+        _generator_version = hash_sources(package_dir)
+    return _generator_version
+
+
+def hash_inputs(paths, root):
+    """
+    Return a dict mapping paths relative to `root` to the SHA-1 hash of each
+    file, or None for files that do not exist
+    """
+    hashes = {}
+    for path in paths:
+        rel_path = os.path.relpath(path, root)
+        hashes[rel_path] = file_hash(path) if os.path.isfile(path) else None
+    return hashes
+
+
+class BuildManifest(object):
+    """
+    Record of the targets built in an output directory. Each target is an
+    output filename (or another name, such as 'pyessv', for outputs written
+    elsewhere), mapped to the hashes of its inputs and whether the output was
+    written (a target is not written if, for example, its TSV file could not
+    be parsed).
+
+    The recorded targets are discarded if the manifest was written by a
+    different generator version.
+    """
+    def __init__(self, out_dir, generator_version=None):
+        """
+        Load the manifest from `out_dir` if it exists
+        :param out_dir:           directory output files are written to
+        :param generator_version: version of the code generating outputs
+                                  (default: see `get_generator_version`)
+        """
+        self.out_dir = out_dir
+        self.path = os.path.join(out_dir, MANIFEST_FILENAME)
+        self.generator_version = generator_version or get_generator_version()
+        self.lock = threading.Lock()
+        self.targets = {}
+
+        # A missing or unreadable manifest means every target is rebuilt
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if (isinstance(data, dict)
+                and data.get("generator_version") == self.generator_version):
+            self.targets = data.get("targets", {})
+
+    def is_up_to_date(self, name, inputs):
+        """
+        Return True if a target was built from inputs with the given hashes,
+        and its output file (if any) still exists
+        :param name:   name of the target
+        :param inputs: dict mapping input paths to hashes (see `hash_inputs`)
+        """
+        with self.lock:
+            entry = self.targets.get(name)
+        if not entry or entry["inputs"] != inputs:
+            return False
+        return not entry["written"] or os.path.isfile(os.path.join(self.out_dir, name))
+
+    def was_written(self, name):
+        """
+        Return True if the output for a target was written in the last build
+        """
+        with self.lock:
+            entry = self.targets.get(name)
+        return bool(entry and entry["written"])
+
+    def record(self, name, inputs, written):
+        """
+        Record that a target has been built
+        :param name:    name of the target
+        :param inputs:  dict mapping input paths to hashes
+        :param written: whether an output file was written for the target
+        """
+        with self.lock:
+            self.targets[name] = {"inputs": inputs, "written": written}
+
+    def retain(self, names):
+        """
+        Forget targets that are not in `names`, e.g. outputs for products that
+        no longer exist
+        """
+        names = set(names)
+        with self.lock:
+            for name in list(self.targets):
+                if name not in names:
+                    del self.targets[name]
+
+    def save(self):
+        """
+        Write the manifest to the output directory
+        """
+        with self.lock:
+            with atomic_write(self.path) as f:
+                json.dump({
+                    "generator_version": self.generator_version,
+                    "targets": self.targets
+                }, f, indent=4, sort_keys=True)
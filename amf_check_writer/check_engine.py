@@ -0,0 +1,163 @@
+"""
+Run compliance-checker in the current process instead of as a subprocess.
+
+Starting `compliance-checker` imports the library, loads its plugins and parses
+the YAML check suite given with `--yaml`, every time it is run. `InProcessChecker`
+does this once: suites generated from a YAML file are kept loaded, and reused
+for every dataset checked against them.
+
+The checks are run by the function behind the `compliance-checker` script
+itself, so the options, reports and exit codes are those of the installed
+version of compliance-checker.
+"""
+from __future__ import print_function
+import os
+import sys
+import argparse
+import traceback
+
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+
+
+# Name of the compliance-checker distribution, and of the script it installs
+CC_DISTRIBUTION = "compliance-checker"
+CC_SCRIPT = "compliance-checker"
+
+
+def is_available():
+    """
+    Return True if compliance-checker is installed, so that the in-process
+    engine can be used
+    """
+    try:
+        load_cc_main()
+    except ImportError:
+        return False
+    return True
+
+
+def load_cc_main():
+    """
+    Return the function run by the `compliance-checker` script, as given by
+    its console script entry point. compliance-checker installs the module
+    containing it alongside the script rather than in site-packages, so it is
+    imported from the directory of the script found on the PATH (i.e. the
+    script the subprocess engine runs)
+    :raises ImportError: if compliance-checker is not installed
+    """
+    import pkg_resources
+    try:
+        entry_point = pkg_resources.get_entry_info(CC_DISTRIBUTION,
+                                                   "console_scripts", CC_SCRIPT)
+    except pkg_resources.ResolutionError as ex:
+        raise ImportError("{} is not installed: {}".format(CC_DISTRIBUTION, ex))
+    if entry_point is None:
+        raise ImportError("{} has no '{}' script".format(CC_DISTRIBUTION, CC_SCRIPT))
+
+    script = which(CC_SCRIPT)
+    script_dir = os.path.dirname(os.path.abspath(script)) if script else None
+    if script_dir:
+        sys.path.insert(0, script_dir)
+    try:
+        # Do not check the requirements of the distribution, which
+        # compliance-checker pins exactly
+        return entry_point.resolve()
+    finally:
+        if script_dir:
+            sys.path.remove(script_dir)
+
+
+class InProcessChecker(object):
+    """
+    Run compliance-checker command lines in the current process. The options,
+    reports and exit code are the same as those of the `compliance-checker`
+    script
+    """
+    def __init__(self):
+        # compliance-checker is slow to import, so only import it when the
+        # in-process engine is used
+        self._main = load_cc_main()
+        self._cc_module = sys.modules[self._main.__module__]
+
+        # The script creates a CheckSuite for each run, which loads the
+        # checkers of every plugin. Give it one that only does so once for each
+        # set of plugin arguments (e.g. '--yaml' from cc-yaml) instead. If the
+        # script does not use CheckSuite, checkers are loaded on every run
+        base_suite = getattr(self._cc_module, "CheckSuite", None)
+        self._suite = _make_caching_suite(base_suite) if base_suite else None
+
+    def run(self, cc_args):
+        """
+        Run the checks given by a compliance-checker command line
+        :param cc_args: list of arguments, not including the program name
+        :return:        exit code compliance-checker would have returned
+        """
+        argv = sys.argv
+        suite = getattr(self._cc_module, "CheckSuite", None)
+        sys.argv = [CC_SCRIPT] + list(cc_args)
+        if self._suite:
+            self._cc_module.CheckSuite = self._suite
+        try:
+            return _exit_code(self._main())
+        except SystemExit as ex:
+            return _exit_code(ex.code)
+        except Exception:
+            # compliance-checker would exit with a traceback
+            traceback.print_exc()
+            return 1
+        finally:
+            sys.argv = argv
+            if self._suite:
+                self._cc_module.CheckSuite = suite
+
+
+def _make_caching_suite(base):
+    """
+    Return a subclass of compliance-checker's CheckSuite class that loads the
+    available checkers once, and the checkers generated by plugins once for
+    each set of plugin arguments
+    """
+    # Names of the arguments added by plugins
+    plugin_parser = argparse.ArgumentParser(add_help=False)
+    base.add_plugin_args(plugin_parser)
+    plugin_arg_names = sorted(vars(plugin_parser.parse_known_args([])[0]))
+    loaded = set()
+
+    class CachingCheckSuite(base):
+        @classmethod
+        def load_all_available_checkers(cls):
+            if None not in loaded:
+                super(CachingCheckSuite, cls).load_all_available_checkers()
+                loaded.add(None)
+
+        @classmethod
+        def load_generated_checkers(cls, args):
+            key = tuple(
+                (name, _hashable(getattr(args, name, None)))
+                for name in plugin_arg_names
+            )
+            if key not in loaded:
+                super(CachingCheckSuite, cls).load_generated_checkers(args)
+                loaded.add(key)
+
+    return CachingCheckSuite
+
+
+def _hashable(value):
+    return tuple(value) if isinstance(value, list) else value
+
+
+def _exit_code(code):
+    """
+    Return the exit status of a process exiting with `code`, as the argument
+    to sys.exit
+    """
+    if code is None:
+        return 0
+    if isinstance(code, int):
+        return code
+    print(code, file=sys.stderr)
+    return 1
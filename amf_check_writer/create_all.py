@@ -0,0 +1,96 @@
+"""
+Read AMF spreadsheet TSV files once, and produce JSON controlled vocabulary
+files, pyessv CVs and YAML checks. This is equivalent to running create-cvs
+and create-yaml-checks, but each spreadsheet is only parsed once.
+"""
+import os
+import sys
+import argparse
+
+from amf_check_writer.spreadsheet_handler import SpreadsheetHandler
+from amf_check_writer.pyessv_writer import PYESSV_BACKENDS
+from amf_check_writer.json_output import (JSON_FORMATS, JSON_BACKENDS,
+                                          is_backend_available)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "spreadsheets_dir",
+        help="Directory containing spreadsheet data, as produced by "
+             "download_from_drive.py"
+    )
+    parser.add_argument(
+        "cvs_dir",
+        help="Directory to write output JSON CVs to"
+    )
+    parser.add_argument(
+        "yaml_dir",
+        help="Directory to write output YAML files to"
+    )
+    parser.add_argument(
+        "--pyessv-dir",
+        default=None,
+        dest="pyessv_root",
+        help="Directory to write pyessv CVs to [default: ~/.esdoc/pyessv-archive/]"
+    )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes to use for parsing spreadsheets "
+             "[default: %(default)s]"
+    )
+    parser.add_argument(
+        "-i", "--incremental",
+        action="store_true",
+        help="Only regenerate output files whose input spreadsheets have "
+             "changed since the last run, and reuse the list of product "
+             "spreadsheets if the products directory is unchanged"
+    )
+    parser.add_argument(
+        "--json-format",
+        choices=JSON_FORMATS,
+        default="pretty",
+        help="Format of JSON CVs: 'pretty' is indented, 'compact' has no "
+             "whitespace and sorted keys [default: %(default)s]"
+    )
+    parser.add_argument(
+        "--json-backend",
+        choices=JSON_BACKENDS,
+        default="json",
+        help="Serialiser to use for compact JSON CVs. 'orjson' is faster but "
+             "requires the orjson package [default: %(default)s]"
+    )
+    parser.add_argument(
+        "--pyessv-backend",
+        choices=PYESSV_BACKENDS,
+        default="pyessv",
+        help="How to write pyessv CVs: 'direct' writes the same files without "
+             "importing pyessv, which loads the whole existing archive "
+             "[default: %(default)s]"
+    )
+    args = parser.parse_args(sys.argv[1:])
+
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if not is_backend_available(args.json_backend):
+        parser.error("JSON backend '{}' is not available".format(args.json_backend))
+
+    if not os.path.isdir(args.spreadsheets_dir):
+        parser.error("No such directory '{}'".format(args.spreadsheets_dir))
+    for dirname in (args.cvs_dir, args.yaml_dir, args.pyessv_root):
+        if dirname and not os.path.isdir(dirname):
+            os.mkdir(dirname)
+
+    sh = SpreadsheetHandler(args.spreadsheets_dir, jobs=args.jobs,
+                            incremental=args.incremental,
+                            discovery_index=args.incremental,
+                            json_format=args.json_format,
+                            json_backend=args.json_backend,
+                            pyessv_backend=args.pyessv_backend)
+    sh.write_all(args.cvs_dir, args.yaml_dir, write_pyessv=True,
+                 pyessv_root=args.pyessv_root)
+
+if __name__ == "__main__":
+    main()
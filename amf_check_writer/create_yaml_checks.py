@@ -20,14 +20,32 @@ def main():
         "output_dir",
         help="Directory to write output YAML files to"
     )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker processes to use for parsing spreadsheets "
+             "[default: %(default)s]"
+    )
+    parser.add_argument(
+        "-i", "--incremental",
+        action="store_true",
+        help="Only regenerate output files whose input spreadsheets have "
+             "changed since the last run, and reuse the list of product "
+             "spreadsheets if the products directory is unchanged"
+    )
     args = parser.parse_args(sys.argv[1:])
 
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
     if not os.path.isdir(args.spreadsheets_dir):
         parser.error("No such directory '{}'".format(args.spreadsheets_dir))
     if not os.path.isdir(args.output_dir):
         os.mkdir(args.output_dir)
 
-    sh = SpreadsheetHandler(args.spreadsheets_dir)
+    sh = SpreadsheetHandler(args.spreadsheets_dir, jobs=args.jobs,
+                            incremental=args.incremental,
+                            discovery_index=args.incremental)
     sh.write_yaml(args.output_dir)
 
 if __name__ == "__main__":
@@ -16,7 +16,13 @@ SCOPES = {
     # If modifying these scopes, delete your previously saved credentials
     # at ~/.credentials/sheets.googleapis.com-python-quickstart.json
     "sheets": "https://www.googleapis.com/auth/spreadsheets.readonly",
-    "drive":  "https://www.googleapis.com/auth/drive.metadata.readonly"
+    "drive":  "https://www.googleapis.com/auth/drive.metadata.readonly",
+    # Used by download-from-drive to list folders, read sheet values and
+    # export spreadsheets with a single set of credentials
+    "drive-download": [
+        "https://www.googleapis.com/auth/drive.readonly",
+        "https://www.googleapis.com/auth/spreadsheets.readonly"
+    ]
 }
 
 
@@ -38,7 +44,8 @@ def get_credentials(api, secrets_file=None):
 
     store = Storage(credential_path)
     credentials = store.get()
-    if not credentials or credentials.invalid:
+    if (not credentials or credentials.invalid
+            or not credentials.has_scopes(SCOPES[api])):
         if secrets_file is None:
             raise ValueError(
                 "No valid credentials found in '{}' and secrets file not "
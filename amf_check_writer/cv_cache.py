@@ -0,0 +1,166 @@
+"""
+On-disk cache of parsed CVs, so that repeatedly loading CVs from the same
+spreadsheets does not require re-reading and re-parsing every TSV file
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import pickle
+import hashlib
+
+from amf_check_writer.build_manifest import get_generator_version
+from amf_check_writer.file_utils import atomic_write, file_hash, user_cache_dir
+
+
+# Version of the format of cache entries
+CACHE_FORMAT = 2
+
+# Files modified less than this many seconds before their fingerprint was
+# taken may have been modified again without changing their size or mtime, so
+# their contents are always hashed
+RACY_INTERVAL = 2
+
+
+class CVCache(object):
+    """
+    Cache of CVs parsed from TSV files. Each entry is stored in a separate
+    file named after the path of the TSV file, containing two pickles: a
+    header recording the size, modification time and SHA-1 hash of the file
+    it was parsed from, the CV class and facets and any warnings printed while
+    parsing it; and the parsed CV (or None if it could not be parsed). Entries
+    can be checked without loading the CV.
+
+    An entry is valid if it was written by the same version of this code for
+    the same CV class and facets, and the TSV file's size and mtime are
+    unchanged. If only the mtime has changed, the file is hashed and the entry
+    is still used if the contents are the same.
+    """
+    def __init__(self, cache_dir=None):
+        """
+        :param cache_dir: directory to store entries in (default:
+                          ~/.cache/amf-check-writer/cvs)
+        """
+        self.cache_dir = cache_dir or user_cache_dir("cvs")
+
+    def get_path(self, tsv_path):
+        path_hash = hashlib.sha1(os.path.abspath(tsv_path).encode("utf-8"))
+        return os.path.join(self.cache_dir, "{}.pickle".format(path_hash.hexdigest()))
+
+    def get_header(self, parse_info):
+        """
+        Return the header of the entry for a TSV file if the entry is valid,
+        or None otherwise
+        :param parse_info: CVParseInfo with the full path to the TSV file
+        """
+        path, cls, facets = parse_info
+        try:
+            checked_at = time.time()
+            stat = os.stat(path)
+            with open(self.get_path(path), "rb") as f:
+                header = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError,
+                AttributeError, ImportError, ValueError):
+            return None
+
+        if (not isinstance(header, dict)
+                or header.get("format") != CACHE_FORMAT
+                or header["generator_version"] != get_generator_version()
+                or header["cls"] != cls.__name__ or header["facets"] != list(facets)
+                or header["size"] != stat.st_size):
+            return None
+
+        racy = header["mtime"] >= header["cached_at"] - RACY_INTERVAL
+        if header["mtime"] != stat.st_mtime or racy:
+            if file_hash(path) != header["sha1"]:
+                return None
+            if not racy:
+                # Contents are unchanged: record the new mtime so the file
+                # does not need to be hashed next time
+                entry = self.load(parse_info, header)
+                if entry is not None:
+                    fingerprint = {"size": stat.st_size, "mtime": stat.st_mtime,
+                                   "sha1": header["sha1"], "cached_at": checked_at}
+                    self.put(parse_info, entry[0], entry[1], fingerprint)
+        return header
+
+    def load(self, parse_info, header):
+        """
+        Load the CV from an entry
+        :param parse_info: CVParseInfo with the full path to the TSV file
+        :param header:     the entry's header, from `get_header`
+        :return:           tuple (CV object or None, warnings), or None if
+                           the entry cannot be read
+        """
+        try:
+            with open(self.get_path(parse_info.path), "rb") as f:
+                if pickle.load(f) != header:
+                    # Entry was replaced since the header was read
+                    return None
+                cv = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError,
+                AttributeError, ImportError, ValueError):
+            return None
+        return cv, header["warnings"]
+
+    def get(self, parse_info):
+        """
+        Return the cached result of parsing a TSV file
+        :param parse_info: CVParseInfo with the full path to the TSV file
+        :return:           tuple (CV object or None, warnings), or None if
+                           there is no valid entry for the file
+        """
+        header = self.get_header(parse_info)
+        if header is None:
+            return None
+        return self.load(parse_info, header)
+
+    def get_fingerprint(self, path):
+        """
+        Return the size, modification time and SHA-1 hash of a TSV file, and
+        the time they were read, or None if the file does not exist. This
+        must be called before the file is parsed, so that if the file changes
+        while it is being parsed the entry does not match the new contents
+        """
+        try:
+            cached_at = time.time()
+            stat = os.stat(path)
+            return {
+                "size": stat.st_size,
+                "mtime": stat.st_mtime,
+                "sha1": file_hash(path),
+                "cached_at": cached_at
+            }
+        except (IOError, OSError):
+            return None
+
+    def put(self, parse_info, cv, warnings, fingerprint):
+        """
+        Store the result of parsing a TSV file. Nothing is stored if the file
+        did not exist. Failure to write the entry is not fatal
+        :param parse_info:  CVParseInfo with the full path to the TSV file
+        :param cv:          CV object, or None if the file could not be parsed
+        :param warnings:    string containing warnings printed while parsing
+        :param fingerprint: fingerprint of the file taken before it was
+                            parsed (see `get_fingerprint`)
+        """
+        path, cls, facets = parse_info
+        if fingerprint is None:
+            return
+        try:
+            header = {
+                "format": CACHE_FORMAT,
+                "generator_version": get_generator_version(),
+                "cls": cls.__name__,
+                "facets": list(facets),
+                "warnings": warnings
+            }
+            header.update(fingerprint)
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with atomic_write(self.get_path(path), "wb") as f:
+                pickle.dump(header, f, protocol=2)
+                pickle.dump(cv, f, protocol=2)
+        except (IOError, OSError) as ex:
+            print("WARNING: Could not cache CV for '{}': {}".format(path, ex),
+                  file=sys.stderr)
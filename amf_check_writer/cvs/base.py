@@ -1,7 +1,7 @@
-import json
 from csv import DictReader
 
 from amf_check_writer.base_file import AmfFile
+from amf_check_writer.json_output import dump_json
 
 
 class BaseCV(AmfFile):
@@ -16,14 +16,25 @@ class BaseCV(AmfFile):
         """
         super(BaseCV, self).__init__(facets)
         self.tsv_file = tsv_file
+        self.tsv_path = getattr(tsv_file, "name", None)
         reader = StripWhitespaceReader(self.tsv_file, delimiter="\t")
         self.cv_dict = self.parse_tsv(reader)
 
-    def to_json(self):
+    def __getstate__(self):
+        # File objects cannot be pickled, and the file is not needed once
+        # parsed. This allows CVs to be returned from worker processes
+        state = self.__dict__.copy()
+        state["tsv_file"] = None
+        return state
+
+    def to_json(self, fmt="pretty", backend="json"):
         """
         Return JSON representation of this CV as a string
+        :param fmt:     output format (see `json_output.JSON_FORMATS`)
+        :param backend: serialiser for compact output (see
+                        `json_output.JSON_BACKENDS`)
         """
-        return json.dumps(self.cv_dict, indent=4)
+        return dump_json(self.cv_dict, fmt=fmt, backend=backend)
 
     def parse_tsv(self, reader):
         """
@@ -75,5 +75,5 @@ class VariablesCV(BaseCV, YamlCheck):
                 }
             except KeyError as ex:
                 print("WARNING: Missing value {} in '{}"
-                      .format(ex, self.tsv_file.name),
+                      .format(ex, self.tsv_path),
                       file=sys.stderr)
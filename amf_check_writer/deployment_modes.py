@@ -0,0 +1,14 @@
+"""
+Deployment modes of AMF instruments. This module has no dependencies so that
+scripts that only need the modes, such as amf-checker, can import it quickly
+"""
+from enum import Enum
+
+
+class DeploymentModes(Enum):
+    """
+    Enumeration of valid deployment modes
+    """
+    LAND = "Land"
+    SEA = "Sea"
+    AIR = "Air"
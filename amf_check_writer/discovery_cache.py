@@ -0,0 +1,134 @@
+"""
+On-disk cache of Google API discovery documents, so that API clients can be
+built without fetching the documents over the network on every run
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import hashlib
+
+import httplib2
+from apiclient import discovery
+from apiclient import errors
+
+from amf_check_writer.file_utils import atomic_write, user_cache_dir
+
+
+# Number of seconds a cached discovery document is used for before it is
+# fetched again
+MAX_AGE = 24 * 60 * 60
+
+# Timeout in seconds when fetching a discovery document
+FETCH_TIMEOUT = 30
+
+
+def default_cache_dir():
+    """
+    Return the directory to cache discovery documents in, following the XDG
+    base directory specification
+    """
+    return user_cache_dir("discovery")
+
+
+class DiscoveryCache(object):
+    """
+    Cache of discovery documents, stored as JSON files named after the API,
+    its version and a hash of the URL they were fetched from.
+
+    A cached document is used if it is less than `max_age` seconds old and
+    describes the requested API version. Otherwise it is fetched again; if
+    that fails, a stale cached copy is used in preference to failing.
+    """
+    def __init__(self, cache_dir=None, max_age=MAX_AGE, timeout=FETCH_TIMEOUT):
+        """
+        :param cache_dir: directory to store documents in (default: see
+                          `default_cache_dir`)
+        :param max_age:   number of seconds cached documents are valid for
+        :param timeout:   timeout in seconds when fetching documents
+        """
+        self.cache_dir = cache_dir or default_cache_dir()
+        self.max_age = max_age
+        self.timeout = timeout
+
+    def get_path(self, api, version, url):
+        url_hash = hashlib.sha1(url.encode("utf-8")).hexdigest()[:10]
+        return os.path.join(self.cache_dir, "{}.{}.{}.json".format(api, version, url_hash))
+
+    def load(self, path, version):
+        """
+        Return the cached document at `path`, or None if it does not exist,
+        cannot be parsed or is for a different version of the API
+        """
+        try:
+            with open(path) as f:
+                doc = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if doc.get("version") != version:
+            return None
+        return doc
+
+    def save(self, path, doc):
+        """
+        Write a document to the cache. Failure to write is not fatal
+        """
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            with atomic_write(path) as f:
+                json.dump(doc, f)
+        except (IOError, OSError) as ex:
+            print("WARNING: Could not cache discovery document: {}".format(ex),
+                  file=sys.stderr)
+
+    def fetch(self, api, version, url):
+        """
+        Fetch a discovery document over the network
+        """
+        url = url.format(api=api, apiVersion=version)
+        http = httplib2.Http(timeout=self.timeout)
+        response, content = http.request(url)
+        if response.status >= 400:
+            raise errors.HttpError(response, content, uri=url)
+        if isinstance(content, bytes):
+            content = content.decode("utf-8")
+        doc = json.loads(content)
+        if doc.get("version") != version:
+            raise ValueError("Discovery document at '{}' is for version '{}'"
+                             .format(url, doc.get("version")))
+        return doc
+
+    def get(self, api, version, url):
+        """
+        Return the discovery document for an API
+        :param api:     name of the API, e.g. 'drive'
+        :param version: version of the API, e.g. 'v3'
+        :param url:     discovery URL, which may contain '{api}' and
+                        '{apiVersion}' placeholders
+        """
+        path = self.get_path(api, version, url)
+        cached = self.load(path, version)
+        if cached and time.time() - os.path.getmtime(path) < self.max_age:
+            return cached
+
+        try:
+            doc = self.fetch(api, version, url)
+        except (httplib2.HttpLib2Error, errors.HttpError, ValueError,
+                IOError, OSError) as ex:
+            if cached is None:
+                raise
+            print("WARNING: Could not fetch discovery document for {} {} ({}); "
+                  "using cached copy".format(api, version, ex), file=sys.stderr)
+            return cached
+
+        self.save(path, doc)
+        return doc
+
+    def build(self, api, version, url, http=None):
+        """
+        Build an API client from the cached discovery document
+        :param http: Http object to use for requests by default
+        """
+        return discovery.build_from_document(self.get(api, version, url), http=http)
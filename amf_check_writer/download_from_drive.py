@@ -6,22 +6,27 @@ See the README in amf-check-writer for details.
 """
 import os
 import sys
-import time
+import json
 import argparse
+import threading
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import httplib2
-from pygdrive3 import service
-
-from apiclient import discovery
 from apiclient import http
-
+from apiclient import errors
 
 from amf_check_writer.credentials import get_credentials
+from amf_check_writer.discovery_cache import DiscoveryCache
+from amf_check_writer.drive_manifest import DriveManifest
+from amf_check_writer.file_utils import atomic_write
+from amf_check_writer.rate_limiter import RateLimiter
+from amf_check_writer.xlsx_to_tsv import (convert_xlsx, write_values_to_tsv,
+                                          column_letters)
 
 
 # ID of the top level folder in Google Drive
 ROOT_FOLDER_ID = "1TGsJBltDttqs6nsbUwopX5BL_q8AU-5X"
-NROWS_TO_PARSE = 999
 
 SPREADSHEET_MIME_TYPES = (
     "application/vnd.google-apps.spreadsheet"
@@ -29,6 +34,32 @@ SPREADSHEET_MIME_TYPES = (
 
 FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
 
+# URLs to fetch the discovery document for each API from
+DISCOVERY_URLS = {
+    "drive": "https://www.googleapis.com/discovery/v1/apis/{api}/{apiVersion}/rest",
+    "sheets": "https://sheets.googleapis.com/$discovery/rest?version={apiVersion}"
+}
+
+# Fields to request when listing the contents of folders
+LIST_FIELDS = "nextPageToken, files(id, name, mimeType, parents, modifiedTime, version)"
+
+# Fields to request for each file in the changes feed
+CHANGES_FIELDS = (
+    "nextPageToken, newStartPageToken, changes(fileId, removed, "
+    "file(id, name, mimeType, parents, trashed, modifiedTime, version))"
+)
+
+# Reasons given in 403 responses when a rate limit or quota is exceeded
+RATE_LIMIT_REASONS = (
+    "rateLimitExceeded",
+    "userRateLimitExceeded"
+)
+
+# Maximum number of cells to request in a single batch of sheet values. Large
+# sheets are split into several ranges, which are fetched in separate requests
+# if necessary
+MAX_CELLS_PER_REQUEST = 500000
+
 FOLDERS_TO_SKIP = (
     "products under development",
     "TO_DELETE_SOON",
@@ -36,37 +67,128 @@ FOLDERS_TO_SKIP = (
 )
 
 
-API_CALL_TIMES = []
+def makedirs(path):
+    """
+    Create a directory and its parents if it does not already exist. Safe to
+    call from several threads at once
+    """
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def get_sheet_ranges(properties, max_cells=MAX_CELLS_PER_REQUEST):
+    """
+    Return the ranges in A1 notation covering the whole grid of a sheet, each
+    with at most `max_cells` cells (or a single row if the sheet is wider
+    than that)
+    :param properties: the sheet's properties from the Sheets API
+    :return:           list of tuples (range, number of rows in the range)
+    """
+    grid = properties.get("gridProperties", {})
+    nrows = grid.get("rowCount", 0)
+    ncols = grid.get("columnCount", 0)
+    if not nrows or not ncols:
+        return []
+
+    name = properties["title"].replace("'", "''")
+    last_col = column_letters(ncols - 1)
+    rows_per_range = max(1, max_cells // ncols)
+    ranges = []
+    for start in range(0, nrows, rows_per_range):
+        end = min(start + rows_per_range, nrows)
+        ranges.append(("'{}'!A{}:{}{}".format(name, start + 1, last_col, end),
+                       end - start))
+    return ranges
+
+
+def is_rate_limit_error(ex):
+    """
+    Return True if an HttpError from Google's APIs indicates that a rate limit
+    or quota has been exceeded
+    """
+    status = int(ex.resp.status)
+    if status == 429:
+        return True
+    if status != 403:
+        return False
+    try:
+        reasons = [e.get("reason") for e in json.loads(ex.content)["error"]["errors"]]
+    except (ValueError, KeyError, TypeError):
+        return False
+    return bool(set(reasons) & set(RATE_LIMIT_REASONS))
 
 
 def api_call(func):
     """
-    Decorator for functions that make a call to one of Google's APIs. Used to
-    avoid hitting rate limits
+    Decorator for methods of `SheetDownloader` that make a call to one of
+    Google's APIs. Used to avoid hitting rate limits: calls are spaced out
+    using the downloader's rate limiter, and retried with exponential backoff
+    if a rate limit is exceeded anyway
     """
-    def inner(*args, **kwargs):
-        # Rate limit is 'max_request' requests per 'min_time' seconds
-        max_requests = 100
-        min_time = 120
+    def inner(self, *args, **kwargs):
+        limiter = self.rate_limiter
+        attempt = 0
+        while True:
+            limiter.acquire()
+            try:
+                return func(self, *args, **kwargs)
+            except errors.HttpError as ex:
+                if not is_rate_limit_error(ex) or attempt >= limiter.max_retries:
+                    raise
+                limiter.backoff(attempt)
+                attempt += 1
 
-        now = time.time()
+    return inner
 
-        # Trim API_CALL_TIMES to calls made recently
-        if API_CALL_TIMES:
-            while now - API_CALL_TIMES[0] > min_time:
-                API_CALL_TIMES.pop(0)
 
-        # If 100 or more then wait long enough to make this next request
-        if len(API_CALL_TIMES) >= max_requests:
-            n = min_time - now + API_CALL_TIMES[0] + 2 # Add 2s leeway...
-            print("Waiting {} seconds to avoid reaching rate limit...".format(int(n)))
-            time.sleep(n)
+class TaskPool(object):
+    """
+    Run tasks on a pool of worker threads. Tasks may submit further tasks, and
+    `wait` blocks until every task (including those submitted later) has
+    finished.
 
-        API_CALL_TIMES.append(time.time())
+    If `jobs` is 1 no threads are used, and tasks are run immediately when they
+    are submitted.
+    """
+    def __init__(self, jobs=1):
+        self.pool = ThreadPool(jobs) if jobs > 1 else None
+        self.results = []
+        self.lock = threading.Lock()
 
-        return func(*args, **kwargs)
+    def submit(self, func, *args):
+        if self.pool is None:
+            func(*args)
+            return
 
-    return inner
+        result = self.pool.apply_async(func, args)
+        with self.lock:
+            self.results.append(result)
+
+    def wait(self):
+        """
+        Wait for all tasks to finish. Any exception raised by a task is
+        re-raised here
+        """
+        if self.pool is None:
+            return
+
+        # A task submits its children before it finishes, so once every result
+        # in the list has been collected there is no more work to do
+        i = 0
+        try:
+            while True:
+                with self.lock:
+                    if i >= len(self.results):
+                        break
+                    result = self.results[i]
+                result.get()
+                i += 1
+        finally:
+            self.pool.terminate()
+            self.pool.join()
 
 
 class SheetDownloader(object):
@@ -75,83 +197,407 @@ class SheetDownloader(object):
     spreadsheets
     """
 
-    def __init__(self, out_dir, secrets_file=None):
+    def __init__(self, out_dir, secrets_file=None, jobs=1, force=False,
+                 use_changes=False, rate_limiter=None, folders_per_query=20,
+                 xlsx_only=False, root_id=ROOT_FOLDER_ID, api_root=None,
+                 discovery_cache=None):
+        """
+        :param api_root:        if given, use the stand-in for Google's APIs
+                                served from this URL (see
+                                `fake_google_api.py`) without authenticating
+        :param discovery_cache: DiscoveryCache to build API clients from
+                                (default: cache in the user's cache directory)
+        """
         self.out_dir = out_dir
         self.secrets_file = secrets_file
+        self.jobs = jobs
+        self.force = force
+        self.use_changes = use_changes
+        self.folders_per_query = folders_per_query
+        self.xlsx_only = xlsx_only
+        self.root_id = root_id
+        self.tasks = None
+        self.manifest = DriveManifest(out_dir)
+        # Rate limit is 100 requests per 120 seconds. The same limiter is
+        # shared by all worker threads
+        self.rate_limiter = rate_limiter or RateLimiter(max_requests=100, period=120)
+        self.thread_data = threading.local()
+
+        self.discovery_cache = discovery_cache or DiscoveryCache()
+
+        if api_root:
+            discovery_urls = dict.fromkeys(DISCOVERY_URLS,
+                                           api_root + "/discovery/{api}/{apiVersion}")
+            self.credentials = None
+        else:
+            # A single set of credentials covers listing folders, reading
+            # sheet values and exporting spreadsheets
+            discovery_urls = DISCOVERY_URLS
+            self.credentials = get_credentials("drive-download", secrets_file)
+
+        # Build API clients from cached discovery documents. Requests are made
+        # with the current thread's Http object (see `get_http`)
+        self.drive_api = self.discovery_cache.build(
+            "drive", "v3", discovery_urls["drive"], http=self.get_http()
+        )
+        self.sheets_api = self.discovery_cache.build(
+            "sheets", "v4", discovery_urls["sheets"], http=self.get_http()
+        )
 
-        # Authenticate and get API handles
-        drive_credentials = get_credentials("drive", secrets_file)
-        drive_http = drive_credentials.authorize(httplib2.Http())
-        self.drive_api = discovery.build("drive", "v3", http=drive_http)
+    def run(self):
+        makedirs(self.out_dir)
+        if self.manifest.resumed:
+            print("Resuming interrupted run: {} spreadsheets recovered from journal"
+                  .format(self.manifest.resumed))
+        try:
+            if self.use_changes and self.manifest.page_token and not self.force:
+                if self.sync_changes():
+                    return
+                print("Folder structure has changed on Drive; performing a full sync")
+            self.sync_all()
+        finally:
+            self.manifest.save()
+            print("Waited {:.1f} seconds in total to avoid exceeding rate limits"
+                  .format(self.rate_limiter.total_wait))
+
+    def sync_all(self):
+        """
+        Traverse the whole folder tree and download each spreadsheet that has
+        changed. Afterwards, store a page token for the changes feed so that
+        later runs can use `sync_changes`
+        """
+        # Get the token before traversing so that changes made during the sync
+        # are not missed
+        page_token = self.get_start_page_token()
+        self.manifest.reset_folders(self.root_id)
+        # Until the traversal finishes the folders in the manifest are
+        # incomplete, so the changes feed cannot be used if this run is
+        # interrupted
+        self.manifest.page_token = None
+
+        self.tasks = TaskPool(self.jobs)
+        self.tasks.submit(self.find_all_spreadsheets,
+                          self.save_spreadsheet_callback(), self.root_id)
+        self.tasks.wait()
+
+        # Only remove deleted spreadsheets once the whole tree has been
+        # traversed successfully, since otherwise we cannot tell which
+        # spreadsheets are missing
+        removed = self.manifest.remove_unseen()
+        if removed:
+            print("Removed {} spreadsheets deleted from Drive".format(len(removed)))
+        self.manifest.page_token = page_token
+
+    def sync_changes(self):
+        """
+        Process only the files that have changed since the last sync, as
+        listed in the Drive changes feed. Changed files are mapped to local
+        paths using the folders recorded in the manifest.
 
-        sheets_credentials = get_credentials("sheets", secrets_file)
-        sheets_http = sheets_credentials.authorize(httplib2.Http())
-        discovery_url = ("https://sheets.googleapis.com/$discovery/rest?version=v4")
-        self.sheets_api = discovery.build("sheets", "v4", http=sheets_http,
-                                          discoveryServiceUrl=discovery_url)
+        :return: False if a full sync is required because a known folder has
+                 been moved, renamed or deleted; True otherwise
+        """
+        changes, new_page_token = self.get_changes(self.manifest.page_token)
+
+        # Only the latest change for each file is relevant
+        latest = OrderedDict()
+        for change in changes:
+            latest[change["fileId"]] = change
+
+        new_folders = []
+        spreadsheets = []
+        for file_id, change in latest.items():
+            f = change.get("file")
+            removed = change.get("removed") or (f and f.get("trashed"))
+
+            if file_id == self.root_id:
+                if removed:
+                    return False
+            elif file_id in self.manifest.folders:
+                if (removed or f["mimeType"] != FOLDER_MIME_TYPE
+                        or self.get_folder_path(f) != self.manifest.folders[file_id]):
+                    return False
+            elif f and f["mimeType"] == FOLDER_MIME_TYPE:
+                if not removed:
+                    new_folders.append(f)
+            elif (f and f["mimeType"] in SPREADSHEET_MIME_TYPES) or self.manifest.get(file_id):
+                spreadsheets.append((file_id, f, removed))
+
+        # Add new folders whose parent is known. Repeat until no progress is
+        # made, since a new folder may be inside another new folder
+        while new_folders:
+            remaining = [f for f in new_folders if self.get_folder_path(f) is False]
+            for f in new_folders:
+                path = self.get_folder_path(f)
+                if path is not False:
+                    self.manifest.set_folder(f["id"], path)
+            if len(remaining) == len(new_folders):
+                break
+            new_folders = remaining
+
+        print("Found {} changed spreadsheets".format(len(spreadsheets)))
+        callback = self.save_spreadsheet_callback()
+        self.tasks = TaskPool(self.jobs)
+        for file_id, f, removed in spreadsheets:
+            parent_folder = None if removed else self.get_parent_folder(f)
+            if parent_folder is None:
+                # Spreadsheet deleted, or moved out of the tree or into a
+                # skipped folder
+                self.manifest.remove_local_files(file_id)
+                continue
+            self.tasks.submit(callback, f["name"], file_id, parent_folder, f)
+        self.tasks.wait()
+
+        self.manifest.page_token = new_page_token
+        return True
+
+    def get_parent_folder(self, f):
+        """
+        Return the path of the parent folder of a Drive file relative to the
+        output directory, or None if it is not in the tree or is in a skipped
+        folder
+        """
+        for parent_id in f.get("parents", []):
+            path = self.manifest.folders.get(parent_id)
+            if path is not None:
+                return path
+        return None
 
-        # Also authenticate to separate downloder library for raw XLSX downloads
-        drive_service = service.DriveService(self.secrets_file)
-        drive_service.auth()
- 
-        self.drive_service = drive_service.drive_service
+    def get_folder_path(self, f):
+        """
+        Return the path a Drive folder should have according to its parent's
+        path in the manifest, None if it should be skipped, or False if its
+        parent is not in the tree
+        """
+        for parent_id in f.get("parents", []):
+            if parent_id not in self.manifest.folders:
+                continue
+            parent_path = self.manifest.folders[parent_id]
+            if parent_path is None or f["name"] in FOLDERS_TO_SKIP:
+                return None
+            return os.path.join(parent_path, f["name"])
+        return False
+
+    def submit(self, func, *args):
+        """
+        Run `func` with the given arguments on the worker pool if one is
+        running, or immediately otherwise
+        """
+        if self.tasks is None:
+            func(*args)
+        else:
+            self.tasks.submit(func, *args)
 
-    def run(self):
-        self.find_all_spreadsheets(self.save_spreadsheet_callback())
+    def get_http(self):
+        """
+        Return the authorised Http object belonging to the current thread.
+        httplib2.Http objects are not thread-safe, so each thread gets its
+        own; each one keeps its connections open and is shared by the Drive,
+        Sheets and export requests made by that thread
+        """
+        thread_http = getattr(self.thread_data, "http", None)
+        if thread_http is None:
+            thread_http = httplib2.Http()
+            if self.credentials is not None:
+                thread_http = self.credentials.authorize(thread_http)
+            self.thread_data.http = thread_http
+        return thread_http
 
     @api_call
+    def get_files_page(self, query, page_token=None):
+        """
+        Return a single page of the results of a Drive files query
+        """
+        return (self.drive_api.files().list(
+            q=query,
+            pageSize=1000,
+            pageToken=page_token,
+            fields=LIST_FIELDS
+        ).execute(http=self.get_http()))
+
+    def get_children_of_folders(self, folder_ids):
+        """
+        List the children of several Drive folders in a single query (which
+        may span several pages)
+        :param folder_ids: list of folder IDs
+        :return:           dict mapping each folder ID to a list of its
+                           children
+        """
+        query = "({}) and trashed = false".format(
+            " or ".join("'{}' in parents".format(folder_id)
+                        for folder_id in folder_ids)
+        )
+        children = OrderedDict((folder_id, []) for folder_id in folder_ids)
+
+        page_token = None
+        while True:
+            results = self.get_files_page(query, page_token)
+            for f in results.get("files", []):
+                for parent_id in f.get("parents", []):
+                    if parent_id in children:
+                        children[parent_id].append(f)
+            page_token = results.get("nextPageToken")
+            if not page_token:
+                return children
+
     def get_folder_children(self, folder_id):
         """
         Return a list of children of the Drive folder with the given ID
         """
-        results = (self.drive_api.files().list(
-            fields="files(id, name, mimeType)",
-            q="'{}' in parents".format(folder_id)
-        ).execute())
-        return results.get("files", [])
+        return self.get_children_of_folders([folder_id])[folder_id]
+
+    @api_call
+    def get_start_page_token(self):
+        """
+        Return a page token for the current state of the Drive changes feed
+        """
+        results = (self.drive_api.changes().getStartPageToken()
+                   .execute(http=self.get_http()))
+        return results["startPageToken"]
+
+    @api_call
+    def get_changes_page(self, page_token):
+        """
+        Return a single page of the Drive changes feed
+        """
+        return (self.drive_api.changes().list(
+            pageToken=page_token,
+            pageSize=1000,
+            spaces="drive",
+            fields=CHANGES_FIELDS
+        ).execute(http=self.get_http()))
+
+    def get_changes(self, page_token):
+        """
+        Return a list of all changes since `page_token` was issued, and a new
+        page token to use for the next sync
+        """
+        changes = []
+        while True:
+            results = self.get_changes_page(page_token)
+            changes += results.get("changes", [])
+            if "newStartPageToken" in results:
+                return changes, results["newStartPageToken"]
+            page_token = results["nextPageToken"]
 
     @api_call
     def get_spreadsheet(self, sheet_id):
-        return self.sheets_api.spreadsheets().get(spreadsheetId=sheet_id).execute()
+        """
+        Return metadata for a spreadsheet, including the properties of each of
+        its sheets
+        """
+        return (self.sheets_api.spreadsheets().get(spreadsheetId=sheet_id,
+                                                   fields="sheets.properties")
+                .execute(http=self.get_http()))
 
     @api_call
-    def get_sheet_values(self, sheet_id, cell_range):
-        results = self.sheets_api.spreadsheets().values().get(spreadsheetId=sheet_id,
-                                                              range=cell_range).execute()
-        return results.get("values", [])
+    def get_sheet_values_batch(self, sheet_id, cell_ranges):
+        """
+        Fetch several ranges from a spreadsheet in a single request
+        :param sheet_id:    ID of the spreadsheet
+        :param cell_ranges: list of ranges in A1 notation
+        :return:            list of values for each range (in the same order
+                            as `cell_ranges`), where each item is a list of
+                            lists representing the rows in that range
+        """
+        results = (self.sheets_api.spreadsheets().values()
+                   .batchGet(spreadsheetId=sheet_id, ranges=cell_ranges)
+                   .execute(http=self.get_http()))
+        return [r.get("values", []) for r in results.get("valueRanges", [])]
+
+    def get_all_sheet_values(self, sheet_id, sheets):
+        """
+        Fetch the values of every cell in the given sheets, using as few
+        batched requests as possible while keeping each below
+        `MAX_CELLS_PER_REQUEST` cells
+        :param sheet_id: ID of the spreadsheet
+        :param sheets:   list of sheet properties from `get_spreadsheet`
+        :return:         list of values for each sheet, where each item is a
+                         list of lists representing the rows of the sheet
+        """
+        # Group ranges into batches of (sheet index, range, first row)
+        batches = [[]]
+        batch_cells = 0
+        for i, properties in enumerate(sheets):
+            ncols = properties.get("gridProperties", {}).get("columnCount", 0)
+            first_row = 0
+            for cell_range, nrows in get_sheet_ranges(properties,
+                                                      MAX_CELLS_PER_REQUEST):
+                if batches[-1] and batch_cells + nrows * ncols > MAX_CELLS_PER_REQUEST:
+                    batches.append([])
+                    batch_cells = 0
+                batches[-1].append((i, cell_range, first_row))
+                batch_cells += nrows * ncols
+                first_row += nrows
+
+        all_values = [[] for _ in sheets]
+        for batch in batches:
+            if not batch:
+                continue
+            results = self.get_sheet_values_batch(sheet_id, [b[1] for b in batch])
+            for (i, _, first_row), values in zip(batch, results):
+                if values:
+                    # Trailing empty rows are omitted from each range, so pad
+                    # the rows already fetched up to the start of this one
+                    sheet_values = all_values[i]
+                    sheet_values += [[] for _ in range(first_row - len(sheet_values))]
+                    sheet_values += values
+        return all_values
 
     def find_all_spreadsheets(self, callback, root_id=ROOT_FOLDER_ID, folder_name=""):
         """
         Recursively search the drive folder with the given ID and call `callback`
         on each spreadsheet found. `callback` is called with args
-        (spreadsheet name, spreadsheet ID, parent folder name).
-        """
-        for f in self.get_folder_children(root_id):
-            if f["mimeType"] == FOLDER_MIME_TYPE:
-                if f["name"] in FOLDERS_TO_SKIP:
-                    print("Skipping folder '{}'".format(f["name"]))
-                    continue
+        (spreadsheet name, spreadsheet ID, parent folder name, Drive file
+        resource).
 
-                new_folder = os.path.join(folder_name, f["name"])
-                # Make the recursive call if we have found a sub-folder
-                self.find_all_spreadsheets(callback, root_id=f["id"], folder_name=new_folder)
+        When running with a worker pool, sub-folders and callbacks are
+        submitted to the pool instead of being processed directly.
+        """
+        self.find_spreadsheets_in_folders(callback, [(root_id, folder_name)])
 
-            elif f["mimeType"] in SPREADSHEET_MIME_TYPES:
-                # Process the spreadsheet
-                callback(f["name"], f["id"], folder_name)
+    def find_spreadsheets_in_folders(self, callback, folders):
+        """
+        List the children of several folders in a single query, call `callback`
+        on each spreadsheet found and search sub-folders recursively, in
+        batches of `self.folders_per_query` folders.
+        :param callback: callback function as for `find_all_spreadsheets`
+        :param folders:  list of tuples (folder ID, folder name)
+        """
+        folder_names = dict(folders)
+        sub_folders = []
+        children = self.get_children_of_folders([folder_id for folder_id, _ in folders])
+
+        for parent_id, files in children.items():
+            folder_name = folder_names[parent_id]
+            for f in files:
+                if f["mimeType"] == FOLDER_MIME_TYPE:
+                    if f["name"] in FOLDERS_TO_SKIP:
+                        print("Skipping folder '{}'".format(f["name"]))
+                        self.manifest.set_folder(f["id"], None)
+                        continue
+
+                    new_folder = os.path.join(folder_name, f["name"])
+                    self.manifest.set_folder(f["id"], new_folder)
+                    sub_folders.append((f["id"], new_folder))
+
+                elif f["mimeType"] in SPREADSHEET_MIME_TYPES:
+                    # Process the spreadsheet
+                    self.submit(callback, f["name"], f["id"], folder_name, f)
+
+        # Make the recursive calls for the sub-folders we have found
+        n = self.folders_per_query
+        for i in range(0, len(sub_folders), n):
+            self.submit(self.find_spreadsheets_in_folders, callback, sub_folders[i:i + n])
 
     def write_values_to_tsv(self, values, out_file):
         """
         Write a sheet to `out_file`. `values` is a list of lists representing a
         range in the sheet
         """
-        with open(out_file, "w") as f:
-            for row in values:
-                f.write("\t".join([cell.strip().replace("\n", "|").encode("utf-8")
-                                   for cell in row]))
-                f.write(os.linesep)
+        write_values_to_tsv(values, out_file)
 
-    def download_all_sheets(self, sheet_id, out_dir):
+    def download_all_sheets(self, sheet_id, out_dir, on_complete=None):
         """
         Download each sheet of a spreadsheet as a TSV file and save them in the given
         output directory.
@@ -162,28 +608,79 @@ class SheetDownloader(object):
             .../spreadsheets/<spreadsheet_name>/*.tsv - tab-delimited files
             .../raw-spreadsheets/<spreadsheet_name> - XLSX file
 
+        The values of all sheets are fetched in a single batched request. The
+        raw spreadsheet is fetched in a separate task, so that it is downloaded
+        in parallel when running with a worker pool.
+
+        If `self.xlsx_only` is set, only the raw spreadsheet is downloaded and
+        the TSV files are created from it locally.
+
+        If given, `on_complete` is called with the list of TSV filenames written
+        once both the TSV files and the raw spreadsheet have been saved.
         """
-        # Get spreadsheet as a whole and iterate through each sheet
+        if self.xlsx_only:
+            def save_and_convert():
+                self.save_raw_spreadsheet(sheet_id, out_dir)
+                print("Saving sheets to {}...".format(out_dir))
+                tsv_names = convert_xlsx(self.get_raw_spreadsheet_path(out_dir), out_dir)
+                if on_complete:
+                    on_complete(tsv_names)
+
+            self.submit(save_and_convert)
+            return
+
+        # Get spreadsheet as a whole to find the names and sizes of each sheet.
+        # Sheets without a grid (e.g. charts) have no values to download
         results = self.get_spreadsheet(sheet_id)
+        sheets = [sheet["properties"] for sheet in results["sheets"]
+                  if sheet["properties"].get("sheetType", "GRID") == "GRID"]
+
+        print("Saving {} sheets to {}...".format(len(sheets), out_dir))
+        all_values = self.get_all_sheet_values(sheet_id, sheets)
+        tsv_names = []
+        for properties, values in zip(sheets, all_values):
+            tsv_name = "{}.tsv".format(properties["title"])
+            self.write_values_to_tsv(values, os.path.join(out_dir, tsv_name))
+            tsv_names.append(tsv_name)
 
-        print("Saving {} sheets to {}...".format(len(results["sheets"]), out_dir))
-        for sheet in results["sheets"]:
-            name = sheet["properties"]["title"]
-            cell_range = "'{}'!A1:Z{}".format(name, NROWS_TO_PARSE)
-            out_file = os.path.join(out_dir, "{}.tsv".format(name))
-            self.write_values_to_tsv(self.get_sheet_values(sheet_id, cell_range), out_file)
+        def save_raw():
+            self.save_raw_spreadsheet(sheet_id, out_dir)
+            if on_complete:
+                on_complete(tsv_names)
 
-        # Now download the raw spreadsheet 
+        self.submit(save_raw)
+
+    def get_raw_spreadsheet_path(self, out_dir):
+        """
+        Return the path to save the raw XLSX export of the spreadsheet whose
+        TSV files are saved in `out_dir`
+        """
+        return out_dir.replace('/spreadsheets/', '/raw-spreadsheets/')
+
+    def save_raw_spreadsheet(self, sheet_id, out_dir):
+        """
+        Export a spreadsheet as an XLSX file and save it under the
+        'raw-spreadsheets' directory corresponding to `out_dir`
+        """
         raw_dir = os.path.dirname(out_dir).replace('/spreadsheets', '/raw-spreadsheets')
-        if not os.path.isdir(raw_dir): os.makedirs(raw_dir)
+        makedirs(raw_dir)
 
-        raw_spreadsheet_file = out_dir.replace('/spreadsheets/', '/raw-spreadsheets/')
+        raw_spreadsheet_file = self.get_raw_spreadsheet_path(out_dir)
         print("Saving raw spreadsheet to: {}...".format(raw_spreadsheet_file))
+        self.export_spreadsheet(sheet_id, raw_spreadsheet_file)
 
-        request = self.drive_service.files().export_media(fileId=sheet_id,
+    @api_call
+    def export_spreadsheet(self, sheet_id, out_file):
+        """
+        Export a spreadsheet as an XLSX file. Exports count towards the Drive
+        API rate limit, and the file is rewritten from the start if the export
+        is retried
+        """
+        request = self.drive_api.files().export_media(fileId=sheet_id,
               mimeType='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet')
+        request.http = self.get_http()
 
-        with open(raw_spreadsheet_file, 'wb') as fh:
+        with atomic_write(out_file, "wb") as fh:
             downloader = http.MediaIoBaseDownload(fh, request)
 
             done = False
@@ -195,13 +692,29 @@ class SheetDownloader(object):
         Return a callback function to pass to `find_all_spreadsheets` that downloads
         and saves sheets to a directory under `self.out_dir`.
 
+        Spreadsheets whose version on Drive matches the one recorded in the
+        manifest are skipped, unless `self.force` is set.
         """
-        def callback(name, sheet_id, parent_folder):
-            target_dir = os.path.join(self.out_dir, parent_folder, name)
-            if not os.path.isdir(target_dir):
-                os.makedirs(target_dir)
+        def callback(name, sheet_id, parent_folder, file_info):
+            path = os.path.join(parent_folder, name)
+            self.manifest.mark_seen(sheet_id)
+            if not self.force and self.manifest.is_up_to_date(sheet_id, path, file_info):
+                print("Skipping unchanged spreadsheet {}".format(path))
+                return
+
+            # Remove the old copy if the spreadsheet has been moved or renamed
+            entry = self.manifest.get(sheet_id)
+            if entry and entry["path"] != path:
+                self.manifest.remove_local_files(sheet_id)
+
+            target_dir = os.path.join(self.out_dir, path)
+            makedirs(target_dir)
 
-            self.download_all_sheets(sheet_id, target_dir)
+            def on_complete(tsv_names):
+                raw_path = self.get_raw_spreadsheet_path(target_dir)
+                self.manifest.update(sheet_id, path, file_info, tsv_names, raw_path)
+
+            self.download_all_sheets(sheet_id, target_dir, on_complete=on_complete)
 
         return callback
 
@@ -216,8 +729,54 @@ def main():
         help="Client secrets JSON file (see README for instructions on how to "
              "obtain this). Only required for first time use."
     )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=1,
+        help="Number of worker threads to use for listing folders and "
+             "downloading sheets. All workers share the same API rate limit "
+             "[default: %(default)s]"
+    )
+    parser.add_argument(
+        "-f", "--force",
+        action="store_true",
+        help="Download all spreadsheets, even those that have not changed "
+             "since the last run"
+    )
+    parser.add_argument(
+        "-c", "--changes",
+        action="store_true",
+        dest="use_changes",
+        help="Only process files listed in the Drive changes feed since the "
+             "last run, instead of listing every folder. A full sync is "
+             "performed if there is no previous run to compare against, or if "
+             "folders have been moved, renamed or deleted"
+    )
+    parser.add_argument(
+        "--folders-per-query",
+        type=int,
+        default=20,
+        help="Maximum number of folders to list in a single Drive query "
+             "[default: %(default)s]"
+    )
+    parser.add_argument(
+        "--xlsx-only",
+        action="store_true",
+        help="Only export each spreadsheet as XLSX, and convert the XLSX "
+             "files to TSV locally instead of fetching sheet values with the "
+             "Sheets API"
+    )
     args = parser.parse_args(sys.argv[1:])
-    downloader = SheetDownloader(args.output_dir, secrets_file=args.secrets)
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.folders_per_query < 1:
+        parser.error("--folders-per-query must be at least 1")
+
+    downloader = SheetDownloader(args.output_dir, secrets_file=args.secrets,
+                                 jobs=args.jobs, force=args.force,
+                                 use_changes=args.use_changes,
+                                 folders_per_query=args.folders_per_query,
+                                 xlsx_only=args.xlsx_only)
     downloader.run()
 
 if __name__ == "__main__":
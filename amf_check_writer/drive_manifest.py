@@ -0,0 +1,241 @@
+"""
+Manifest of spreadsheets downloaded from Google Drive, used by
+download-from-drive to skip spreadsheets that have not changed since the last
+run, and to map files in the Drive changes feed to local paths.
+
+Each spreadsheet is also recorded in an append-only journal as soon as it has
+been downloaded, so that if a run is killed before the manifest is saved the
+next run can resume where it stopped.
+"""
+import os
+import json
+import shutil
+import threading
+
+from amf_check_writer.file_utils import atomic_write, file_hash
+
+
+MANIFEST_FILENAME = ".drive-manifest.json"
+JOURNAL_FILENAME = ".drive-manifest.journal"
+
+
+def get_version(file_info):
+    """
+    Return a string identifying the revision of a Drive file, from a file
+    resource containing 'version' and/or 'modifiedTime' fields
+    """
+    return file_info.get("version") or file_info.get("modifiedTime")
+
+
+class DriveManifest(object):
+    """
+    Record of the Drive ID, version and local TSV hashes of each spreadsheet
+    downloaded to an output directory. Paths are stored relative to the output
+    directory.
+
+    The path of each folder found in the last full sync, and a page token for
+    the Drive changes feed, are also stored.
+
+    Methods may be called from several threads at once.
+    """
+    def __init__(self, out_dir):
+        """
+        Load the manifest from `out_dir` if it exists
+        :param out_dir: directory spreadsheets are downloaded to
+        """
+        self.out_dir = out_dir
+        self.path = os.path.join(out_dir, MANIFEST_FILENAME)
+        self.journal_path = os.path.join(out_dir, JOURNAL_FILENAME)
+        self.journal = None
+        self.lock = threading.Lock()
+        # IDs of spreadsheets found on Drive in this run
+        self.seen = set()
+        self.spreadsheets = {}
+        # Mapping from folder ID to path relative to the output directory, or
+        # None for folders that are skipped
+        self.folders = {}
+        self.page_token = None
+
+        if os.path.isfile(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+            self.spreadsheets = data.get("spreadsheets", {})
+            self.folders = data.get("folders", {})
+            self.page_token = data.get("page_token")
+
+        # Number of spreadsheets recovered from the journal of an interrupted
+        # run
+        self.resumed = 0
+        if os.path.isfile(self.journal_path):
+            self.resumed = self.replay_journal()
+
+    def replay_journal(self):
+        """
+        Apply the records in the journal left by a run that did not finish
+        :return: number of records applied
+        """
+        count = 0
+        with open(self.journal_path) as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # The last record may be incomplete if the run was killed
+                    # while writing it
+                    break
+                if record["entry"] is None:
+                    self.spreadsheets.pop(record["id"], None)
+                else:
+                    self.spreadsheets[record["id"]] = record["entry"]
+                count += 1
+        return count
+
+    def write_journal(self, file_id, entry):
+        """
+        Append a record to the journal and flush it to disk. Must be called
+        with the lock held
+        :param entry: the new manifest entry for the spreadsheet, or None if
+                      it has been removed
+        """
+        if self.journal is None:
+            self.journal = open(self.journal_path, "a")
+        self.journal.write(json.dumps({"id": file_id, "entry": entry}, sort_keys=True))
+        self.journal.write("\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+
+    def mark_seen(self, file_id):
+        with self.lock:
+            self.seen.add(file_id)
+
+    def get(self, file_id):
+        """
+        Return the manifest entry for a spreadsheet, or None if it has not
+        been downloaded before
+        """
+        with self.lock:
+            return self.spreadsheets.get(file_id)
+
+    def reset_folders(self, root_id):
+        """
+        Forget all folders except the root folder, ready for a full sync
+        """
+        with self.lock:
+            self.folders = {root_id: ""}
+
+    def set_folder(self, folder_id, path):
+        """
+        Record the path of a folder, or None if the folder is skipped
+        """
+        with self.lock:
+            self.folders[folder_id] = path
+
+    def is_up_to_date(self, file_id, path, file_info):
+        """
+        Return True if the spreadsheet with the given ID has already been
+        downloaded to `path`, its version on Drive is unchanged and the local
+        TSV files have not been modified or deleted
+        :param file_id:   Drive ID of the spreadsheet
+        :param path:      path of the spreadsheet directory relative to the
+                          output directory
+        :param file_info: Drive file resource for the spreadsheet
+        """
+        entry = self.get(file_id)
+        if (not entry or entry["path"] != path
+                or entry["version"] != get_version(file_info)):
+            return False
+
+        for tsv_name, expected_hash in entry["tsv_hashes"].items():
+            tsv_path = os.path.join(self.out_dir, path, tsv_name)
+            if not os.path.isfile(tsv_path) or file_hash(tsv_path) != expected_hash:
+                return False
+        return True
+
+    def update(self, file_id, path, file_info, tsv_names, raw_path):
+        """
+        Record that a spreadsheet has been downloaded. TSV files left over from
+        sheets that no longer exist in the spreadsheet are deleted.
+        :param file_id:   Drive ID of the spreadsheet
+        :param path:      path of the spreadsheet directory relative to the
+                          output directory
+        :param file_info: Drive file resource for the spreadsheet
+        :param tsv_names: filenames of the TSV files written
+        :param raw_path:  path to the raw XLSX export
+        """
+        spreadsheet_dir = os.path.join(self.out_dir, path)
+        tsv_hashes = dict(
+            (name, file_hash(os.path.join(spreadsheet_dir, name)))
+            for name in tsv_names
+        )
+
+        old_entry = self.get(file_id)
+        if old_entry and old_entry["path"] == path:
+            for name in set(old_entry["tsv_hashes"]) - set(tsv_hashes):
+                stale = os.path.join(spreadsheet_dir, name)
+                if os.path.isfile(stale):
+                    os.remove(stale)
+
+        entry = {
+            "name": file_info.get("name"),
+            "path": path,
+            "raw_path": os.path.relpath(raw_path, self.out_dir),
+            "version": get_version(file_info),
+            "modifiedTime": file_info.get("modifiedTime"),
+            "tsv_hashes": tsv_hashes
+        }
+        with self.lock:
+            self.spreadsheets[file_id] = entry
+            self.write_journal(file_id, entry)
+
+    def remove_local_files(self, file_id):
+        """
+        Delete the local TSV directory and raw XLSX file for a spreadsheet, and
+        remove it from the manifest
+        """
+        with self.lock:
+            entry = self.spreadsheets.pop(file_id, None)
+            if entry:
+                self.write_journal(file_id, None)
+        if not entry:
+            return
+
+        spreadsheet_dir = os.path.join(self.out_dir, entry["path"])
+        raw_path = os.path.join(self.out_dir, entry["raw_path"])
+        if os.path.isdir(spreadsheet_dir):
+            print("Removing {}...".format(spreadsheet_dir))
+            shutil.rmtree(spreadsheet_dir)
+        if os.path.isfile(raw_path):
+            os.remove(raw_path)
+
+    def remove_unseen(self):
+        """
+        Remove the local files for spreadsheets that were not seen on Drive in
+        this run, i.e. spreadsheets that have been deleted. Should only be
+        called after the whole folder tree has been traversed.
+        :return: list of IDs of removed spreadsheets
+        """
+        with self.lock:
+            removed = [file_id for file_id in self.spreadsheets
+                       if file_id not in self.seen]
+        for file_id in removed:
+            self.remove_local_files(file_id)
+        return removed
+
+    def save(self):
+        """
+        Write the manifest to the output directory. The journal is no longer
+        needed once the manifest has been replaced, so it is removed
+        """
+        with self.lock:
+            with atomic_write(self.path) as f:
+                json.dump({
+                    "spreadsheets": self.spreadsheets,
+                    "folders": self.folders,
+                    "page_token": self.page_token
+                }, f, indent=4, sort_keys=True)
+
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            if os.path.isfile(self.journal_path):
+                os.remove(self.journal_path)
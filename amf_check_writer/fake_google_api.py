@@ -0,0 +1,598 @@
+"""
+Local stand-in for the parts of Google's Drive and Sheets APIs used by
+download-from-drive, serving a synthetic folder tree of spreadsheets.
+
+The server also serves discovery documents, so the same discovery-based API
+clients can be used against it as against Google's servers. Latency and rate
+limit (429) errors can be injected, and the number of requests made is
+counted. It is used in tests and `benchmarks/bench_download.py`.
+"""
+from __future__ import print_function
+import io
+import re
+import json
+import time
+import random
+import zipfile
+import threading
+from collections import deque, OrderedDict
+from xml.sax.saxutils import escape, quoteattr
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+    from urllib import unquote
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, unquote
+
+from amf_check_writer.xlsx_to_tsv import column_index, column_letters
+
+
+FOLDER_MIME_TYPE = "application/vnd.google-apps.folder"
+SPREADSHEET_MIME_TYPE = "application/vnd.google-apps.spreadsheet"
+XLSX_MIME_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# Default size of a new sheet in Google Sheets
+DEFAULT_ROW_COUNT = 1000
+DEFAULT_COLUMN_COUNT = 26
+
+RANGE_REGEX = re.compile(
+    r"^(?:'(?P<quoted>(?:[^']|'')+)'|(?P<name>[^!]+))"
+    r"(?:!(?P<col1>[A-Z]+)(?P<row1>\d+)(?::(?P<col2>[A-Z]+)(?P<row2>\d+))?)?$"
+)
+
+
+class FakeDriveTree(object):
+    """
+    Folder tree of spreadsheets, with a log of changes for the Drive changes
+    feed.
+
+    Files are stored as dicts of Drive file resource fields. Spreadsheets also
+    have a 'sheets' entry, which is an OrderedDict mapping sheet names to a
+    list of rows of cell values.
+    """
+    def __init__(self, root_id="root"):
+        self.root_id = root_id
+        self.lock = threading.Lock()
+        self.files = OrderedDict()
+        self.changes = []
+        self.next_id = 0
+        self.files[root_id] = {"id": root_id, "name": "root",
+                               "mimeType": FOLDER_MIME_TYPE, "parents": []}
+
+    @classmethod
+    def generate(cls, root_id="root", depth=2, folders_per_folder=3,
+                 spreadsheets_per_folder=4, sheets_per_spreadsheet=5,
+                 rows_per_sheet=50, seed=0):
+        """
+        Create a tree with synthetic product definition spreadsheets
+        """
+        tree = cls(root_id=root_id)
+        rand = random.Random(seed)
+
+        def fill(folder_id, level):
+            for _ in range(spreadsheets_per_folder):
+                name = "product-{}".format(tree.next_id)
+                sheets = OrderedDict()
+                for i in range(sheets_per_spreadsheet):
+                    rows = [["Variable", "Attribute", "Value"]]
+                    while len(rows) < rows_per_sheet:
+                        var = "var_{}".format(rand.randint(0, 10 ** 6))
+                        rows.append([var])
+                        rows.append(["", "units", "m s-1"])
+                        rows.append(["", "long_name", "Variable\n{}".format(var)])
+                    sheets["Sheet {}".format(i + 1)] = rows[:rows_per_sheet]
+                tree.add_spreadsheet(folder_id, "{}.xlsx".format(name), sheets)
+
+            if level < depth:
+                for _ in range(folders_per_folder):
+                    sub_id = tree.add_folder(folder_id, "folder-{}".format(tree.next_id))
+                    fill(sub_id, level + 1)
+
+        fill(root_id, 1)
+        return tree
+
+    def new_id(self):
+        self.next_id += 1
+        return "id{}".format(self.next_id)
+
+    def add_folder(self, parent_id, name):
+        """
+        Add a folder and return its ID
+        """
+        with self.lock:
+            folder_id = self.new_id()
+            self.files[folder_id] = {"id": folder_id, "name": name,
+                                     "mimeType": FOLDER_MIME_TYPE,
+                                     "parents": [parent_id]}
+            self.record_change(folder_id)
+        return folder_id
+
+    def add_spreadsheet(self, parent_id, name, sheets):
+        """
+        Add a spreadsheet and return its ID
+        """
+        with self.lock:
+            sheet_id = self.new_id()
+            self.files[sheet_id] = {"id": sheet_id, "name": name,
+                                    "mimeType": SPREADSHEET_MIME_TYPE,
+                                    "parents": [parent_id], "version": "1",
+                                    "modifiedTime": self.timestamp(),
+                                    "sheets": sheets}
+            self.record_change(sheet_id)
+        return sheet_id
+
+    def update_spreadsheet(self, sheet_id, sheets):
+        """
+        Replace the contents of a spreadsheet and increment its version
+        """
+        with self.lock:
+            f = self.files[sheet_id]
+            f["sheets"] = sheets
+            f["version"] = str(int(f["version"]) + 1)
+            f["modifiedTime"] = self.timestamp()
+            self.record_change(sheet_id)
+
+    def update(self, file_id, **fields):
+        """
+        Change fields of a file (e.g. 'name', 'parents' or 'trashed')
+        """
+        with self.lock:
+            self.files[file_id].update(fields)
+            self.record_change(file_id)
+
+    def delete(self, file_id):
+        with self.lock:
+            del self.files[file_id]
+            self.record_change(file_id)
+
+    def timestamp(self):
+        return "2018-01-01T00:00:{:02d}.000Z".format(len(self.changes) % 60)
+
+    def record_change(self, file_id):
+        self.changes.append(file_id)
+
+    def resource(self, f):
+        """
+        Return the Drive file resource for a file, without the sheet contents
+        """
+        return dict((k, v) for k, v in f.items() if k != "sheets")
+
+    def children(self, parent_ids, include_trashed=True):
+        with self.lock:
+            return [self.resource(f) for f in self.files.values()
+                    if set(f["parents"]) & set(parent_ids)
+                    and (include_trashed or not f.get("trashed"))]
+
+    def get_changes(self, start, end):
+        with self.lock:
+            changes = []
+            for file_id in self.changes[start:end]:
+                f = self.files.get(file_id)
+                change = {"fileId": file_id, "removed": f is None}
+                if f is not None:
+                    change["file"] = self.resource(f)
+                changes.append(change)
+            return changes
+
+    def get_sheets(self, sheet_id):
+        with self.lock:
+            f = self.files.get(sheet_id)
+            if f is None or f["mimeType"] != SPREADSHEET_MIME_TYPE:
+                return None
+            return f["sheets"]
+
+
+def make_xlsx(sheets):
+    """
+    Return the bytes of an XLSX file containing the given sheets (as stored in
+    `FakeDriveTree`), using inline strings for all cells
+    """
+    main_ns = "http://schemas.openxmlformats.org/spreadsheetml/2006/main"
+    rel_ns = "http://schemas.openxmlformats.org/officeDocument/2006/relationships"
+
+    out = io.BytesIO()
+    with zipfile.ZipFile(out, "w", zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("[Content_Types].xml", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '</Types>'
+        ))
+        sheet_elems = []
+        rels = []
+        for i, (name, rows) in enumerate(sheets.items()):
+            sheet_elems.append('<sheet name={} sheetId="{}" r:id="rId{}"/>'
+                               .format(quoteattr(name), i + 1, i + 1))
+            rels.append('<Relationship Id="rId{}" Target="worksheets/sheet{}.xml" '
+                        'Type="{}/worksheet"/>'.format(i + 1, i + 1, rel_ns))
+
+            row_elems = []
+            for r, row in enumerate(rows):
+                cells = "".join(
+                    '<c r="{}{}" t="inlineStr"><is><t xml:space="preserve">{}</t></is></c>'
+                    .format(column_letters(c), r + 1, escape(value))
+                    for c, value in enumerate(row) if value
+                )
+                row_elems.append('<row r="{}">{}</row>'.format(r + 1, cells))
+            zf.writestr("xl/worksheets/sheet{}.xml".format(i + 1), (
+                '<?xml version="1.0" encoding="UTF-8"?>'
+                '<worksheet xmlns="{}"><sheetData>{}</sheetData></worksheet>'
+                .format(main_ns, "".join(row_elems))
+            ).encode("utf-8"))
+
+        zf.writestr("xl/workbook.xml", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<workbook xmlns="{}" xmlns:r="{}"><sheets>{}</sheets></workbook>'
+            .format(main_ns, rel_ns, "".join(sheet_elems))
+        ).encode("utf-8"))
+        zf.writestr("xl/_rels/workbook.xml.rels", (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '{}</Relationships>'.format("".join(rels))
+        ))
+    return out.getvalue()
+
+
+def get_range_values(sheets, cell_range):
+    """
+    Return the values in a range in A1 notation, trimmed in the same way as
+    the Sheets API: trailing empty cells and rows are omitted
+    :return: tuple (sheet name, values), or None if the sheet does not exist
+    """
+    match = RANGE_REGEX.match(cell_range)
+    if not match:
+        return None
+    name = match.group("name")
+    if name is None:
+        name = match.group("quoted").replace("''", "'")
+    if name not in sheets:
+        return None
+
+    rows = sheets[name]
+    row1, row2 = 0, len(rows)
+    col1, col2 = 0, None
+    if match.group("col1"):
+        col1 = column_index(match.group("col1"))
+        row1 = int(match.group("row1")) - 1
+        col2 = col1 + 1
+        row2 = row1 + 1
+        if match.group("col2"):
+            col2 = column_index(match.group("col2")) + 1
+            row2 = int(match.group("row2"))
+
+    values = []
+    for row in rows[row1:row2]:
+        row = list(row[col1:col2])
+        while row and not row[-1]:
+            row.pop()
+        values.append(row)
+    while values and not values[-1]:
+        values.pop()
+    return name, values
+
+
+def discovery_document(api, version, root_url):
+    """
+    Return a minimal discovery document for the methods served by
+    `FakeGoogleApiServer`
+    """
+    def param(location="query", required=False, type="string", repeated=False):
+        p = {"location": location, "type": type}
+        if required:
+            p["required"] = True
+        if repeated:
+            p["repeated"] = True
+        return p
+
+    def method(method_id, path, params, response=None, media=False):
+        m = {
+            "id": method_id,
+            "path": path,
+            "httpMethod": "GET",
+            "parameters": params,
+            "parameterOrder": [name for name, p in params.items()
+                               if p.get("required") and p["location"] == "path"]
+        }
+        if response:
+            m["response"] = {"$ref": response}
+        if media:
+            m["supportsMediaDownload"] = True
+        return m
+
+    if api == "drive":
+        service_path = "drive/v3/"
+        resources = {
+            "files": {"methods": {
+                "list": method("drive.files.list", "files", {
+                    "q": param(), "pageSize": param(type="integer"),
+                    "pageToken": param()
+                }, response="FileList"),
+                "export": method("drive.files.export", "files/{fileId}/export", {
+                    "fileId": param("path", required=True),
+                    "mimeType": param(required=True)
+                }, media=True)
+            }},
+            "changes": {"methods": {
+                "getStartPageToken": method("drive.changes.getStartPageToken",
+                                            "changes/startPageToken", {},
+                                            response="StartPageToken"),
+                "list": method("drive.changes.list", "changes", {
+                    "pageToken": param(required=True),
+                    "pageSize": param(type="integer"), "spaces": param()
+                }, response="ChangeList")
+            }}
+        }
+        schemas = ["FileList", "StartPageToken", "ChangeList"]
+    else:
+        service_path = ""
+        resources = {
+            "spreadsheets": {
+                "methods": {
+                    "get": method("sheets.spreadsheets.get",
+                                  "v4/spreadsheets/{spreadsheetId}", {
+                                      "spreadsheetId": param("path", required=True)
+                                  }, response="Spreadsheet")
+                },
+                "resources": {"values": {"methods": {
+                    "batchGet": method("sheets.spreadsheets.values.batchGet",
+                                       "v4/spreadsheets/{spreadsheetId}/values:batchGet", {
+                                           "spreadsheetId": param("path", required=True),
+                                           "ranges": param(repeated=True)
+                                       }, response="BatchGetValuesResponse")
+                }}}
+            }
+        }
+        schemas = ["Spreadsheet", "BatchGetValuesResponse"]
+
+    return {
+        "kind": "discovery#restDescription",
+        "discoveryVersion": "v1",
+        "id": "{}:{}".format(api, version),
+        "name": api,
+        "version": version,
+        "protocol": "rest",
+        "rootUrl": root_url + "/",
+        "servicePath": service_path,
+        "batchPath": "batch",
+        "parameters": {
+            "alt": {"type": "string", "location": "query", "default": "json",
+                    "enum": ["json", "media"]},
+            "fields": param()
+        },
+        "schemas": dict((name, {"id": name, "type": "object"}) for name in schemas),
+        "resources": resources
+    }
+
+
+class FakeGoogleApiHandler(BaseHTTPRequestHandler):
+    """
+    Request handler for `FakeGoogleApiServer`
+    """
+    protocol_version = "HTTP/1.1"
+
+    ROUTES = (
+        ("discovery", re.compile(r"^/discovery/(?P<api>\w+)/(?P<version>\w+)$")),
+        ("files.list", re.compile(r"^/drive/v3/files$")),
+        ("files.export", re.compile(r"^/drive/v3/files/(?P<id>[^/]+)/export$")),
+        ("changes.getStartPageToken", re.compile(r"^/drive/v3/changes/startPageToken$")),
+        ("changes.list", re.compile(r"^/drive/v3/changes$")),
+        ("spreadsheets.get", re.compile(r"^/v4/spreadsheets/(?P<id>[^/]+)$")),
+        ("spreadsheets.values.batchGet",
+         re.compile(r"^/v4/spreadsheets/(?P<id>[^/]+)/values:batchGet$")),
+    )
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = parse_qs(url.query)
+        path = unquote(url.path)
+
+        for name, regex in self.ROUTES:
+            match = regex.match(path)
+            if match:
+                break
+        else:
+            return self.send_error_json(404, "notFound", "No such method")
+
+        if name == "discovery":
+            with self.server.lock:
+                self.server.discovery_count += 1
+            doc = discovery_document(match.group("api"), match.group("version"),
+                                     self.server.url)
+            return self.send_json(doc)
+
+        error = self.server.before_request(name)
+        if error:
+            return self.send_error_json(*error)
+        getattr(self, "handle_" + name.replace(".", "_"))(params, **match.groupdict())
+
+    def get_param(self, params, name, default=None):
+        return params.get(name, [default])[0]
+
+    def handle_files_list(self, params):
+        tree = self.server.tree
+        query = self.get_param(params, "q", "")
+        parent_ids = re.findall(r"'([^']+)' in parents", query)
+        files = tree.children(parent_ids,
+                              include_trashed="trashed = false" not in query)
+        self.send_page(params, files, "files")
+
+    def handle_files_export(self, params, id):
+        sheets = self.server.tree.get_sheets(id)
+        if sheets is None:
+            return self.send_error_json(404, "notFound", "File not found")
+        if self.get_param(params, "mimeType") != XLSX_MIME_TYPE:
+            return self.send_error_json(400, "badRequest", "Unsupported mimeType")
+        self.send_body(make_xlsx(sheets), XLSX_MIME_TYPE)
+
+    def handle_changes_getStartPageToken(self, params):
+        with self.server.tree.lock:
+            token = str(len(self.server.tree.changes))
+        self.send_json({"startPageToken": token})
+
+    def handle_changes_list(self, params):
+        tree = self.server.tree
+        start = int(self.get_param(params, "pageToken"))
+        page_size = int(self.get_param(params, "pageSize", 100))
+        with tree.lock:
+            total = len(tree.changes)
+        end = min(start + page_size, total)
+        result = {"changes": tree.get_changes(start, end)}
+        if end < total:
+            result["nextPageToken"] = str(end)
+        else:
+            result["newStartPageToken"] = str(end)
+        self.send_json(result)
+
+    def handle_spreadsheets_get(self, params, id):
+        sheets = self.server.tree.get_sheets(id)
+        if sheets is None:
+            return self.send_error_json(404, "notFound", "Spreadsheet not found")
+        self.send_json({"sheets": [
+            {"properties": {
+                "sheetId": i,
+                "title": name,
+                "index": i,
+                "gridProperties": {
+                    "rowCount": max(DEFAULT_ROW_COUNT, len(rows)),
+                    "columnCount": max([DEFAULT_COLUMN_COUNT] + [len(r) for r in rows])
+                }
+            }}
+            for i, (name, rows) in enumerate(sheets.items())
+        ]})
+
+    def handle_spreadsheets_values_batchGet(self, params, id):
+        sheets = self.server.tree.get_sheets(id)
+        if sheets is None:
+            return self.send_error_json(404, "notFound", "Spreadsheet not found")
+        value_ranges = []
+        for cell_range in params.get("ranges", []):
+            result = get_range_values(sheets, cell_range)
+            if result is None:
+                return self.send_error_json(400, "badRequest",
+                                            "Unable to parse range: {}".format(cell_range))
+            value_range = {"range": cell_range, "majorDimension": "ROWS"}
+            if result[1]:
+                value_range["values"] = result[1]
+            value_ranges.append(value_range)
+        self.send_json({"spreadsheetId": id, "valueRanges": value_ranges})
+
+    def send_page(self, params, items, key):
+        """
+        Send a page of a list of items, using the offset as the page token
+        """
+        start = int(self.get_param(params, "pageToken", 0))
+        page_size = int(self.get_param(params, "pageSize", 100))
+        result = {key: items[start:start + page_size]}
+        if start + page_size < len(items):
+            result["nextPageToken"] = str(start + page_size)
+        self.send_json(result)
+
+    def send_json(self, obj, status=200):
+        self.send_body(json.dumps(obj).encode("utf-8"), "application/json", status)
+
+    def send_error_json(self, status, reason, message):
+        self.send_json({"error": {
+            "code": status,
+            "message": message,
+            "errors": [{"domain": "usageLimits" if status in (403, 429) else "global",
+                        "reason": reason, "message": message}]
+        }}, status=status)
+
+    def send_body(self, body, content_type, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeGoogleApiServer(ThreadingMixIn, HTTPServer):
+    """
+    HTTP server for a `FakeDriveTree`, run in a background thread. Use as a
+    context manager, or call `start` and `stop`.
+    """
+    daemon_threads = True
+
+    def __init__(self, tree, latency=0, error_rate=0, quota=None, port=0,
+                 seed=0):
+        """
+        :param tree:       FakeDriveTree to serve
+        :param latency:    number of seconds to wait before responding to each
+                           API request
+        :param error_rate: probability of responding to an API request with a
+                           429 rate limit error
+        :param quota:      if given, a tuple (max requests, period in seconds);
+                           requests beyond this rate are rejected with 429
+                           errors, like Google's per-user quota
+        :param port:       port to listen on (default: any free port)
+        """
+        HTTPServer.__init__(self, ("127.0.0.1", port), FakeGoogleApiHandler)
+        self.tree = tree
+        self.latency = latency
+        self.error_rate = error_rate
+        self.quota = quota
+        self.url = "http://127.0.0.1:{}".format(self.server_address[1])
+
+        self.lock = threading.Lock()
+        self.random = random.Random(seed)
+        self.recent_requests = deque()
+        self.request_counts = {}
+        self.error_count = 0
+        self.discovery_count = 0
+        self.thread = None
+
+    @property
+    def total_requests(self):
+        with self.lock:
+            return sum(self.request_counts.values())
+
+    def before_request(self, name):
+        """
+        Count an API request, and decide whether it should fail
+        :return: None, or a tuple of arguments for `send_error_json`
+        """
+        if self.latency:
+            time.sleep(self.latency)
+
+        with self.lock:
+            self.request_counts[name] = self.request_counts.get(name, 0) + 1
+
+            now = time.time()
+            if self.quota:
+                max_requests, period = self.quota
+                while self.recent_requests and self.recent_requests[0] <= now - period:
+                    self.recent_requests.popleft()
+                if len(self.recent_requests) >= max_requests:
+                    self.error_count += 1
+                    return (429, "rateLimitExceeded", "Quota exceeded")
+                self.recent_requests.append(now)
+
+            if self.error_rate and self.random.random() < self.error_rate:
+                self.error_count += 1
+                return (429, "rateLimitExceeded", "Rate limit exceeded")
+        return None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
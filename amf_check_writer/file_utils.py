@@ -0,0 +1,191 @@
+"""
+Helpers for writing output and cache files
+"""
+import os
+import errno
+import hashlib
+import binascii
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+# Flags to create temporary files with. The file is created with mode 0o666,
+# so that the process umask applies as it does to a normally created file
+_TMP_FLAGS = os.O_CREAT | os.O_EXCL | os.O_WRONLY | getattr(os, "O_BINARY", 0)
+
+
+def _create_temp_file(dirname, basename):
+    """
+    Create a new hidden file next to `basename` in `dirname`
+    :return: tuple (file descriptor, path)
+    """
+    while True:
+        suffix = binascii.hexlify(os.urandom(6)).decode("ascii")
+        tmp_path = os.path.join(dirname, ".{}.{}.tmp".format(basename, suffix))
+        try:
+            return os.open(tmp_path, _TMP_FLAGS, 0o666), tmp_path
+        except OSError as ex:
+            if ex.errno != errno.EEXIST:
+                raise
+
+
+@contextmanager
+def atomic_write(path, mode="w"):
+    """
+    Context manager to write a file atomically: the contents are written to a
+    temporary file in the same directory, which is renamed to `path` only if
+    the block completes without an exception. Readers (and later runs) never
+    see a partially written file.
+
+    :param path: path of the file to write
+    :param mode: mode to open the temporary file with ('w' or 'wb')
+    :return:     the open temporary file
+    """
+    dirname, basename = os.path.split(os.path.abspath(path))
+    fd, tmp_path = _create_temp_file(dirname, basename)
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.rename(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def file_hash(path):
+    """
+    Return the SHA-1 hex digest of the contents of a file
+    """
+    sha = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(65536), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def user_cache_dir(name):
+    """
+    Return the directory to store cached data of the given kind in, following
+    the XDG base directory specification
+    :param name: name of the sub-directory, e.g. 'discovery'
+    """
+    cache_home = (os.environ.get("XDG_CACHE_HOME")
+                  or os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(cache_home, "amf-check-writer", name)
+
+
+def write_if_changed(path, content):
+    """
+    Write `content` to a file atomically, unless the file already exists with
+    the same contents
+    :param path:    path of the file to write
+    :param content: string to write
+    :return:        True if the file was written, False if it was unchanged
+    """
+    if not isinstance(content, bytes):
+        content = content.encode("utf-8")
+    try:
+        if os.path.getsize(path) == len(content):
+            with open(path, "rb") as f:
+                existing_hash = hashlib.sha1(f.read()).hexdigest()
+            if existing_hash == hashlib.sha1(content).hexdigest():
+                return False
+    except (IOError, OSError):
+        pass
+
+    with atomic_write(path, "wb") as f:
+        f.write(content)
+    return True
+
+
+class OutputWriter(object):
+    """
+    Write and remove output files using a pool of I/O threads, counting the
+    number of files written, unchanged and removed. Files whose contents have
+    not changed are not rewritten (see `write_if_changed`).
+
+    Use as a context manager: all writes have finished when the block exits.
+    """
+    def __init__(self, threads=4, max_pending=None):
+        """
+        :param threads:     number of I/O threads
+        :param max_pending: maximum number of writes to queue before waiting
+                            for earlier ones to finish (default: 4 per thread)
+        """
+        # Imported here since multiprocessing is slow to import, and not
+        # needed by scripts that only use the other helpers
+        from multiprocessing.pool import ThreadPool
+        self.pool = ThreadPool(threads)
+        self.max_pending = max_pending or 4 * threads
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.written = 0
+        self.unchanged = 0
+        self.removed = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.wait()
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stop the I/O threads. Writes that have not finished are abandoned
+        """
+        self.pool.terminate()
+        self.pool.join()
+
+    def _write(self, path, content):
+        written = write_if_changed(path, content)
+        with self.lock:
+            if written:
+                self.written += 1
+            else:
+                self.unchanged += 1
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            if os.path.exists(path):
+                raise
+            return
+        with self.lock:
+            self.removed += 1
+
+    def _submit(self, func, *args):
+        while len(self.pending) >= self.max_pending:
+            self.pending.popleft().get()
+        self.pending.append(self.pool.apply_async(func, args))
+
+    def write(self, path, content):
+        """
+        Queue a file to be written
+        """
+        self._submit(self._write, path, content)
+
+    def remove(self, path):
+        """
+        Queue a file to be removed, if it exists
+        """
+        self._submit(self._remove, path)
+
+    def wait(self):
+        """
+        Wait for all queued writes and removals to finish, raising any
+        exception that occurred
+        """
+        while self.pending:
+            self.pending.popleft().get()
+
+    def get_summary(self):
+        return "{} files written, {} unchanged, {} removed".format(
+            self.written, self.unchanged, self.removed
+        )
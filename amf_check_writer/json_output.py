@@ -0,0 +1,73 @@
+"""
+Serialisation of CVs to JSON, in one of several output formats
+"""
+import json
+
+
+# Output formats:
+#   pretty:  indented with 4 spaces, keys in the order of the CV. This is the
+#            original format, and is byte-for-byte stable
+#   compact: no whitespace and sorted keys
+JSON_FORMATS = ("pretty", "compact")
+
+# Serialisers for the compact format. 'orjson' is much faster, but only
+# available if the orjson package is installed. Its output is equivalent but
+# may not be identical to that of 'json': non-ASCII characters are not
+# escaped, floats in exponent form are written without a '+' or leading
+# zeros, and NaN and infinity are written as null
+JSON_BACKENDS = ("json", "orjson")
+
+# The orjson module, imported when first needed: None if it has not been
+# imported yet, or False if it is not installed
+_orjson = None
+
+
+def _get_orjson():
+    global _orjson
+    if _orjson is None:
+        try:
+            import orjson
+        except ImportError:
+            orjson = False
+        _orjson = orjson
+    return _orjson
+
+
+def is_backend_available(backend):
+    """
+    Return True if a JSON backend is recognised and can be used
+    """
+    if backend == "orjson":
+        return bool(_get_orjson())
+    return backend in JSON_BACKENDS
+
+
+def get_available_backends():
+    """
+    Return the list of JSON backends that can be used
+    """
+    return [backend for backend in JSON_BACKENDS if is_backend_available(backend)]
+
+
+def dump_json(data, fmt="pretty", backend="json"):
+    """
+    Return `data` as a JSON string
+    :param data:    object to serialise
+    :param fmt:     output format: one of JSON_FORMATS
+    :param backend: serialiser to use for the compact format: one of
+                    JSON_BACKENDS. The pretty format always uses the json
+                    module
+    :raises ValueError: if the format or backend is not recognised or not
+                        available
+    """
+    if fmt not in JSON_FORMATS:
+        raise ValueError("Unrecognised JSON format '{}'".format(fmt))
+    if not is_backend_available(backend):
+        raise ValueError("JSON backend '{}' is not available".format(backend))
+
+    if fmt == "pretty":
+        return json.dumps(data, indent=4)
+    if backend == "orjson":
+        orjson = _get_orjson()
+        return orjson.dumps(data, option=orjson.OPT_SORT_KEYS).decode("utf-8")
+    return json.dumps(data, sort_keys=True, separators=(",", ":"))
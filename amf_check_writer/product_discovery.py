@@ -0,0 +1,231 @@
+"""
+Find the per-product variable and dimension sheets in the product definition
+spreadsheets directory. Each product has the layout
+'<name>/<name>.xlsx/{Variables,Dimensions} - Specific.tsv', at any depth in
+the directory tree
+"""
+from __future__ import print_function
+import os
+import re
+import sys
+import json
+import time
+import codecs
+from collections import namedtuple
+
+try:
+    from os import scandir
+except ImportError:
+    from scandir import scandir
+
+from amf_check_writer.file_utils import atomic_write
+
+
+# Version of the format of the index file
+INDEX_FORMAT = 2
+
+# Directories modified less than this many seconds before the index was
+# written may have been modified again without changing their mtime, so the
+# index is not used
+RACY_INTERVAL = 2
+
+# Maximum number of ignored paths to list in the warning summary
+MAX_IGNORED_TO_LIST = 5
+
+PRODUCT_NAME_REGEX = re.compile(r"^[a-zA-Z0-9-]+$")
+SHEET_REGEX = re.compile(r"^(?P<type>Variables|Dimensions) - Specific\.tsv$")
+
+
+# Encoding of the paths stored as text in the index. An ASCII filesystem
+# encoding (the C locale) is treated as UTF-8, as Python 3 does
+FS_ENCODING = sys.getfilesystemencoding() or "utf-8"
+if codecs.lookup(FS_ENCODING).name == "ascii":
+    FS_ENCODING = "utf-8"
+
+
+ProductSheet = namedtuple("ProductSheet", ["name", "type", "path"])
+"""
+Tuple describing a variables or dimensions sheet for a product
+:param name: name of the product
+:param type: 'Variables' or 'Dimensions'
+:param path: path to the TSV file, relative to the products directory
+"""
+
+
+class ProductDiscoverer(object):
+    """
+    Find product sheets by listing the products directory recursively with
+    scandir. Files that are not in the expected layout are recorded in
+    `ignored` so that a single warning can be printed.
+
+    If `index_path` is given, the results are written to an index file along
+    with the modification time of each directory listed. Later runs use the
+    index instead of listing the directories if none of the mtimes have
+    changed.
+    """
+    def __init__(self, prods_dir, index_path=None):
+        """
+        :param prods_dir:  products directory
+        :param index_path: path of the index file (default: do not use an
+                           index)
+        """
+        self.prods_dir = prods_dir
+        self.index_path = index_path
+        # Paths relative to `prods_dir` that did not match the expected layout
+        self.ignored = []
+        # True if the last call to `discover` used the index
+        self.used_index = False
+
+    def discover(self):
+        """
+        Return a list of ProductSheet tuples, sorted by product name and type
+        """
+        index = self.load_index() if self.index_path else None
+        self.used_index = index is not None
+        if index is not None:
+            self.ignored = index["ignored"]
+            return index["sheets"]
+
+        indexed_at = time.time()
+        sheets, self.ignored, dir_mtimes = self.scan()
+        if self.index_path:
+            self.save_index(sheets, dir_mtimes, indexed_at)
+        return sheets
+
+    def scan(self):
+        """
+        List the products directory and its sub-directories
+        :return: tuple (list of ProductSheet tuples, list of ignored paths,
+                 dict mapping directory paths relative to the products
+                 directory to their mtimes)
+        """
+        sheets = []
+        ignored = []
+        dir_mtimes = {}
+        try:
+            dir_mtimes["."] = os.stat(self.prods_dir).st_mtime
+        except OSError:
+            return sheets, ignored, dir_mtimes
+
+        self._scan_dir(self.prods_dir, "", sheets, ignored, dir_mtimes)
+        sheets.sort(key=lambda sheet: (sheet.name, sheet.type, sheet.path))
+        return sheets, ignored, dir_mtimes
+
+    def _scan_dir(self, path, rel_path, sheets, ignored, dir_mtimes):
+        """
+        Find product sheets in a directory, descending into sub-directories
+        other than spreadsheet directories
+        :param path:     path to the directory
+        :param rel_path: path relative to the products directory ('' for the
+                         products directory itself)
+        """
+        parent_name = os.path.basename(rel_path)
+        for entry in sorted(scandir(path), key=lambda e: e.name):
+            entry_rel_path = os.path.join(rel_path, entry.name)
+            if (entry.name == "{}.xlsx".format(parent_name) and entry.is_dir()
+                    and PRODUCT_NAME_REGEX.match(parent_name)):
+                dir_mtimes[entry_rel_path] = entry.stat().st_mtime
+                self._scan_spreadsheet_dir(entry.path, entry_rel_path,
+                                           parent_name, sheets, ignored)
+            elif entry.is_dir(follow_symlinks=False):
+                dir_mtimes[entry_rel_path] = entry.stat().st_mtime
+                self._scan_dir(entry.path, entry_rel_path, sheets, ignored,
+                               dir_mtimes)
+            else:
+                ignored.append(entry_rel_path)
+
+    def _scan_spreadsheet_dir(self, path, rel_path, name, sheets, ignored):
+        """
+        Find the sheets in the '<name>.xlsx' directory of a product
+        """
+        for entry in sorted(scandir(path), key=lambda e: e.name):
+            sheet_path = os.path.join(rel_path, entry.name)
+            match = SHEET_REGEX.match(entry.name)
+            if not match or not entry.is_file():
+                ignored.append(sheet_path)
+                continue
+            sheets.append(ProductSheet(name, match.group("type"), sheet_path))
+
+    def load_index(self):
+        """
+        Return the index if it exists and no directory has been modified since
+        it was written, or None otherwise
+        """
+        try:
+            with open(self.index_path) as f:
+                index = json.load(f)
+            if index.get("format") != INDEX_FORMAT:
+                return None
+            # Paths are returned as the same type of string as when scanning
+            index = {
+                "prods_dir": _from_text(index["prods_dir"]),
+                "indexed_at": index["indexed_at"],
+                "dirs": dict((_from_text(path), mtime)
+                             for path, mtime in index["dirs"].items()),
+                "sheets": [ProductSheet(*map(_from_text, sheet))
+                           for sheet in index["sheets"]],
+                "ignored": [_from_text(path) for path in index["ignored"]]
+            }
+        except (IOError, OSError, ValueError, KeyError, TypeError):
+            return None
+        if index["prods_dir"] != os.path.abspath(self.prods_dir):
+            return None
+
+        for rel_path, mtime in index["dirs"].items():
+            try:
+                current = os.stat(os.path.join(self.prods_dir, rel_path)).st_mtime
+            except OSError:
+                return None
+            if current != mtime or mtime >= index["indexed_at"] - RACY_INTERVAL:
+                return None
+        return index
+
+    def save_index(self, sheets, dir_mtimes, indexed_at):
+        """
+        Write the index file. Failure to write is not fatal
+        """
+        try:
+            index = {
+                "format": INDEX_FORMAT,
+                "prods_dir": _to_text(os.path.abspath(self.prods_dir)),
+                "indexed_at": indexed_at,
+                "dirs": dict((_to_text(path), mtime)
+                             for path, mtime in dir_mtimes.items()),
+                "sheets": [[_to_text(value) for value in sheet] for sheet in sheets],
+                "ignored": [_to_text(path) for path in self.ignored]
+            }
+            with atomic_write(self.index_path) as f:
+                json.dump(index, f, indent=4, sort_keys=True)
+        except (IOError, OSError, UnicodeError) as ex:
+            print("WARNING: Could not write product index '{}': {}"
+                  .format(self.index_path, ex), file=sys.stderr)
+
+    def print_summary(self):
+        """
+        Print a single warning listing (some of) the ignored paths
+        """
+        if not self.ignored:
+            return
+        examples = ", ".join("'{}'".format(path)
+                             for path in self.ignored[:MAX_IGNORED_TO_LIST])
+        if len(self.ignored) > MAX_IGNORED_TO_LIST:
+            examples += ", ..."
+        print("WARNING: Ignored {} unexpected files/directories in '{}': {}"
+              .format(len(self.ignored), self.prods_dir, examples),
+              file=sys.stderr)
+
+
+def _to_text(path):
+    """
+    Return a path as a text string to store in the index. Paths are byte
+    strings in Python 2
+    """
+    return path.decode(FS_ENCODING) if isinstance(path, bytes) else path
+
+
+def _from_text(path):
+    """
+    Return a path loaded from the index as the native string type, which is
+    what scandir returns for the products directory
+    """
+    return path if isinstance(path, str) else path.encode(FS_ENCODING)
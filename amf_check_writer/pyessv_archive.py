@@ -0,0 +1,215 @@
+"""
+Minimal implementation of the parts of pyessv used by PyessvWriter: creating
+authority, scope, collection and term nodes, and encoding them as the JSON
+files pyessv writes to its archive directory.
+
+Importing pyessv loads every vocabulary already in the archive, which gets
+slower as the archive grows. This module can be used in its place to write
+the archive without importing pyessv. The files written are identical to
+those written by pyessv 0.4.5.0.
+"""
+import os
+import re
+import uuid
+from datetime import datetime
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+try:
+    string_types = basestring
+except NameError:
+    string_types = str
+
+# pyessv uses simplejson if it is installed; in Python 2 its indented output
+# differs from that of json
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+DIR_ARCHIVE = os.getenv("PYESSV_ARCHIVE_HOME",
+                        os.path.expanduser("~/.esdoc/pyessv-archive"))
+
+REGEX_CANONICAL_NAME = r"^[a-z0-9\-]*$"
+
+GOVERNANCE_STATUS_PENDING = "pending"
+GOVERNANCE_STATUS_SET = ("pending", "accepted", "rejected", "obsolete")
+
+
+class ValidationError(ValueError):
+    """
+    A node has validation errors, e.g. a term's name does not match its
+    collection's term regex
+    """
+
+
+class Node(object):
+    """
+    An authority, scope, collection or term
+    """
+    def __init__(self, typekey, parent, name, description=None, label=None,
+                 url=None, create_date=None, data=None):
+        """
+        :param typekey:     'authority', 'scope', 'collection' or 'term'
+        :param parent:      parent node, or None for an authority
+        :param name:        name of the node
+        :param description: description of the node
+        :param label:       label of the node (default: `name`)
+        :param url:         URL for further information
+        :param create_date: creation date (default: that of the parent)
+        :param data:        dict of arbitrary data
+        """
+        self.typekey = typekey
+        self.parent = parent
+        self.raw_name = name.strip()
+        self.canonical_name = format_canonical_name(name)
+        self.label = label or self.raw_name
+        self.description = description.strip() if description else None
+        self.url = url.strip() if url else None
+        self.create_date = create_date or parent.create_date
+        self.data = data
+        self.uid = uuid.uuid4()
+        self.status = GOVERNANCE_STATUS_PENDING
+        self.term_regex = None
+        self.children = []
+
+        if parent is not None:
+            parent.children.append(self)
+
+    def __iter__(self):
+        # pyessv iterates over child nodes in order of canonical name
+        return iter(sorted(self.children, key=lambda node: node.canonical_name))
+
+    @property
+    def namespace(self):
+        if self.parent is None:
+            return self.canonical_name
+        return "{}:{}".format(self.parent.namespace, self.canonical_name)
+
+    @property
+    def io_name(self):
+        return format_canonical_name(self.canonical_name)
+
+
+def format_canonical_name(name):
+    return name.strip().replace("_", "-").replace(" ", "-").lower()
+
+
+def create_authority(name, description, label=None, url=None, create_date=None):
+    return Node("authority", None, name, description=description, label=label,
+                url=url, create_date=create_date)
+
+
+def create_scope(authority, name, description, label=None, url=None,
+                 create_date=None):
+    return Node("scope", authority, name, description=description, label=label,
+                url=url, create_date=create_date)
+
+
+def create_collection(scope, name, description, label=None, url=None,
+                      create_date=None, term_regex=None):
+    collection = Node("collection", scope, name, description=description,
+                      label=label, url=url, create_date=create_date)
+    collection.term_regex = term_regex or REGEX_CANONICAL_NAME
+    return collection
+
+
+def create_term(collection, name, description=None, label=None, url=None,
+                create_date=None, data=None):
+    """
+    :raises ValidationError: if the canonical name of the term does not match
+                             the collection's term regex
+    """
+    canonical_name = format_canonical_name(name)
+    if not re.match(collection.term_regex, canonical_name):
+        raise ValidationError("Term: invalid canonical_name: [{}]"
+                              .format(canonical_name))
+    return Node("term", collection, name, description=description, label=label,
+                url=url, create_date=create_date, data=data)
+
+
+def get_errors(node):
+    """
+    Return a sorted list of the validation errors for a single node, in the
+    same format as pyessv's. Child nodes are not validated
+    """
+    def is_string(val):
+        return isinstance(val, string_types) and bool(val.strip())
+
+    def is_url(val):
+        url = urlparse(val) if is_string(val) else None
+        return bool(url and url.netloc and url.scheme)
+
+    if node.typekey == "term":
+        name_regex = node.parent.term_regex
+        # Only authorities, scopes and collections require a description
+        description_valid = node.description is None or is_string(node.description)
+    else:
+        name_regex = REGEX_CANONICAL_NAME
+        description_valid = is_string(node.description)
+
+    checks = [
+        ("canonical_name", is_string(node.canonical_name)
+                           and re.match(name_regex, node.canonical_name)),
+        ("create_date", isinstance(node.create_date, datetime)),
+        ("data", node.data is None or isinstance(node.data, dict)),
+        ("description", description_valid),
+        ("label", node.label is None or is_string(node.label)),
+        ("uid", isinstance(node.uid, uuid.UUID)),
+        ("url", node.url is None or is_url(node.url)),
+    ]
+    if node.typekey == "collection":
+        checks.append(("term_regex", is_string(node.term_regex)))
+    if node.typekey == "term":
+        checks.append(("status", node.status in GOVERNANCE_STATUS_SET))
+
+    return sorted("{}: invalid {}: [{}]".format(node.typekey.capitalize(), field,
+                                                getattr(node, field))
+                  for field, valid in checks if not valid)
+
+
+def is_valid(node):
+    """
+    Return True if a single node has no validation errors
+    """
+    return not get_errors(node)
+
+
+def encode(node):
+    """
+    Return a node encoded as JSON, as in the pyessv archive
+    """
+    return json.dumps(_encode_dict(node), indent=4, sort_keys=True)
+
+
+def _encode_dict(node):
+    obj = {
+        "_type": node.typekey,
+        "canonical_name": node.canonical_name,
+        "create_date": str(node.create_date),
+        "namespace": node.namespace,
+        "uid": str(node.uid)
+    }
+    if node.label and node.label != node.canonical_name:
+        obj["label"] = node.label
+    if node.raw_name and node.raw_name != node.canonical_name:
+        obj["raw_name"] = node.raw_name
+    for attr in ("data", "description", "url"):
+        if getattr(node, attr):
+            obj[attr] = getattr(node, attr)
+
+    if node.typekey == "authority":
+        obj["scopes"] = [_encode_dict(scope) for scope in node]
+    elif node.typekey == "scope":
+        obj["collections"] = [_encode_dict(collection) for collection in node]
+    elif node.typekey == "collection":
+        obj["terms"] = ["{}:{}".format(term.canonical_name, term.label)
+                        for term in node]
+        obj["term_regex"] = node.term_regex
+    else:
+        obj["status"] = node.status
+    return obj
@@ -1,27 +1,79 @@
 import os
+import json
+import uuid
 from datetime import datetime
 
+from amf_check_writer import pyessv_archive
+from amf_check_writer.file_utils import OutputWriter
+
+
+# Name of the file pyessv stores an authority's scopes and collections in
+MANIFEST_FILENAME = "MANIFEST"
+
+# Name of the file in the scope directory that lists the term files written
+# by PyessvWriter, so that only those are ever removed
+WRITTEN_FILES_FILENAME = ".amf-check-writer-files.json"
+
+# Ways of writing the archive:
+#   pyessv: create and encode nodes with the pyessv library
+#   direct: write the same files with `pyessv_archive`, without importing
+#           pyessv (which loads the whole existing archive)
+PYESSV_BACKENDS = ("pyessv", "direct")
+
 
 class PyessvWriter(object):
+    """
+    Write CVs to a pyessv archive. Each CV's collection is written as soon as
+    it is added, using a pool of I/O threads; `archive` writes the authority's
+    manifest once all CVs have been added.
+
+    In incremental mode the uids of existing nodes are reused, and only
+    collections whose term files differ from those in the archive are
+    rewritten.
+
+    The term files written are recorded in the scope directory. Files that
+    are no longer needed are only removed if they were written by a previous
+    run, so that other content in the archive is left alone.
+    """
+    def __init__(self, pyessv_root=None, incremental=False, backend="pyessv"):
+        """
+        :param pyessv_root: directory to use as pyessv archive (default:
+                            pyessv's default archive directory)
+        :param incremental: boolean indicating whether to rewrite only the
+                            collections that have changed
+        :param backend:     one of PYESSV_BACKENDS
+        :raises ValueError: if the backend is not recognised
+        """
+        if backend not in PYESSV_BACKENDS:
+            raise ValueError("Unrecognised pyessv backend '{}'".format(backend))
+
+        if backend == "direct":
+            self._pyessv = pyessv_archive
+        else:
+            if pyessv_root:
+                os.environ["PYESSV_ARCHIVE_HOME"] = pyessv_root
 
-    def __init__(self, pyessv_root=None):
-        if pyessv_root:
-            os.environ["PYESSV_ARCHIVE_HOME"] = pyessv_root
+            # Not normally good to import modules anywhere except top of the
+            # file, but pyessv loads archive directory from an environment
+            # variable when the module is imported. This means we cannot change
+            # the archive directory from the code unless it is imported
+            # afterwards...
+            #
+            # This also prevents cluttering output with pyessv's logs even when
+            # CVs are not being generated
+            import pyessv
+            self._pyessv = pyessv
 
-        # Not normally good to import modules anywhere except top of the file,
-        # but pyessv loads archive directory from an environment variable when
-        # the module is imported. This means we cannot change the archive
-        # directory from the code unless it is imported afterwards...
-        #
-        # This also prevents cluttering output with pyessv's logs even when CVs
-        # are not being generated
-        import pyessv
-        self._pyessv = pyessv
+        self.incremental = incremental
+        self.archive_dir = pyessv_root or self._pyessv.DIR_ARCHIVE
+        # Number of collections rewritten and left unchanged
+        self.collections_written = 0
+        self.collections_unchanged = 0
 
         self.create_date = datetime(year=2018, month=7, day=9, hour=13,
                                     minute=9)
 
-        self.authority = pyessv.create_authority(
+        self.authority = self._pyessv.create_authority(
             "NCAS",
             "NCAS Atmospheric Measurement Facility CVs",
             label="NCAS",
@@ -29,7 +81,7 @@ class PyessvWriter(object):
             create_date=self.create_date
         )
 
-        self.scope_amf = pyessv.create_scope(
+        self.scope_amf = self._pyessv.create_scope(
             self.authority,
             "AMF",
             "Controlled Vocabularies (CVs) for use in AMF",
@@ -41,29 +93,189 @@ class PyessvWriter(object):
         # Make sure to include '@' for email addresses
         self.term_regex = r"^[a-z0-9\-@\.]*$"
 
+        self.authority_dir = os.path.join(self.archive_dir, self.authority.io_name)
+        self.scope_dir = os.path.join(self.authority_dir, self.scope_amf.io_name)
+        # uids of the nodes in the existing archive, by namespace
+        self.old_uids = self._read_uids() if incremental else {}
+        for node in (self.authority, self.scope_amf):
+            self._reuse_uid(node)
+        # Names of the term files written by previous runs and this run, by
+        # collection
+        self.old_files = self._read_written_files()
+        self.files = {}
+
+        self.writer = OutputWriter()
+
     def write_cvs(self, cvs):
         print("Writing to pyessv archive...")
         for cv in cvs:
-            collection = self._pyessv.create_collection(
-                self.scope_amf,
-                cv.namespace,
-                "NCAS AMF CV collection: {}".format(cv.namespace),
-                create_date=self.create_date,
-                term_regex=self.term_regex
+            self.add_cv(cv)
+        self.archive()
+
+    def add_cv(self, cv):
+        """
+        Create a collection containing the terms in a CV, and queue its term
+        files to be written
+        """
+        collection = self._pyessv.create_collection(
+            self.scope_amf,
+            cv.namespace,
+            "NCAS AMF CV collection: {}".format(cv.namespace),
+            create_date=self.create_date,
+            term_regex=self.term_regex
+        )
+        self._reuse_uid(collection)
+
+        # Note: This relies on the namespace being a top level key in CV
+        # dictionary
+        inner_cv = cv.cv_dict[cv.namespace]
+        # If inner_cv is a dict then use keys for term names and values for
+        # 'data' attribute. Otherwise (e.g. inner_cv is a list), ommit data
+        # attribute
+        for name in inner_cv:
+            kwargs = {}
+            if isinstance(inner_cv, dict):
+                kwargs["data"] = inner_cv[name]
+
+            self._pyessv.create_term(collection, name=name, label=name,
+                                     create_date=self.create_date,
+                                     **kwargs)
+
+        self._write_collection(collection)
+
+    def archive(self):
+        """
+        Write the authority's manifest, in the same layout as
+        `pyessv.archive`, and remove the files written by previous runs for
+        collections that no longer exist. Wait for all files to be written
+        """
+        self._validate(self.authority)
+        removed_dirs = []
+        with self.writer:
+            for name, term_names in sorted(self.old_files.items()):
+                if name in self.files:
+                    continue
+                collection_dir = os.path.join(self.scope_dir, name)
+                for term_name in term_names:
+                    self.writer.remove(os.path.join(collection_dir, term_name))
+                removed_dirs.append(collection_dir)
+
+            if not os.path.isdir(self.scope_dir):
+                os.makedirs(self.scope_dir)
+            self.writer.write(os.path.join(self.authority_dir, MANIFEST_FILENAME),
+                              self._pyessv.encode(self.authority))
+            self.writer.write(os.path.join(self.scope_dir, WRITTEN_FILES_FILENAME),
+                              json.dumps({"collections": self.files}, indent=4,
+                                         sort_keys=True))
+
+        # Directories that still contain other files are kept
+        for path in removed_dirs:
+            try:
+                os.rmdir(path)
+            except OSError:
+                pass
+
+        print("{} of {} pyessv collections written to {}".format(
+            self.collections_written,
+            self.collections_written + self.collections_unchanged,
+            self.authority_dir
+        ))
+
+    def close(self):
+        """
+        Stop the I/O threads. Files that have not been written are abandoned
+        """
+        self.writer.close()
+
+    def _write_collection(self, collection):
+        """
+        Validate a collection and its terms, and queue the term files to be
+        written, unless they are all unchanged in incremental mode
+        :raises ValidationError: if the collection or a term is not valid
+        """
+        self._validate(collection)
+        for term in collection:
+            self._validate(term)
+
+        collection_dir = os.path.join(self.scope_dir, collection.io_name)
+        term_names = set(term.io_name for term in collection)
+        owned = set(self.old_files.get(collection.io_name, []))
+        existing = {}
+        for name in term_names | owned:
+            path = os.path.join(collection_dir, name)
+            if os.path.isfile(path):
+                existing[name] = None
+                if self.incremental:
+                    with open(path) as f:
+                        existing[name] = f.read()
+
+        contents = {}
+        for term in collection:
+            old_content = existing.get(term.io_name)
+            if old_content is not None:
+                term.uid = uuid.UUID(json.loads(old_content)["uid"])
+            contents[term.io_name] = self._pyessv.encode(term)
+        self.files[collection.io_name] = sorted(contents)
+
+        if self.incremental and contents == existing:
+            self.collections_unchanged += 1
+            return
+
+        if not os.path.isdir(collection_dir):
+            os.makedirs(collection_dir)
+        for name, content in contents.items():
+            self.writer.write(os.path.join(collection_dir, name), content)
+        for name in existing:
+            if name not in contents:
+                self.writer.remove(os.path.join(collection_dir, name))
+        self.collections_written += 1
+
+    def _validate(self, node):
+        """
+        Check a node is valid before it is written, as `pyessv.archive` does
+        :raises ValidationError: if the node has validation errors
+        """
+        errors = self._pyessv.get_errors(node)
+        if errors:
+            raise self._pyessv.ValidationError(
+                "Invalid pyessv node '{}': {}".format(node.namespace,
+                                                      "; ".join(errors))
             )
 
-            # Note: This relies on the namespace being a top level key in CV
-            # dictionary
-            inner_cv = cv.cv_dict[cv.namespace]
-            # If inner_cv is a dict then use keys for term names and values for
-            # 'data' attribute. Otherwise (e.g. inner_cv is a list), ommit data
-            # attribute
-            for name in inner_cv:
-                kwargs = {}
-                if isinstance(inner_cv, dict):
-                    kwargs["data"] = inner_cv[name]
-
-                self._pyessv.create_term(collection, name=name, label=name,
-                                         create_date=self.create_date,
-                                         **kwargs)
-            self._pyessv.archive(self.authority)
+    def _read_written_files(self):
+        """
+        Return a dict mapping the names of collections to the names of the
+        term files written to them by previous runs
+        """
+        try:
+            path = os.path.join(self.scope_dir, WRITTEN_FILES_FILENAME)
+            with open(path) as f:
+                return json.load(f)["collections"]
+        except (IOError, OSError, ValueError, KeyError):
+            return {}
+
+    def _read_uids(self):
+        """
+        Return a dict mapping the namespaces of the authority, scopes and
+        collections in the existing archive's manifest to their uids
+        """
+        try:
+            with open(os.path.join(self.authority_dir, MANIFEST_FILENAME)) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+        uids = {manifest["namespace"]: manifest["uid"]}
+        for scope in manifest.get("scopes", []):
+            uids[scope["namespace"]] = scope["uid"]
+            for collection in scope.get("collections", []):
+                uids[collection["namespace"]] = collection["uid"]
+        return uids
+
+    def _reuse_uid(self, node):
+        """
+        Set the uid of a node to that in the existing archive, if any, so that
+        the encoded node does not change when the CVs have not
+        """
+        if node.namespace in self.old_uids:
+            node.uid = uuid.UUID(self.old_uids[node.namespace])
@@ -0,0 +1,93 @@
+"""
+Thread-safe sliding window rate limiter, used to keep calls to Google's APIs
+within their quotas
+"""
+from __future__ import print_function
+import time
+import random
+import threading
+from collections import deque
+
+
+class RateLimiter(object):
+    """
+    Allow at most `max_requests` requests in any window of `period` seconds.
+
+    Each caller reserves the earliest time slot available when it calls
+    `acquire`, so callers in different threads are served in order and the
+    lock is never held while sleeping. Only the times of the last
+    `max_requests` slots are kept, so each call takes constant time.
+
+    When the API reports that a quota has been exceeded anyway, `backoff`
+    pauses all callers for an exponentially increasing, jittered delay.
+    """
+    def __init__(self, max_requests=100, period=120, leeway=0.5,
+                 base_delay=1, max_delay=64, max_retries=6,
+                 clock=time.time, sleep=time.sleep):
+        """
+        :param max_requests: number of requests allowed in each window
+        :param period:       length of the window in seconds
+        :param leeway:       extra time in seconds to wait when the window is
+                             full, to allow for clock differences
+        :param base_delay:   delay in seconds after the first quota error
+        :param max_delay:    maximum delay in seconds after a quota error
+        :param max_retries:  number of times a request should be retried after
+                             quota errors before giving up
+        :param clock:        function returning the current time in seconds
+        :param sleep:        function to sleep for a given number of seconds
+        """
+        self.max_requests = max_requests
+        self.period = period
+        self.leeway = leeway
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retries = max_retries
+        self.clock = clock
+        self.sleep = sleep
+
+        self.lock = threading.Lock()
+        # Times of the most recent slots handed out. Once full, the oldest
+        # entry is dropped automatically when a new one is appended
+        self.slots = deque(maxlen=max_requests)
+        # Time before which no requests may be made, after a quota error
+        self.paused_until = 0
+        # Total number of seconds callers have been made to wait
+        self.total_wait = 0.0
+
+    def acquire(self):
+        """
+        Block until a request can be made without exceeding the rate limit
+        :return: the number of seconds waited
+        """
+        with self.lock:
+            now = self.clock()
+            slot = max(now, self.paused_until)
+            if len(self.slots) == self.max_requests:
+                slot = max(slot, self.slots[0] + self.period + self.leeway)
+            self.slots.append(slot)
+
+            wait = slot - now
+            self.total_wait += wait
+
+        if wait >= 1:
+            print("Waiting {} seconds to avoid reaching rate limit...".format(int(wait)))
+        if wait > 0:
+            self.sleep(wait)
+        return wait
+
+    def backoff(self, attempt):
+        """
+        Pause all callers after a quota error. The delay doubles with each
+        attempt (up to `max_delay`) and is randomised so that retries from
+        different threads are spread out.
+
+        :param attempt: number of previous attempts at the failed request
+                        (starting from 0)
+        :return:        the delay in seconds
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        delay = delay / 2.0 + random.uniform(0, delay / 2.0)
+        with self.lock:
+            self.paused_until = max(self.paused_until, self.clock() + delay)
+        print("Rate limit exceeded; backing off for {:.1f} seconds...".format(delay))
+        return delay
@@ -1,29 +1,34 @@
 from __future__ import print_function
 import os
 import sys
-import re
-from collections import namedtuple
+from collections import namedtuple, OrderedDict, deque
 
-from enum import Enum
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
 
-from amf_check_writer.cvs import (BaseCV, VariablesCV, ProductsCV, PlatformsCV,
+try:
+    from itertools import izip
+except ImportError:
+    izip = zip
+
+from amf_check_writer.cvs import (VariablesCV, ProductsCV, PlatformsCV,
                                   InstrumentsCV, DimensionsCV, ScientistsCV)
 from amf_check_writer.yaml_check import (YamlCheck, WrapperYamlCheck,
                                          FileInfoCheck, FileStructureCheck,
                                          GlobalAttrCheck)
-from amf_check_writer.pyessv_writer import PyessvWriter
+from amf_check_writer.pyessv_writer import PyessvWriter, PYESSV_BACKENDS
+from amf_check_writer.base_file import AmfFile
+from amf_check_writer.deployment_modes import DeploymentModes
+from amf_check_writer.build_manifest import (BuildManifest, hash_inputs,
+                                             get_generator_version)
+from amf_check_writer.json_output import dump_json
+from amf_check_writer.file_utils import OutputWriter
+from amf_check_writer.product_discovery import ProductDiscoverer
 from amf_check_writer.exceptions import CVParseError, DimensionsSheetNoRowsError
 
 
-class DeploymentModes(Enum):
-    """
-    Enumeration of valid deployment modes
-    """
-    LAND = "Land"
-    SEA = "Sea"
-    AIR = "Air"
-
-
 SPREADSHEET_NAMES = {
     "products_dir": "Product Definition Spreadsheets",
     "common_spreadsheet": "Common.xlsx",
@@ -35,6 +40,9 @@ SPREADSHEET_NAMES = {
     "scientists_worksheet": "Creators.tsv"
 }
 
+# Name of the product discovery index file in the spreadsheets directory
+PRODUCT_INDEX_FILENAME = ".product-index.json"
+
 
 CVParseInfo = namedtuple("CVParseInfo", ["path", "cls", "facets"])
 """
@@ -44,6 +52,78 @@ Tuple containing information required to parse a TSV file
 :param facets: list of facets for CV namespace
 """
 
+BuildTarget = namedtuple("BuildTarget", ["name", "inputs", "cv_path", "make"])
+"""
+Tuple describing an output file of SpreadsheetHandler.build
+:param name:    output filename
+:param inputs:  list of full paths to files the output depends on
+:param cv_path: for outputs that are a CV, full path to the TSV file to parse
+                it from. The CV is written as soon as it is parsed
+:param make:    for other outputs, function that is passed a dict mapping
+                full paths of parsed TSV files to an AmfFile with the CV's
+                facets (or None if the CV could not be parsed), and returns the
+                AmfFile to write or None if there is no output
+"""
+
+OutputDir = namedtuple("OutputDir", ["path", "manifest", "targets", "callback",
+                                     "ext", "writer"])
+"""
+Tuple describing an output directory for SpreadsheetHandler.build
+:param path:     path to the directory
+:param manifest: BuildManifest for the directory
+:param targets:  list of BuildTarget objects for files in the directory
+:param callback: method to call on CVs and other AmfFile objects to get the
+                 contents of each file
+:param ext:      file extension to use
+:param writer:   OutputWriter to write files with
+"""
+
+# Number of threads to use for writing output files
+IO_THREADS = 4
+
+# Number of CVs per worker process that may be parsed ahead of those being
+# written
+MAX_PENDING_PER_JOB = 2
+
+
+def parse_cv(full_path, cls, facets):
+    """
+    Parse a single CV from a TSV file, printing a warning if the file does not
+    exist or cannot be parsed
+    :return: the CV object, or None
+    """
+    if not os.path.isfile(full_path):
+        print("WARNING: Expected to find file at '{}'".format(full_path),
+              file=sys.stderr)
+        return None
+
+    with open(full_path) as tsv_file:
+        try:
+            return cls(tsv_file, facets)
+        except DimensionsSheetNoRowsError as ex:
+            # Ignore if there is no data in the Dimensions worksheet
+            pass
+        except CVParseError as ex:
+            print("WARNING: Failed to parse '{}': {}"
+                  .format(full_path, ex), file=sys.stderr)
+    return None
+
+
+def _parse_cv_in_worker(parse_info):
+    """
+    Call `parse_cv` in a worker process, capturing anything written to stderr
+    so that the parent process can print warnings in order
+    :param parse_info: CVParseInfo with the full path to the TSV file
+    :return:           tuple (CV object or None, captured stderr)
+    """
+    stderr = sys.stderr
+    sys.stderr = StringIO()
+    try:
+        cv = parse_cv(*parse_info)
+        return cv, sys.stderr.getvalue()
+    finally:
+        sys.stderr = stderr
+
 
 class SpreadsheetHandler(object):
     """
@@ -58,8 +138,45 @@ class SpreadsheetHandler(object):
         "Dimensions": {"name": "dimension", "cls": DimensionsCV},
     }
 
-    def __init__(self, spreadsheets_dir):
+    def __init__(self, spreadsheets_dir, jobs=1, incremental=False, cache=None,
+                 discovery_index=False, json_format="pretty", json_backend="json",
+                 pyessv_backend="pyessv"):
+        """
+        :param spreadsheets_dir: directory containing spreadsheet data, as
+                                 produced by download-from-drive
+        :param jobs:             number of worker processes to use when
+                                 parsing TSV files
+        :param incremental:      if True, only regenerate output files whose
+                                 input TSV files have changed since the last
+                                 build (see `build`)
+        :param cache:            CVCache to load unchanged CVs from instead
+                                 of parsing the TSV files again (default: do
+                                 not cache CVs)
+        :param discovery_index:  if True, save the list of product sheets to an
+                                 index file in `spreadsheets_dir`, and reuse it
+                                 while the product directories are unchanged
+        :param json_format:      format of JSON CVs (see
+                                 `json_output.JSON_FORMATS`)
+        :param json_backend:     serialiser to use for compact JSON CVs (see
+                                 `json_output.JSON_BACKENDS`)
+        :param pyessv_backend:   how to write the pyessv archive (see
+                                 `pyessv_writer.PYESSV_BACKENDS`)
+        :raises ValueError:      if the JSON format or backend is not
+                                 recognised or not available, or the pyessv
+                                 backend is not recognised
+        """
         self.path = spreadsheets_dir
+        self.jobs = jobs
+        self.incremental = incremental
+        self.cache = cache
+        self.discovery_index = discovery_index
+        self.json_format = json_format
+        self.json_backend = json_backend
+        # Check the format and backend now, rather than when writing files
+        dump_json({}, fmt=json_format, backend=json_backend)
+        if pyessv_backend not in PYESSV_BACKENDS:
+            raise ValueError("Unrecognised pyessv backend '{}'".format(pyessv_backend))
+        self.pyessv_backend = pyessv_backend
 
     def write_cvs(self, output_dir, write_pyessv=False, pyessv_root=None):
         """
@@ -69,83 +186,309 @@ class SpreadsheetHandler(object):
                              archive
         :param pyessv_root:  directory to use as pyessv archive
         """
-        cvs = list(self.get_all_cvs())
-        self._write_output_files(cvs, BaseCV.to_json, output_dir, "json")
-        if write_pyessv:
-            writer = PyessvWriter(pyessv_root=pyessv_root)
-            writer.write_cvs(cvs)
+        self.build(cvs_dir=output_dir, write_pyessv=write_pyessv,
+                   pyessv_root=pyessv_root)
 
     def write_yaml(self, output_dir):
         """
         Write YAML checks for each appropriate CV
         :param output_dir: directory in which to write output YAML files
         """
-        # Find CVs that are also YAML checks
-        cvs = list(self.get_all_cvs(base_class=YamlCheck))
-        all_checks = []
-        all_checks += cvs
+        self.build(yaml_dir=output_dir)
 
-        # Add global checks
-        global_checks = [
-            FileInfoCheck(["file_info"]),
-            FileStructureCheck(["file_structure"]),
+    def write_all(self, cvs_dir, yaml_dir, write_pyessv=True, pyessv_root=None):
+        """
+        Parse every spreadsheet once, and write the JSON CVs, pyessv CVs and
+        YAML checks from the results. This is equivalent to calling
+        `write_cvs` and `write_yaml`, but each TSV file is only read once
+        :param cvs_dir:      directory in which to write output JSON files
+        :param yaml_dir:     directory in which to write output YAML files
+        :param write_pyessv: boolean indicating whether to write CVs to pyessv
+                             archive
+        :param pyessv_root:  directory to use as pyessv archive
+        """
+        self.build(cvs_dir=cvs_dir, yaml_dir=yaml_dir,
+                   write_pyessv=write_pyessv, pyessv_root=pyessv_root)
+
+    def build(self, cvs_dir=None, yaml_dir=None, write_pyessv=False,
+              pyessv_root=None):
+        """
+        Write JSON CVs to `cvs_dir` and/or YAML checks to `yaml_dir`, parsing
+        each TSV file at most once. Files are written atomically by a pool of
+        I/O threads, and only if their contents have changed. Files written
+        by a previous build that are no longer generated (e.g. for products
+        that have been removed) are deleted.
+
+        Each CV is written as soon as it is parsed, and only its facets are
+        kept afterwards, so memory use does not grow with the number of CVs
+        (apart from CVs written to the pyessv archive, which pyessv keeps in
+        memory). Wrapper checks are written last, from the facets of the CVs.
+
+        A build manifest is recorded in each output directory, mapping each
+        output file to the hashes of the TSV files it was generated from (see
+        `BuildManifest`). If `self.incremental` is set, outputs whose inputs
+        are unchanged since the last build by the same version of this code
+        are not regenerated, and only the TSV files needed for the remaining
+        outputs are parsed.
+
+        :param cvs_dir:      directory in which to write output JSON files
+        :param yaml_dir:     directory in which to write output YAML files
+        :param write_pyessv: boolean indicating whether to write CVs to pyessv
+                             archive (requires `cvs_dir`)
+        :param pyessv_root:  directory to use as pyessv archive
+        """
+        parse_infos = self._get_cv_parse_infos()
+        input_hashes = {}
+
+        def get_inputs(paths):
+            rel_paths = [os.path.relpath(path, self.path) for path in paths]
+            missing = [path for path, rel_path in zip(paths, rel_paths)
+                       if rel_path not in input_hashes]
+            input_hashes.update(hash_inputs(missing, self.path))
+            return dict((rel_path, input_hashes[rel_path]) for rel_path in rel_paths)
+
+        outputs = []
+        if cvs_dir:
+            # Outputs in another JSON format are out of date, so the format is
+            # included in the version of the generator
+            generator_version = "{}/{}/{}".format(
+                get_generator_version(), self.json_format, self.json_backend
+            )
+            outputs.append(OutputDir(cvs_dir, BuildManifest(cvs_dir, generator_version),
+                                     self._get_json_targets(parse_infos),
+                                     self._cv_to_json, "json",
+                                     OutputWriter(IO_THREADS)))
+        if yaml_dir:
+            manifest = BuildManifest(yaml_dir)
+            outputs.append(OutputDir(yaml_dir, manifest,
+                                     self._get_yaml_targets(parse_infos, manifest),
+                                     YamlCheck.to_yaml_check, "yml",
+                                     OutputWriter(IO_THREADS)))
+        try:
+            self._build(outputs, parse_infos, get_inputs,
+                        bool(write_pyessv and cvs_dir), pyessv_root)
+        finally:
+            for output in outputs:
+                output.writer.close()
+
+    def _build(self, outputs, parse_infos, get_inputs, write_pyessv, pyessv_root):
+        """
+        Helper for `build` to write the outputs for each OutputDir
+        """
+        # Outputs written in the previous build, which are removed if they are
+        # no longer written
+        previous_outputs = [
+            [name for name in output.manifest.targets
+             if output.manifest.was_written(name)]
+            for output in outputs
         ]
+
+        # Find out of date targets, and the TSV files required to build them
+        stale_targets = []
+        required = set()
+        for output in outputs:
+            stale = [t for t in output.targets if not self.incremental
+                     or not output.manifest.is_up_to_date(t.name, get_inputs(t.inputs))]
+            required.update(t.cv_path for t in stale if t.cv_path)
+            stale_targets.append(stale)
+
+        # The pyessv archive is built from every CV, and written once all have
+        # been parsed. It is not an output file in the CVs directory, so is
+        # never recorded as written
+        pyessv_writer = None
+        all_paths = [info.path for info in parse_infos]
+        if write_pyessv:
+            cvs_manifest = outputs[0].manifest
+            if not self.incremental or not cvs_manifest.is_up_to_date("pyessv", get_inputs(all_paths)):
+                pyessv_writer = PyessvWriter(pyessv_root=pyessv_root,
+                                             incremental=self.incremental,
+                                             backend=self.pyessv_backend)
+                required.update(all_paths)
+                print("Writing to pyessv archive...")
+
+        # Map paths of TSV files to the outputs and stale targets that write
+        # the CV parsed from it
+        cv_targets = {}
+        for output, stale in zip(outputs, stale_targets):
+            for target in stale:
+                if target.cv_path:
+                    cv_targets.setdefault(target.cv_path, []).append((output, target))
+
+        cv_facets = {}
+        to_parse = [info for info in parse_infos if info.path in required]
+        try:
+            for info, cv in izip(to_parse, self._parse_cvs(to_parse)):
+                for output, target in cv_targets.get(info.path, []):
+                    if cv is not None:
+                        self._write_output_file(output.writer, cv, output.callback,
+                                                output.path, output.ext)
+                    output.manifest.record(target.name, get_inputs(target.inputs),
+                                           cv is not None)
+                if cv is not None and pyessv_writer:
+                    pyessv_writer.add_cv(cv)
+                cv_facets[info.path] = AmfFile(cv.facets) if cv is not None else None
+
+            if pyessv_writer:
+                pyessv_writer.archive()
+                cvs_manifest.record("pyessv", get_inputs(all_paths), False)
+        finally:
+            if pyessv_writer:
+                pyessv_writer.close()
+
+        for output, stale, previous in zip(outputs, stale_targets, previous_outputs):
+            for target in stale:
+                if target.cv_path:
+                    continue
+                out_file = target.make(cv_facets)
+                if out_file is not None:
+                    self._write_output_file(output.writer, out_file, output.callback,
+                                            output.path, output.ext)
+                output.manifest.record(target.name, get_inputs(target.inputs),
+                                       out_file is not None)
+
+            names = [t.name for t in output.targets]
+            if write_pyessv and output is outputs[0]:
+                names.append("pyessv")
+            output.manifest.retain(names)
+            for name in previous:
+                if not output.manifest.was_written(name):
+                    output.writer.remove(os.path.join(output.path, name))
+            output.writer.wait()
+            output.manifest.save()
+
+            if self.incremental:
+                print("{} of {} outputs in {} are up to date"
+                      .format(len(output.targets) - len(stale),
+                              len(output.targets), output.path))
+            print(output.writer.get_summary())
+
+    def _cv_to_json(self, cv):
+        return cv.to_json(fmt=self.json_format, backend=self.json_backend)
+
+    def _get_json_targets(self, parse_infos):
+        """
+        Return a list of BuildTarget objects for JSON CVs
+        """
+        return [
+            BuildTarget(
+                name=AmfFile(info.facets).get_filename("json"),
+                inputs=[info.path],
+                cv_path=info.path,
+                make=None
+            )
+            for info in parse_infos
+        ]
+
+    def _get_yaml_targets(self, parse_infos, manifest):
+        """
+        Return a list of BuildTarget objects for YAML checks: the CVs that are
+        also YAML checks, global checks, and a wrapper check for each product
+        and deployment mode
+        :param parse_infos: list of CVParseInfo objects for all CVs
+        :param manifest:    BuildManifest for the YAML output directory, used
+                            to find which CVs exist without parsing them
+        """
+        yaml_infos = [info for info in parse_infos
+                      if YamlCheck in info.cls.__bases__]
+
+        def get_cv(info, cv_facets):
+            """
+            Return an AmfFile for a CV if it was parsed in this build or was
+            written in a previous build, or None if the CV does not exist
+            """
+            if info.path in cv_facets:
+                return cv_facets[info.path]
+            if manifest.was_written(AmfFile(info.facets).get_filename("yml")):
+                return AmfFile(info.facets)
+            return None
+
+        targets = [
+            BuildTarget(
+                name=AmfFile(info.facets).get_filename("yml"),
+                inputs=[info.path],
+                cv_path=info.path,
+                make=None
+            )
+            for info in yaml_infos
+        ]
+
+        # Add global checks
         global_attrs_path = os.path.join(
             self.path, SPREADSHEET_NAMES["common_spreadsheet"],
             SPREADSHEET_NAMES["global_attrs_worksheet"]
         )
-        if self._isfile(global_attrs_path):
+
+        def make_global_attrs_check(cv_facets):
+            if not self._isfile(global_attrs_path):
+                return None
             with open(global_attrs_path) as tsv_file:
-                global_checks.append(GlobalAttrCheck(tsv_file, ["global_attrs"]))
-        all_checks += global_checks
+                return GlobalAttrCheck(tsv_file, ["global_attrs"])
+
+        targets += [
+            BuildTarget("AMF_file_info.yml", [], None,
+                        lambda cv_facets: FileInfoCheck(["file_info"])),
+            BuildTarget("AMF_file_structure.yml", [], None,
+                        lambda cv_facets: FileStructureCheck(["file_structure"])),
+            BuildTarget("AMF_global_attrs.yml", [global_attrs_path], None,
+                        make_global_attrs_check)
+        ]
 
         # Group product CVs by name, and common product CVs by deployment mode
-        product_cvs = {}
-        common_cvs = {}
-        for cv in cvs:
-            if len(cv.facets) > 2 and cv.facets[0] == "product":
-                prod_name = cv.facets[1]
+        product_infos = OrderedDict()
+        common_infos = {}
+        for info in yaml_infos:
+            if len(info.facets) > 2 and info.facets[0] == "product":
+                prod_name = info.facets[1]
                 if prod_name == "common":
-                    dep_m = cv.facets[-1]
-                    if dep_m not in common_cvs:
-                        common_cvs[dep_m] = []
-                    common_cvs[dep_m].append(cv)
+                    common_infos.setdefault(info.facets[-1], []).append(info)
                 else:
-                    if prod_name not in product_cvs:
-                        product_cvs[prod_name] = []
-                    product_cvs[prod_name].append(cv)
+                    product_infos.setdefault(prod_name, []).append(info)
 
         # Create a top-level YAML check for each product/deployment-mode
-        # combination
-        for prod_name, prod_cvs in product_cvs.items():
+        # combination. These only include other files, so only need the
+        # facets of each CV
+        def make_wrapper(facets, prod_infos, mode_infos):
+            def make(cv_facets):
+                prod_cvs = [get_cv(info, cv_facets) for info in prod_infos]
+                prod_cvs = [cv for cv in prod_cvs if cv is not None]
+                if not prod_cvs:
+                    return None
+                global_checks = [AmfFile(["file_info"]), AmfFile(["file_structure"])]
+                if os.path.isfile(global_attrs_path):
+                    global_checks.append(AmfFile(["global_attrs"]))
+                mode_cvs = [get_cv(info, cv_facets) for info in mode_infos]
+                child_checks = (global_checks + prod_cvs
+                                + [cv for cv in mode_cvs if cv is not None])
+                return WrapperYamlCheck(child_checks, facets)
+            return make
+
+        for prod_name, prod_infos in product_infos.items():
             for mode in DeploymentModes:
                 dep_m = mode.value.lower()
                 facets = ["product", prod_name, dep_m]
-                child_checks = global_checks + prod_cvs + common_cvs.get(dep_m, [])
-                all_checks.append(WrapperYamlCheck(child_checks, facets))
-
-        self._write_output_files(all_checks, YamlCheck.to_yaml_check,
-                                 output_dir, "yml")
+                mode_infos = common_infos.get(dep_m, [])
+                deps = prod_infos + mode_infos
+                targets.append(BuildTarget(
+                    name=AmfFile(facets).get_filename("yml"),
+                    inputs=[info.path for info in deps] + [global_attrs_path],
+                    cv_path=None,
+                    make=make_wrapper(facets, prod_infos, mode_infos)
+                ))
+        return targets
 
-    def _write_output_files(self, files, callback, output_dir, ext):
+    def _write_output_file(self, writer, f, callback, output_dir, ext):
         """
-        Helper method to call a method on a several AmfFile objects and write
-        the output to a file
-        :param files:      iterable of AmfFile objects
-        :param callback:   method to call for each object. It is passed the
+        Helper method to call a method on an AmfFile object and write the
+        output to a file, if it has changed
+        :param writer:     OutputWriter to write the file with
+        :param f:          AmfFile object
+        :param callback:   method to call on the object. It is passed the
                            object as its single argument and should return a
                            string
-        :param output_dir: directory in which to write output files
+        :param output_dir: directory in which to write output file
         :param ext:        file extension to use
         """
-        count = 0
-        for f in files:
-            fname = f.get_filename(ext)
-            outpath = os.path.join(output_dir, fname)
-            with open(outpath, "w") as out_file:
-                out_file.write(callback(f))
-                count += 1
-        print("{} files written".format(count))
+        writer.write(os.path.join(output_dir, f.get_filename(ext)), callback(f))
 
     def get_all_cvs(self, base_class=None):
         """
@@ -153,7 +496,34 @@ class SpreadsheetHandler(object):
 
         :param base_class: if given, only parse CVs that inherit from this
                            class
-        :return:           an iterator of instances of subclasses of `BaseCV`
+        :return:           an iterator of instances of subclasses of `BaseCV`,
+                           in the same order regardless of `self.jobs`
+        """
+        cv_parse_infos = [info for info in self._get_cv_parse_infos()
+                          if not base_class or base_class in info.cls.__bases__]
+        for cv in self._parse_cvs(cv_parse_infos):
+            if cv is not None:
+                yield cv
+
+    def get_cv(self, namespace):
+        """
+        Parse a single CV from the spreadsheet files. This is quicker than
+        searching the results of `get_all_cvs`, since only one TSV file is
+        read (or, if `self.cache` is set, none)
+
+        :param namespace: namespace of the CV, e.g. 'product_soil_variable'
+        :return:          instance of a subclass of `BaseCV`, or None if there
+                          is no such CV or it could not be parsed
+        """
+        for parse_info in self._get_cv_parse_infos():
+            if AmfFile(parse_info.facets).namespace == namespace:
+                return next(self._parse_cvs([parse_info]))
+        return None
+
+    def _get_cv_parse_infos(self):
+        """
+        Return a list of CVParseInfo objects for every CV, with full paths to
+        the TSV files
         """
         # Static CVs
         def static_path(name):
@@ -191,48 +561,102 @@ class SpreadsheetHandler(object):
                 file=sys.stderr
             )
 
-        for path, cls, facets in cv_parse_infos:
-            if base_class and base_class not in cls.__bases__:
-                continue
+        return [CVParseInfo(os.path.join(self.path, path), cls, facets)
+                for path, cls, facets in cv_parse_infos]
 
-            full_path = os.path.join(self.path, path)
-            if not self._isfile(full_path):
-                continue
+    def _parse_cvs(self, cv_parse_infos):
+        """
+        Parse the CV for each CVParseInfo object, using worker processes if
+        `self.jobs` is more than 1, and loading CVs from `self.cache` where
+        the TSV files have not changed
+        :return: iterator of CV objects (or None where the CV could not be
+                 parsed) in the same order as `cv_parse_infos`
+        """
+        if self.cache is None and self.jobs <= 1:
+            for parse_info in cv_parse_infos:
+                yield parse_cv(*parse_info)
+            return
 
-            with open(full_path) as tsv_file:
-                try:
-                    yield cls(tsv_file, facets)
-                except DimensionsSheetNoRowsError as ex:
-                    # Ignore if there is no data in the Dimensions worksheet
-                    pass
-                except CVParseError as ex:
-                    print("WARNING: Failed to parse '{}': {}"
-                          .format(full_path, ex), file=sys.stderr)
+        # Only check which entries are valid up front: cached CVs are loaded
+        # one at a time, so that they do not all need to be held in memory
+        headers = [self.cache.get_header(info) if self.cache else None
+                   for info in cv_parse_infos]
+        # Fingerprint the files to parse before parsing them, so that a CV is
+        # never cached for contents newer than those it was parsed from
+        fingerprints = [
+            self.cache.get_fingerprint(info.path)
+            if self.cache and header is None else None
+            for info, header in zip(cv_parse_infos, headers)
+        ]
+        parsed = self._parse_cvs_capturing_warnings(
+            [info for info, header in zip(cv_parse_infos, headers) if header is None]
+        )
+        # Warnings are printed in the same order as in the serial case, and
+        # cached warnings are printed again so that output is the same
+        # whether or not the cache is used
+        for parse_info, header, fingerprint in zip(cv_parse_infos, headers,
+                                                   fingerprints):
+            if header is None:
+                entry = next(parsed)
+                if self.cache:
+                    self.cache.put(parse_info, entry[0], entry[1], fingerprint)
+            else:
+                entry = self.cache.load(parse_info, header)
+                if entry is None:
+                    # Entry has been removed or replaced since it was checked
+                    entry = _parse_cv_in_worker(parse_info)
+            cv, warnings = entry
+            sys.stderr.write(warnings)
+            yield cv
+
+    def _parse_cvs_capturing_warnings(self, cv_parse_infos):
+        """
+        Parse the CV for each CVParseInfo object, in worker processes if
+        `self.jobs` is more than 1
+        :return: iterator of tuples (CV object or None, warnings) in the same
+                 order as `cv_parse_infos`
+        """
+        if self.jobs <= 1 or not cv_parse_infos:
+            for parse_info in cv_parse_infos:
+                yield _parse_cv_in_worker(parse_info)
+            return
+
+        # Only keep a few tasks per worker in flight, so that parsed CVs do
+        # not pile up in this process while earlier ones are being written
+        from multiprocessing import Pool
+        pool = Pool(self.jobs)
+        max_pending = self.jobs * MAX_PENDING_PER_JOB
+        try:
+            pending = deque()
+            for parse_info in cv_parse_infos:
+                if len(pending) >= max_pending:
+                    yield pending.popleft().get()
+                pending.append(pool.apply_async(_parse_cv_in_worker, (parse_info,)))
+            while pending:
+                yield pending.popleft().get()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
 
     def _get_per_product_parse_info(self):
         """
         Return iterator of CVParseInfo objects for product variable/dimension
         CVs
         """
-        sheet_regex = re.compile(
-            r"(?P<name>[a-zA-Z0-9-]+)/(?P=name)\.xlsx/(?P<type>Variables|Dimensions) - Specific.tsv$"
-        )
         prods_dir = os.path.join(self.path, SPREADSHEET_NAMES["products_dir"])
-        for dirpath, _dirnames, filenames in os.walk(prods_dir):
-            for fname in filenames:
-                path = os.path.join(dirpath, fname)
-                match = sheet_regex.search(path)
-                if not match:
-                    print("WARNING: No match for '{}'".format(path))
-                    continue
+        index_path = (os.path.join(self.path, PRODUCT_INDEX_FILENAME)
+                      if self.discovery_index else None)
+        discoverer = ProductDiscoverer(prods_dir, index_path=index_path)
+        sheets = discoverer.discover()
+        discoverer.print_summary()
 
-                prod_name = match.group("name")
-                cv_type = match.group("type")
-                cls = self.VAR_DIM_FILENAME_MAPPING[cv_type]["cls"]
-                facets = ["product", prod_name,
-                          self.VAR_DIM_FILENAME_MAPPING[cv_type]["name"]]
-                yield CVParseInfo(os.path.relpath(path, start=self.path), cls,
-                                  facets)
+        for prod_name, cv_type, path in sheets:
+            cls = self.VAR_DIM_FILENAME_MAPPING[cv_type]["cls"]
+            facets = ["product", prod_name,
+                      self.VAR_DIM_FILENAME_MAPPING[cv_type]["name"]]
+            yield CVParseInfo(os.path.join(SPREADSHEET_NAMES["products_dir"], path),
+                              cls, facets)
 
     def _get_common_var_dim_parse_info(self):
         """
@@ -2,20 +2,51 @@
 Tests to add:
 - CVParseError raised when dimensions sheet is empty, invalid var name
 """
+import gc
 import os
+import argparse
 import re
 import sys
+import time
 import json
 import yaml
+import zipfile
+import types
+import weakref
+import threading
+import subprocess
+from collections import OrderedDict
 from StringIO import StringIO
 
 import pytest
+import httplib2
+from apiclient.errors import HttpError
 
+from amf_check_writer import spreadsheet_handler, build_manifest
 from amf_check_writer.spreadsheet_handler import SpreadsheetHandler
 from amf_check_writer.exceptions import CVParseError
-from amf_check_writer.cvs import VariablesCV
-from amf_check_writer.yaml_check import GlobalAttrCheck
-from amf_check_writer.amf_checker import get_product_from_filename
+from amf_check_writer.cvs import BaseCV, VariablesCV
+from amf_check_writer.yaml_check import (GlobalAttrCheck, WrapperYamlCheck,
+                                         FileInfoCheck, FileStructureCheck)
+from amf_check_writer.base_file import AmfFile
+from amf_check_writer.amf_checker import (get_product_from_filename,
+                                          get_check_runs, run_checks, CheckRun)
+from amf_check_writer.deployment_modes import DeploymentModes
+from amf_check_writer import check_engine, amf_checker
+from amf_check_writer.check_engine import InProcessChecker
+from amf_check_writer.drive_manifest import DriveManifest
+from amf_check_writer.rate_limiter import RateLimiter
+from amf_check_writer.xlsx_to_tsv import XlsxReader, convert_xlsx
+from amf_check_writer import download_from_drive
+from amf_check_writer.download_from_drive import SheetDownloader, get_sheet_ranges
+from amf_check_writer.fake_google_api import FakeDriveTree, FakeGoogleApiServer
+from amf_check_writer.discovery_cache import DiscoveryCache
+from amf_check_writer.file_utils import atomic_write, OutputWriter
+from amf_check_writer.cv_cache import CVCache
+from amf_check_writer import product_discovery
+from amf_check_writer.product_discovery import ProductDiscoverer
+from amf_check_writer.pyessv_writer import PyessvWriter, PYESSV_BACKENDS
+from amf_check_writer import pyessv_archive
 
 
 class BaseTest(object):
@@ -768,6 +799,642 @@ class TestVocabulariesSheet(BaseTest):
         }
 
 
+class TestParallelParsing(BaseTest):
+    def test_same_as_serial(self, spreadsheets_dir, capsys):
+        s_dir = spreadsheets_dir
+        s_dir.join("Vocabularies.xlsx").join("Instrument Name & Descriptors.tsv").write(
+            "\n".join((
+                "Old Instrument Name\tNew Instrument Name\tDescriptor",
+                "old1\tmyinstr\tFirst instrument",
+                "old2\tmyinstr\tSecond instrument"
+            ))
+        )
+        prods = s_dir.join("Product Definition Spreadsheets")
+        for i in range(6):
+            name = "product-{}".format(i)
+            prod_dir = prods.mkdir(name).mkdir("{}.xlsx".format(name))
+            prod_dir.join("Variables - Specific.tsv").write("\n".join((
+                "Variable\tAttribute\tValue",
+                "var_{}".format(i),
+                "\tunits\tm",
+                # Invalid variable name in one product
+                "bad???" if i == 3 else "other_var"
+            )))
+            # Empty dimensions sheet
+            prod_dir.join("Dimensions - Specific.tsv").write("Name\tLength\tunits")
+
+        def parse(jobs):
+            sh = SpreadsheetHandler(str(s_dir), jobs=jobs)
+            cvs = [(cv.namespace, cv.cv_dict) for cv in sh.get_all_cvs()]
+            return cvs, capsys.readouterr().err
+
+        serial_cvs, serial_warnings = parse(1)
+        parallel_cvs, parallel_warnings = parse(3)
+        assert len(serial_cvs) == 6
+        assert parallel_cvs == serial_cvs
+        assert "Duplicate instrument name" in serial_warnings
+        assert "Invalid variable name" in serial_warnings
+        assert parallel_warnings == serial_warnings
+
+
+class TestCreateAll(BaseTest):
+    def test_same_as_separate_scripts(self, spreadsheets_dir, tmpdir, monkeypatch):
+        s_dir = spreadsheets_dir
+        s_dir.join("Vocabularies.xlsx").join("Platforms.tsv").write("\n".join((
+            "Platform ID\tPlatform Description",
+            "wao\tweybourne atmospheric observatory"
+        )))
+        common_dir = s_dir.join("Common.xlsx")
+        common_dir.join("Variables - Land.tsv").write("\n".join((
+            "Variable\tAttribute\tValue",
+            "some_land_variable\t\t",
+            "\ttype\tfloat32"
+        )))
+        common_dir.join("Global Attributes.tsv").write("\n".join((
+            "Name\tDescription\tExample\tFixed Value\tCompliance checking rules\tConvention Providence",
+            "someattr\ta\tb\tc\tInteger\td"
+        )))
+        soil_dir = (s_dir.join("Product Definition Spreadsheets")
+                         .mkdir("soil").mkdir("soil.xlsx"))
+        soil_dir.join("Variables - Specific.tsv").write("\n".join((
+            "Variable\tAttribute\tValue",
+            "soil_var\t\t",
+            "\ttype\tfloat32"
+        )))
+
+        sh = SpreadsheetHandler(str(s_dir))
+        separate_cvs = tmpdir.mkdir("separate-cvs")
+        separate_yaml = tmpdir.mkdir("separate-yaml")
+        sh.write_cvs(str(separate_cvs))
+        sh.write_yaml(str(separate_yaml))
+
+        # Count how many times each TSV file is parsed
+        parsed = []
+        real_parse_cv = spreadsheet_handler.parse_cv
+        def parse_cv(full_path, cls, facets):
+            parsed.append(full_path)
+            return real_parse_cv(full_path, cls, facets)
+        monkeypatch.setattr(spreadsheet_handler, "parse_cv", parse_cv)
+
+        all_cvs = tmpdir.mkdir("all-cvs")
+        all_yaml = tmpdir.mkdir("all-yaml")
+        sh.write_all(str(all_cvs), str(all_yaml), write_pyessv=False)
+        assert len(parsed) == len(set(parsed))
+
+        for separate, combined in ((separate_cvs, all_cvs), (separate_yaml, all_yaml)):
+            names = sorted(f.basename for f in separate.listdir())
+            assert names
+            assert sorted(f.basename for f in combined.listdir()) == names
+            for name in names:
+                assert combined.join(name).read() == separate.join(name).read()
+
+
+class TestIncrementalBuild(BaseTest):
+    @pytest.fixture
+    def build(self, spreadsheets_dir, tmpdir, monkeypatch):
+        """
+        Return a function that runs an incremental build and returns the set
+        of TSV filenames parsed and the set of output files written
+        """
+        s_dir = spreadsheets_dir
+        common_dir = s_dir.join("Common.xlsx")
+        for mode in ("Land", "Sea"):
+            common_dir.join("Variables - {}.tsv".format(mode)).write("\n".join((
+                "Variable\tAttribute\tValue",
+                "some_{}_variable\t\t".format(mode.lower()),
+                "\ttype\tfloat32"
+            )))
+        prods = s_dir.join("Product Definition Spreadsheets")
+        for name in ("soil", "rain"):
+            prods.mkdir(name).mkdir("{}.xlsx".format(name)).join("Variables - Specific.tsv").write(
+                "\n".join(("Variable\tAttribute\tValue", "{}_var\t\t".format(name),
+                           "\ttype\tfloat32"))
+            )
+
+        cvs_dir = tmpdir.mkdir("cvs")
+        yaml_dir = tmpdir.mkdir("yaml")
+        parsed = []
+        real_parse_cv = spreadsheet_handler.parse_cv
+        def parse_cv(full_path, cls, facets):
+            parsed.append(os.path.basename(os.path.dirname(full_path)) + "/" +
+                          os.path.basename(full_path))
+            return real_parse_cv(full_path, cls, facets)
+        monkeypatch.setattr(spreadsheet_handler, "parse_cv", parse_cv)
+
+        written = []
+        real_write = SpreadsheetHandler._write_output_file
+        def write_output_file(sh, writer, f, *args):
+            written.append(f.get_filename(args[-1]))
+            return real_write(sh, writer, f, *args)
+        monkeypatch.setattr(SpreadsheetHandler, "_write_output_file", write_output_file)
+
+        def build():
+            del parsed[:]
+            del written[:]
+            sh = SpreadsheetHandler(str(s_dir), incremental=True)
+            sh.write_all(str(cvs_dir), str(yaml_dir), write_pyessv=False)
+            return set(parsed), set(written)
+        return build
+
+    def test_unchanged(self, build):
+        parsed, written = build()
+        assert "soil.xlsx/Variables - Specific.tsv" in parsed
+        assert "AMF_product_soil_land.yml" in written
+        assert build() == (set(), set())
+
+    def test_product_changed(self, spreadsheets_dir, build):
+        build()
+        tsv = (spreadsheets_dir.join("Product Definition Spreadsheets")
+                               .join("soil").join("soil.xlsx")
+                               .join("Variables - Specific.tsv"))
+        tsv.write("\n".join(("Variable\tAttribute\tValue", "new_var\t\t",
+                             "\ttype\tint")))
+        parsed, written = build()
+        assert parsed == set(["soil.xlsx/Variables - Specific.tsv"])
+        assert written == set([
+            "AMF_product_soil_variable.json",
+            "AMF_product_soil_variable.yml",
+            "AMF_product_soil_land.yml",
+            "AMF_product_soil_sea.yml",
+            "AMF_product_soil_air.yml"
+        ])
+
+    def test_common_changed(self, spreadsheets_dir, tmpdir, build):
+        build()
+        wrapper = tmpdir.join("yaml").join("AMF_product_rain_land.yml")
+        before = wrapper.read()
+        spreadsheets_dir.join("Common.xlsx").join("Variables - Land.tsv").write(
+            "\n".join(("Variable\tAttribute\tValue", "other_var\t\t",
+                       "\ttype\tint"))
+        )
+        parsed, written = build()
+        assert parsed == set(["Common.xlsx/Variables - Land.tsv"])
+        assert written == set([
+            "AMF_product_common_variable_land.json",
+            "AMF_product_common_variable_land.yml",
+            "AMF_product_soil_land.yml",
+            "AMF_product_rain_land.yml"
+        ])
+        # Wrappers built from unparsed CVs are the same as in a full build
+        assert wrapper.read() == before
+
+        # Removing the common sheet removes it from the wrappers
+        spreadsheets_dir.join("Common.xlsx").join("Variables - Land.tsv").remove()
+        build()
+        assert "product_common_variable_land" not in wrapper.read()
+
+    def test_generator_version_changed(self, tmpdir, build, monkeypatch):
+        build()
+        monkeypatch.setattr(build_manifest, "_generator_version", "new-version")
+        parsed, written = build()
+        assert "soil.xlsx/Variables - Specific.tsv" in parsed
+        for out_dir in (tmpdir.join("cvs"), tmpdir.join("yaml")):
+            for f in out_dir.listdir():
+                assert f.basename in written or f.basename == build_manifest.MANIFEST_FILENAME
+
+    def test_corrupt_manifest(self, tmpdir, build):
+        _, all_written = build()
+        # A truncated manifest is ignored, and everything is rebuilt
+        manifest = tmpdir.join("yaml").join(build_manifest.MANIFEST_FILENAME)
+        manifest.write(manifest.read()[:20])
+        parsed, written = build()
+        assert "soil.xlsx/Variables - Specific.tsv" in parsed
+        assert written == set(f for f in all_written if f.endswith(".yml"))
+        assert build() == (set(), set())
+
+    def test_generator_version_sources(self, tmpdir):
+        package = tmpdir.mkdir("package")
+        package.mkdir("cvs").join("base.py").write("a = 1")
+        package.join("yaml_check.py").write("b = 1")
+        package.join("download_from_drive.py").write("c = 1")
+        version = build_manifest.hash_sources(str(package))
+
+        # Modules that do not affect the output are not included
+        package.join("download_from_drive.py").write("c = 2")
+        package.join("amf_checker.py").write("d = 1")
+        assert build_manifest.hash_sources(str(package)) == version
+
+        package.join("cvs").join("base.py").write("a = 2")
+        assert build_manifest.hash_sources(str(package)) != version
+
+
+class TestCVCache(BaseTest):
+    @pytest.fixture
+    def parsed(self, monkeypatch):
+        """
+        Return a list which records the filename of each TSV file parsed
+        """
+        parsed = []
+        real_parse_cv = spreadsheet_handler.parse_cv
+        def parse_cv(full_path, cls, facets):
+            parsed.append(os.path.basename(full_path))
+            return real_parse_cv(full_path, cls, facets)
+        monkeypatch.setattr(spreadsheet_handler, "parse_cv", parse_cv)
+        return parsed
+
+    def create_product(self, s_dir, name, var_name):
+        prod_dir = (s_dir.join("Product Definition Spreadsheets")
+                         .ensure(name, "{}.xlsx".format(name), dir=True))
+        tsv = prod_dir.join("Variables - Specific.tsv")
+        tsv.write("\n".join(("Variable\tAttribute\tValue", var_name,
+                             "\tunits\tm")))
+        return tsv
+
+    def test_warm_start(self, spreadsheets_dir, tmpdir, parsed, capsys):
+        s_dir = spreadsheets_dir
+        self.create_product(s_dir, "soil", "soil_var")
+        self.create_product(s_dir, "rain", "bad???")
+        cache = CVCache(str(tmpdir.join("cache")))
+
+        def get_all(cache):
+            sh = SpreadsheetHandler(str(s_dir), cache=cache)
+            cvs = [(cv.namespace, cv.cv_dict) for cv in sh.get_all_cvs()]
+            return cvs, capsys.readouterr().err
+
+        uncached = get_all(None)
+        del parsed[:]
+        assert get_all(cache) == uncached
+        assert "Variables - Specific.tsv" in parsed
+        assert "Invalid variable name" in uncached[1]
+
+        # CVs and warnings are loaded from the cache. Only the missing files
+        # are looked for again
+        del parsed[:]
+        assert get_all(cache) == uncached
+        assert "Variables - Specific.tsv" not in parsed
+
+    def test_invalidation(self, spreadsheets_dir, tmpdir, parsed):
+        tsv = self.create_product(spreadsheets_dir, "soil", "soil_var")
+        cache = CVCache(str(tmpdir.join("cache")))
+        sh = SpreadsheetHandler(str(spreadsheets_dir), cache=cache)
+        ns = "product_soil_variable"
+        assert list(sh.get_cv(ns).cv_dict[ns].keys()) == ["soil_var"]
+
+        # Change the contents but not the size or mtime
+        mtime = tsv.mtime()
+        tsv.write(tsv.read().replace("soil_var", "new_var"))
+        tsv.setmtime(mtime)
+        del parsed[:]
+        assert list(sh.get_cv(ns).cv_dict[ns].keys()) == ["new_var"]
+        assert parsed == ["Variables - Specific.tsv"]
+
+        # Touching the file does not cause it to be parsed again
+        tsv.setmtime(mtime - 100)
+        del parsed[:]
+        assert list(sh.get_cv(ns).cv_dict[ns].keys()) == ["new_var"]
+        assert parsed == []
+
+    def test_changed_while_parsing(self, spreadsheets_dir, tmpdir, monkeypatch):
+        tsv = self.create_product(spreadsheets_dir, "soil", "soil_var")
+        real_parse_cv = spreadsheet_handler.parse_cv
+
+        def parse_cv(full_path, cls, facets):
+            cv = real_parse_cv(full_path, cls, facets)
+            # The file changes after it has been read
+            tsv.write(tsv.read().replace("soil_var", "new_var"))
+            return cv
+
+        monkeypatch.setattr(spreadsheet_handler, "parse_cv", parse_cv)
+        cache = CVCache(str(tmpdir.join("cache")))
+        sh = SpreadsheetHandler(str(spreadsheets_dir), cache=cache)
+        ns = "product_soil_variable"
+        assert list(sh.get_cv(ns).cv_dict[ns].keys()) == ["soil_var"]
+        monkeypatch.undo()
+
+        # The cached CV does not match the new contents
+        assert list(sh.get_cv(ns).cv_dict[ns].keys()) == ["new_var"]
+
+    def test_get_cv(self, spreadsheets_dir, tmpdir, parsed):
+        self.create_product(spreadsheets_dir, "soil", "soil_var")
+        self.create_product(spreadsheets_dir, "rain", "rain_var")
+        sh = SpreadsheetHandler(str(spreadsheets_dir),
+                                cache=CVCache(str(tmpdir.join("cache"))))
+        cv = sh.get_cv("product_rain_variable")
+        assert isinstance(cv, VariablesCV)
+        assert list(cv.cv_dict["product_rain_variable"].keys()) == ["rain_var"]
+        assert parsed == ["Variables - Specific.tsv"]
+        assert sh.get_cv("product_rain_variable").cv_dict == cv.cv_dict
+        assert len(parsed) == 1
+        assert sh.get_cv("product_nonexistent_variable") is None
+
+
+class TestProductDiscovery(BaseTest):
+    def create_products(self, s_dir):
+        prods = s_dir.join("Product Definition Spreadsheets")
+        for name in ("soil", "rain"):
+            xlsx_dir = prods.mkdir(name).mkdir("{}.xlsx".format(name))
+            xlsx_dir.join("Variables - Specific.tsv").write("")
+            xlsx_dir.join("Dimensions - Specific.tsv").write("")
+        # A product nested further down the tree
+        prods.ensure("Old products", "snow", "snow.xlsx",
+                     "Variables - Specific.tsv")
+        # Stray files at each level
+        prods.join("notes.txt").write("")
+        prods.join("soil").join("soil.xlsx").join("Notes.tsv").write("")
+        prods.join("soil").join("old-soil.xlsx").join("Variables - Specific.tsv").ensure()
+        prods.join("raw").join("exports").join("a").join("b.tsv").ensure()
+        return prods
+
+    def test_discovery(self, spreadsheets_dir, capsys):
+        prods = self.create_products(spreadsheets_dir)
+        discoverer = ProductDiscoverer(str(prods))
+        assert discoverer.discover() == [
+            ("rain", "Dimensions", "rain/rain.xlsx/Dimensions - Specific.tsv"),
+            ("rain", "Variables", "rain/rain.xlsx/Variables - Specific.tsv"),
+            ("snow", "Variables",
+             "Old products/snow/snow.xlsx/Variables - Specific.tsv"),
+            ("soil", "Dimensions", "soil/soil.xlsx/Dimensions - Specific.tsv"),
+            ("soil", "Variables", "soil/soil.xlsx/Variables - Specific.tsv"),
+        ]
+        assert discoverer.ignored == [
+            "notes.txt", "raw/exports/a/b.tsv",
+            "soil/old-soil.xlsx/Variables - Specific.tsv",
+            "soil/soil.xlsx/Notes.tsv"
+        ]
+
+        # A single warning is printed when finding CVs
+        sh = SpreadsheetHandler(str(spreadsheets_dir))
+        infos = list(sh._get_per_product_parse_info())
+        assert len(infos) == 5
+        assert infos[-1].facets == ["product", "soil", "variable"]
+        out, err = capsys.readouterr()
+        assert out == ""
+        assert err.count("WARNING") == 1
+        assert "Ignored 4 unexpected files/directories" in err
+
+    def test_index(self, spreadsheets_dir, tmpdir):
+        prods = self.create_products(spreadsheets_dir)
+        index_path = str(tmpdir.join("index.json"))
+
+        def set_mtimes(mtime):
+            for path in [prods] + list(prods.visit(lambda p: p.check(dir=1))):
+                path.setmtime(mtime)
+
+        old_mtime = prods.mtime() - 100
+        set_mtimes(old_mtime)
+        discoverer = ProductDiscoverer(str(prods), index_path=index_path)
+        sheets = discoverer.discover()
+        assert not discoverer.used_index
+
+        discoverer = ProductDiscoverer(str(prods), index_path=index_path)
+        assert discoverer.discover() == sheets
+        assert discoverer.used_index
+        assert len(discoverer.ignored) == 4
+
+        # Changing a directory changes its mtime
+        prods.join("rain").mkdir("rain.xlsx.tmp").join("Notes.tsv").write("")
+        set_mtimes(old_mtime)
+        prods.join("rain").setmtime(old_mtime + 1)
+        discoverer = ProductDiscoverer(str(prods), index_path=index_path)
+        assert discoverer.discover() == sheets
+        assert not discoverer.used_index
+        assert "rain/rain.xlsx.tmp/Notes.tsv" in discoverer.ignored
+
+        # A recently modified directory is not trusted, however deep it is
+        prods.join("Old products").mkdir("wind").mkdir("wind.xlsx").join(
+            "Variables - Specific.tsv").write("")
+        discoverer = ProductDiscoverer(str(prods), index_path=index_path)
+        assert len(discoverer.discover()) == 6
+        discoverer = ProductDiscoverer(str(prods), index_path=index_path)
+        assert len(discoverer.discover()) == 6
+        assert not discoverer.used_index
+
+    def test_non_ascii_paths(self, spreadsheets_dir, tmpdir):
+        prods = spreadsheets_dir.join("Product Definition Spreadsheets")
+        folder = u"Donn\u00e9es"
+        if not isinstance(folder, str):
+            folder = folder.encode(product_discovery.FS_ENCODING)
+        prods.ensure(folder, "rain", "rain.xlsx", "Variables - Specific.tsv")
+        prods.ensure(folder, "notes.txt")
+        old_mtime = prods.mtime() - 100
+        for path in [prods] + list(prods.visit(lambda p: p.check(dir=1))):
+            path.setmtime(old_mtime)
+        index_path = str(tmpdir.join("index.json"))
+
+        discoverer = ProductDiscoverer(str(prods), index_path=index_path)
+        sheets = discoverer.discover()
+        assert sheets == [("rain", "Variables",
+                           os.path.join(folder, "rain", "rain.xlsx",
+                                        "Variables - Specific.tsv"))]
+        ignored = discoverer.ignored
+
+        # The index is used, and gives the same strings as scanning
+        discoverer = ProductDiscoverer(str(prods), index_path=index_path)
+        indexed_sheets = discoverer.discover()
+        assert discoverer.used_index
+        assert indexed_sheets == sheets
+        assert discoverer.ignored == ignored == [os.path.join(folder, "notes.txt")]
+        assert all(type(value) is str
+                   for value in tuple(indexed_sheets[0]) + tuple(discoverer.ignored))
+
+
+class TestStreamingBuild(BaseTest):
+    def test_bounded_memory(self, spreadsheets_dir, tmpdir, monkeypatch):
+        self.check_bounded_memory(spreadsheets_dir, tmpdir, monkeypatch, jobs=1,
+                                  max_cvs=2)
+
+    def test_bounded_memory_parallel(self, spreadsheets_dir, tmpdir, monkeypatch):
+        # CVs parsed in worker processes are created here when the results
+        # are received, so count the instances that are alive instead
+        max_cvs = 2 * spreadsheet_handler.MAX_PENDING_PER_JOB + 2
+        self.check_bounded_memory(spreadsheets_dir, tmpdir, monkeypatch, jobs=2,
+                                  max_cvs=max_cvs)
+
+    def check_bounded_memory(self, spreadsheets_dir, tmpdir, monkeypatch, jobs,
+                             max_cvs):
+        prods = spreadsheets_dir.join("Product Definition Spreadsheets")
+        for i in range(20):
+            name = "product-{}".format(i)
+            prods.mkdir(name).mkdir("{}.xlsx".format(name)).join("Variables - Specific.tsv").write(
+                "\n".join(("Variable\tAttribute\tValue", "var_{}\t\t".format(i),
+                           "\ttype\tfloat32"))
+            )
+
+        # Keep track of how many CVs are alive whenever a file is written
+        live_cvs = weakref.WeakSet()
+        real_parse_cv = spreadsheet_handler.parse_cv
+        def parse_cv(*args):
+            cv = real_parse_cv(*args)
+            if cv is not None:
+                live_cvs.add(cv)
+            return cv
+        monkeypatch.setattr(spreadsheet_handler, "parse_cv", parse_cv)
+
+        def count_cvs():
+            if jobs == 1:
+                return len(live_cvs)
+            return sum(1 for obj in gc.get_objects() if isinstance(obj, BaseCV))
+
+        max_live = []
+        real_write = SpreadsheetHandler._write_output_file
+        def write_output_file(sh, writer, f, *args):
+            # Give the workers time to get ahead of the writes
+            if jobs > 1:
+                time.sleep(0.02)
+            gc.collect()
+            max_live.append(count_cvs())
+            return real_write(sh, writer, f, *args)
+        monkeypatch.setattr(SpreadsheetHandler, "_write_output_file", write_output_file)
+
+        cvs_dir = tmpdir.mkdir("cvs")
+        yaml_dir = tmpdir.mkdir("yaml")
+        sh = SpreadsheetHandler(str(spreadsheets_dir), jobs=jobs)
+        sh.write_all(str(cvs_dir), str(yaml_dir), write_pyessv=False)
+
+        assert max(max_live) <= max_cvs
+        assert cvs_dir.join("AMF_product_product-19_variable.json").check()
+        wrapper = yaml_dir.join("AMF_product_product-19_land.yml").read()
+        assert "AMF_product_product-19_variable.yml" in wrapper
+
+
+class TestOutputWriting(BaseTest):
+    def test_write_if_changed(self, spreadsheets_dir, tmpdir, capsys):
+        prods = spreadsheets_dir.join("Product Definition Spreadsheets")
+        for name in ("soil", "rain"):
+            prods.mkdir(name).mkdir("{}.xlsx".format(name)).join("Variables - Specific.tsv").write(
+                "\n".join(("Variable\tAttribute\tValue", "{}_var\t\t".format(name),
+                           "\ttype\tfloat32"))
+            )
+        cvs_dir = tmpdir.mkdir("cvs")
+        yaml_dir = tmpdir.mkdir("yaml")
+
+        def build():
+            sh = SpreadsheetHandler(str(spreadsheets_dir))
+            sh.write_all(str(cvs_dir), str(yaml_dir), write_pyessv=False)
+            return capsys.readouterr().out
+
+        out = build()
+        assert "2 files written, 0 unchanged, 0 removed" in out
+        assert "10 files written, 0 unchanged, 0 removed" in out
+
+        soil_json = cvs_dir.join("AMF_product_soil_variable.json")
+        soil_json.setmtime(soil_json.mtime() - 100)
+        mtime = soil_json.mtime()
+        out = build()
+        assert "0 files written, 2 unchanged, 0 removed" in out
+        assert "0 files written, 10 unchanged, 0 removed" in out
+        assert soil_json.mtime() == mtime
+
+        # Outputs for a removed product are deleted, but other files are not
+        cvs_dir.join("other.json").write("")
+        prods.join("rain").remove()
+        out = build()
+        assert "0 files written, 1 unchanged, 1 removed" in out
+        assert "0 files written, 6 unchanged, 4 removed" in out
+        assert sorted(f.basename for f in cvs_dir.listdir()) == [
+            ".build-manifest.json", "AMF_product_soil_variable.json", "other.json"
+        ]
+        assert not yaml_dir.join("AMF_product_rain_land.yml").check()
+
+    def test_output_writer(self, tmpdir):
+        path = tmpdir.join("out.txt")
+        with OutputWriter(threads=2, max_pending=1) as writer:
+            writer.write(str(path), "hello")
+            writer.write(str(tmpdir.join("other.txt")), "other")
+            writer.remove(str(tmpdir.join("nonexistent.txt")))
+        assert path.read() == "hello"
+        assert (writer.written, writer.unchanged, writer.removed) == (2, 0, 0)
+
+        with OutputWriter() as writer:
+            writer.write(str(path), "hello")
+            writer.remove(str(tmpdir.join("other.txt")))
+        assert (writer.written, writer.unchanged, writer.removed) == (0, 1, 1)
+        assert sorted(f.basename for f in tmpdir.listdir()) == ["out.txt"]
+
+
+class TestYamlEmission(BaseTest):
+    def reference_yaml(self, check):
+        """
+        Return the YAML for a check suite as generated with the pure-Python
+        dumper, without any pre-rendered fragments
+        """
+        return yaml.dump({
+            "suite_name": "{}_checks".format(check.namespace),
+            "description": "Check '{}' in AMF files".format(" ".join(check.facets)),
+            "checks": list(check.get_yaml_checks())
+        }, Dumper=yaml.Dumper)
+
+    def test_byte_identical(self):
+        var_tsv = StringIO("\n".join((
+            "Variable\tAttribute\tValue",
+            "wind_speed\t\t",
+            "\tname\twind_speed",
+            "\ttype\tfloat32",
+            "\tcomment\t" + "a long comment that needs to be wrapped " * 4,
+            "eastward_wind\t\t",
+            "\ttype\tfloat32",
+            "\tunits\tm s-1"
+        )))
+        attrs_tsv = StringIO("\n".join((
+            "Name\tDescription\tExample\tFixed Value\tCompliance checking rules",
+            "source\t\t\t\tValid URL _or_ N/A",
+            "version\t\t\t\tMatch: vN.M",
+            "title\t\t\tsome: 'text'\tExact match"
+        )))
+        children = [AmfFile(["file_info"]), AmfFile(["product", "soil", "variable"]),
+                    AmfFile(["weird: name"]), AmfFile(["yes"])]
+        checks = [
+            FileInfoCheck(["file_info"]),
+            FileInfoCheck(["file_info"]),
+            FileStructureCheck(["file_structure"]),
+            VariablesCV(var_tsv, ["product", "soil", "variable"]),
+            GlobalAttrCheck(attrs_tsv, ["global_attrs"]),
+            WrapperYamlCheck(children, ["product", "soil", "land"]),
+            WrapperYamlCheck([], ["product", "empty", "land"]),
+        ]
+        for check in checks:
+            assert check.to_yaml_check() == self.reference_yaml(check)
+
+
+class TestJsonOutput(BaseTest):
+    @pytest.fixture
+    def cv(self):
+        tsv = StringIO("\n".join((
+            "Variable\tAttribute\tValue",
+            "wind_speed\t\t",
+            "\ttype\tfloat32",
+            "\tunits\tm s-1",
+            "\tvalid_min\t0.5",
+            "eastward_wind\t\t",
+            "\ttype\tfloat32"
+        )))
+        return VariablesCV(tsv, ["product", "wind", "variable"])
+
+    def test_formats(self, cv):
+        assert cv.to_json() == json.dumps(cv.cv_dict, indent=4)
+        compact = cv.to_json(fmt="compact")
+        assert json.loads(compact) == json.loads(cv.to_json())
+        assert " " not in compact.replace("m s-1", "")
+        assert compact.index("eastward_wind") < compact.index("wind_speed")
+
+        with pytest.raises(ValueError):
+            cv.to_json(fmt="tiny")
+        with pytest.raises(ValueError):
+            SpreadsheetHandler("", json_backend="nonexistent")
+
+    def test_orjson(self, cv):
+        pytest.importorskip("orjson")
+        fast = cv.to_json(fmt="compact", backend="orjson")
+        assert json.loads(fast) == json.loads(cv.to_json())
+
+    def test_incremental_format_change(self, spreadsheets_dir, tmpdir):
+        prod_dir = (spreadsheets_dir.join("Product Definition Spreadsheets")
+                                    .mkdir("wind").mkdir("wind.xlsx"))
+        prod_dir.join("Variables - Specific.tsv").write("\n".join((
+            "Variable\tAttribute\tValue", "wind_speed\t\t", "\ttype\tfloat32"
+        )))
+        cvs_dir = tmpdir.mkdir("cvs")
+        cv_file = cvs_dir.join("AMF_product_wind_variable.json")
+
+        SpreadsheetHandler(str(spreadsheets_dir), incremental=True).write_cvs(str(cvs_dir))
+        pretty = cv_file.read()
+        SpreadsheetHandler(str(spreadsheets_dir), incremental=True,
+                           json_format="compact").write_cvs(str(cvs_dir))
+        compact = cv_file.read()
+        assert compact != pretty
+        assert json.loads(compact) == json.loads(pretty)
+
+
 class TestPyessvGeneration(BaseTest):
     def test_pyessv_cvs_are_generated(self, spreadsheets_dir, tmpdir):
         # Create spreadsheets to generate some CVs
@@ -826,6 +1493,179 @@ class TestPyessvGeneration(BaseTest):
         product_term = root.join("amf").join("product").join("snr-winds")
         assert product_term.check()
 
+    def test_incremental_archive(self, spreadsheets_dir, tmpdir):
+        s_dir = spreadsheets_dir
+        prod_tsv = s_dir.join("Vocabularies.xlsx").join("Data Products.tsv")
+        prod_tsv.write("Data Product\nsnr-winds\naerosol-backscatter")
+        plat_tsv = s_dir.join("Vocabularies.xlsx").join("Platforms.tsv")
+        plat_tsv.write("Platform ID\tPlatform Description\nwao\tweybourne observatory")
+
+        json_cvs_output = tmpdir.mkdir("json_cvs")
+        pyessv_cvs_output = tmpdir.mkdir("pyessv_cvs")
+
+        def build():
+            sh = SpreadsheetHandler(str(s_dir), incremental=True)
+            sh.write_cvs(str(json_cvs_output), write_pyessv=True,
+                         pyessv_root=str(pyessv_cvs_output))
+
+        amf_dir = pyessv_cvs_output.join("ncas").join("amf")
+        build()
+        wao_term = amf_dir.join("platform").join("wao")
+        wao_uid = json.load(wao_term)["uid"]
+        assert amf_dir.join("product").join("aerosol-backscatter").check()
+
+        # Change the products CV only: the platforms collection should not
+        # be rewritten, and keep its uids
+        prod_tsv.write("Data Product\nsnr-winds\nradiance")
+        # Python 2 rounds fractional mtimes set with setmtime
+        old_mtime = int(wao_term.mtime()) - 100
+        wao_term.setmtime(old_mtime)
+        build()
+        assert wao_term.mtime() == old_mtime
+        assert json.load(wao_term)["uid"] == wao_uid
+        assert amf_dir.join("product").join("radiance").check()
+        assert not amf_dir.join("product").join("aerosol-backscatter").check()
+
+        manifest = json.load(pyessv_cvs_output.join("ncas").join("MANIFEST"))
+        collections = manifest["scopes"][0]["collections"]
+        product = [c for c in collections if c["canonical_name"] == "product"][0]
+        assert sorted(product["terms"]) == ["radiance:radiance",
+                                            "snr-winds:snr-winds"]
+
+    @pytest.mark.parametrize("backend", PYESSV_BACKENDS)
+    def test_only_written_files_removed(self, spreadsheets_dir, tmpdir, backend):
+        vocabs = spreadsheets_dir.join("Vocabularies.xlsx")
+        vocabs.join("Data Products.tsv").write("Data Product\nsnr-winds\nradiance")
+        plat_tsv = vocabs.join("Platforms.tsv")
+        plat_tsv.write("Platform ID\tPlatform Description\nwao\tweybourne observatory")
+        json_dir = tmpdir.mkdir("json")
+        pyessv_dir = tmpdir.mkdir("pyessv_cvs")
+        amf_dir = pyessv_dir.join("ncas").join("amf")
+
+        # Collections and terms from elsewhere in the scope
+        amf_dir.ensure("other-collection", "term")
+        amf_dir.ensure("platform", "other-platform")
+
+        def build():
+            sh = SpreadsheetHandler(str(spreadsheets_dir), incremental=True,
+                                    pyessv_backend=backend)
+            sh.write_cvs(str(json_dir), write_pyessv=True,
+                         pyessv_root=str(pyessv_dir))
+
+        build()
+        assert amf_dir.join("platform").join("wao").check()
+        assert amf_dir.join("product").join("radiance").check()
+
+        # Removed terms and collections are deleted, but only if they were
+        # written by a previous build
+        plat_tsv.remove()
+        vocabs.join("Data Products.tsv").write("Data Product\nsnr-winds")
+        build()
+        assert not amf_dir.join("product").join("radiance").check()
+        assert amf_dir.join("product").join("snr-winds").check()
+        assert sorted(p.basename for p in amf_dir.join("platform").listdir()) == [
+            "other-platform"
+        ]
+        assert amf_dir.join("other-collection").join("term").check()
+
+        # An empty collection directory is removed
+        amf_dir.join("platform").join("other-platform").remove()
+        plat_tsv.write("Platform ID\tPlatform Description\nwao\tweybourne observatory")
+        build()
+        plat_tsv.remove()
+        build()
+        assert not amf_dir.join("platform").check()
+
+    def test_invalid_nodes_not_written(self, tmpdir):
+        writer = PyessvWriter(pyessv_root=str(tmpdir), backend="direct")
+        try:
+            collection = pyessv_archive.create_collection(
+                writer.scope_amf, "platform", "Platforms",
+                term_regex=writer.term_regex
+            )
+            term = pyessv_archive.create_term(collection, "wao")
+            assert pyessv_archive.get_errors(term) == []
+            term.status = "unknown"
+            assert pyessv_archive.get_errors(term) == [
+                "Term: invalid status: [unknown]"
+            ]
+            with pytest.raises(pyessv_archive.ValidationError):
+                writer._write_collection(collection)
+
+            writer.authority.url = "not a url"
+            with pytest.raises(pyessv_archive.ValidationError):
+                writer.archive()
+        finally:
+            writer.close()
+        assert tmpdir.listdir() == []
+
+    def test_direct_backend_matches_pyessv(self, spreadsheets_dir, tmpdir):
+        s_dir = spreadsheets_dir
+        s_dir.join("Vocabularies.xlsx").join("Creators.tsv").write("\n".join((
+            "name\temail\torcid\tconfirmed",
+            "Bob Smith\tbob@smith.com\thttps://orcid.org/123\tyes",
+        )))
+        s_dir.join("Vocabularies.xlsx").join("Data Products.tsv").write(
+            "Data Product\nsnr-winds\naerosol-backscatter"
+        )
+        s_dir.join("Vocabularies.xlsx").join("Platforms.tsv").write(
+            "Platform ID\tPlatform Description\nwao\tWeybourne Atmospheric Observatory"
+        )
+
+        pyessv_dir = tmpdir.mkdir("pyessv_cvs")
+        direct_dir = tmpdir.mkdir("direct_cvs")
+        sh = SpreadsheetHandler(str(s_dir), pyessv_backend="pyessv")
+        sh.write_cvs(str(tmpdir.mkdir("json1")), write_pyessv=True,
+                     pyessv_root=str(pyessv_dir))
+
+        # Write the same CVs over a copy of the archive in incremental mode,
+        # so that uids are reused: no files should change
+        pyessv_dir.join("ncas").copy(direct_dir.join("ncas"))
+        sh = SpreadsheetHandler(str(s_dir), incremental=True,
+                                pyessv_backend="direct")
+        sh.write_cvs(str(tmpdir.mkdir("json2")), write_pyessv=True,
+                     pyessv_root=str(direct_dir))
+
+        paths = sorted(p.relto(pyessv_dir) for p in pyessv_dir.visit())
+        assert paths == sorted(p.relto(direct_dir) for p in direct_dir.visit())
+        assert "ncas/amf/platform/wao" in paths
+        for path in paths:
+            if pyessv_dir.join(path).check(file=True):
+                assert (pyessv_dir.join(path).read_binary()
+                        == direct_dir.join(path).read_binary())
+
+    def test_direct_backend(self, spreadsheets_dir, tmpdir, monkeypatch):
+        # Make sure pyessv is not imported
+        monkeypatch.setitem(sys.modules, "pyessv", None)
+
+        prod_tsv = spreadsheets_dir.join("Vocabularies.xlsx").join("Data Products.tsv")
+        prod_tsv.write("Data Product\nsnr-winds\naerosol-backscatter")
+        pyessv_dir = tmpdir.mkdir("pyessv_cvs")
+        sh = SpreadsheetHandler(str(spreadsheets_dir), pyessv_backend="direct")
+        sh.write_cvs(str(tmpdir.mkdir("json")), write_pyessv=True,
+                     pyessv_root=str(pyessv_dir))
+
+        manifest = json.load(pyessv_dir.join("ncas").join("MANIFEST"))
+        assert manifest["namespace"] == "ncas"
+        product = manifest["scopes"][0]["collections"][0]
+        assert product["namespace"] == "ncas:amf:product"
+        assert product["terms"] == ["aerosol-backscatter:aerosol-backscatter",
+                                    "snr-winds:snr-winds"]
+        term = json.load(pyessv_dir.join("ncas").join("amf").join("product")
+                                   .join("snr-winds"))
+        assert term["namespace"] == "ncas:amf:product:snr-winds"
+        assert term["create_date"] == "2018-07-09 13:09:00"
+        assert term["status"] == "pending"
+
+        # Terms must still match the term regex
+        prod_tsv.write("Data Product\nsnr-winds\nnot/valid")
+        with pytest.raises(ValueError):
+            sh.write_cvs(str(tmpdir.join("json")), write_pyessv=True,
+                         pyessv_root=str(pyessv_dir))
+
+        with pytest.raises(ValueError):
+            SpreadsheetHandler(str(spreadsheets_dir), pyessv_backend="fast")
+
 
 class TestGlobalAttributeRegexes(BaseTest):
     def test_get_regex(self):
@@ -1030,3 +1870,1006 @@ class TestCheckerWrapperScript(BaseTest):
         for fname in bad_filenames:
             with pytest.raises(ValueError):
                 get_product_from_filename(fname)
+
+    def test_get_check_runs(self):
+        groups = {
+            ("prod-b", DeploymentModes.LAND): ["b1.nc"],
+            ("prod-a", DeploymentModes.SEA): ["a1.nc", "a2.nc", "a3.nc",
+                                              "a4.nc", "a5.nc"],
+        }
+        runs = get_check_runs(groups, "yaml", 2, output_dir="out",
+                              output_format="json_new")
+        assert [run.fnames for run in runs] == [
+            ["a1.nc", "a2.nc"], ["a3.nc", "a4.nc"], ["a5.nc"], ["b1.nc"]
+        ]
+        assert runs[0].yaml_check == "product_prod-a_sea"
+        assert runs[0].cc_args == [
+            "compliance-checker",
+            "--yaml", os.path.join("yaml", "AMF_product_prod-a_sea.yml"),
+            "--test", "product_prod-a_sea_checks",
+            "--format", "json_new",
+            "--output", os.path.join("out", "a1.nc.cc-output"),
+            "--output", os.path.join("out", "a2.nc.cc-output"),
+            "a1.nc", "a2.nc"
+        ]
+
+    def test_run_checks(self, capfd):
+        def fake_run(name, fnames, exit_code):
+            code = "print('checking {}'); import sys; sys.exit({})".format(
+                name, exit_code
+            )
+            return CheckRun(name, fnames, [sys.executable, "-c", code])
+
+        runs = [fake_run("one", ["1.nc", "2.nc"], 0),
+                fake_run("two", ["3.nc"], 1),
+                fake_run("three", ["4.nc"], 0)]
+        for jobs in (1, 3):
+            results = run_checks(runs, jobs=jobs)
+            assert sorted((run.yaml_check, code) for run, code in results) == [
+                ("one", 0), ("three", 0), ("two", 1)
+            ]
+            lines = capfd.readouterr()[0].splitlines()
+            assert sorted(lines) == sorted([
+                "checking one", "1.nc: passed", "2.nc: passed",
+                "checking two", "3.nc: failed (exit code 1)",
+                "checking three", "4.nc: passed",
+            ])
+            # Each run's output is followed by its results
+            assert lines.index("checking two") + 1 == lines.index("3.nc: failed (exit code 1)")
+
+    def test_status_per_dataset(self, tmpdir, monkeypatch, capsys):
+        # A stand-in for the compliance-checker script, which passes datasets
+        # whose names contain 'good'
+        bin_dir = tmpdir.mkdir("bin")
+        script = bin_dir.join("compliance-checker")
+        script.write("\n".join((
+            "#!{}".format(sys.executable),
+            "import sys",
+            "datasets = [a for a in sys.argv[1:] if a.endswith('.nc')]",
+            "sys.exit(0 if all('good' in ds for ds in datasets) else 1)",
+        )))
+        script.chmod(0o755)
+        monkeypatch.setenv("PATH", str(bin_dir) + os.pathsep + os.environ["PATH"])
+
+        # A good and a bad dataset for the same product and deployment mode
+        fnames = []
+        for inst in ("good", "bad"):
+            path = tmpdir.join("{}_wao_20180101000000_prod_v1.0.nc".format(inst))
+            path.write("")
+            fnames.append(str(path))
+        monkeypatch.setattr(amf_checker, "get_deployment_mode",
+                            lambda path: DeploymentModes.LAND)
+
+        def check(*args):
+            argv = ["amf-checker", "--yaml-dir", str(tmpdir)]
+            monkeypatch.setattr(sys, "argv", argv + list(args) + fnames)
+            with pytest.raises(SystemExit) as exc_info:
+                amf_checker.main()
+            assert exc_info.value.code == 1
+            return capsys.readouterr()[0].splitlines()
+
+        # Each dataset gets its own status by default
+        lines = check()
+        assert "{}: passed".format(fnames[0]) in lines
+        assert "{}: failed (exit code 1)".format(fnames[1]) in lines
+        assert lines[-1] == "1 files passed, 1 failed"
+
+        # Datasets checked in the same run share its status
+        lines = check("--files-per-run", "2")
+        shared = "failed (exit code 1, shared by the 2 datasets in this run)"
+        assert "{}: {}".format(fnames[0], shared) in lines
+        assert "{}: {}".format(fnames[1], shared) in lines
+        assert lines[-1] == "0 files passed, 2 failed"
+
+
+class TestInProcessChecker(BaseTest):
+    @pytest.fixture
+    def fake_cc(self, monkeypatch):
+        """
+        Install a stand-in for the `compliance-checker` script, which records
+        the YAML files suites are loaded from. A dataset passes the checks if
+        its name contains 'good'
+        """
+        loaded = []
+        cchecker = types.ModuleType("fake_cchecker")
+
+        class CheckSuite(object):
+            @classmethod
+            def load_all_available_checkers(cls):
+                loaded.append("all")
+
+            @classmethod
+            def add_plugin_args(cls, parser):
+                parser.add_argument("--yaml", "-y", action="append")
+
+            @classmethod
+            def load_generated_checkers(cls, args):
+                loaded.extend(args.yaml or [])
+
+        def main():
+            # Same steps as compliance-checker's cchecker.main
+            check_suite = cchecker.CheckSuite()
+            check_suite.load_all_available_checkers()
+            parser = argparse.ArgumentParser()
+            parser.add_argument("--test", "-t", default=[], action="append")
+            parser.add_argument("--format", "-f", default=[], action="append")
+            parser.add_argument("--output", "-o", default=[], action="append")
+            parser.add_argument("dataset_location", nargs="*")
+            check_suite.add_plugin_args(parser)
+            args = parser.parse_args()
+            check_suite.load_generated_checkers(args)
+
+            outputs = args.output or ["-"]
+            if len(outputs) == 1:
+                runs = [(args.dataset_location, outputs[0])]
+            elif len(outputs) == len(args.dataset_location):
+                runs = [([ds], out) for out, ds in zip(outputs, args.dataset_location)]
+            else:
+                sys.stderr.write("The number of output files must either be "
+                                 "one or the same as the number of datasets\n")
+                sys.exit(2)
+
+            passed = []
+            errors = []
+            for datasets, output in runs:
+                sys.stderr.write("Running Compliance Checker on the datasets "
+                                 "from: {}\n".format(datasets))
+                report = "{} {} {}".format(",".join(args.test),
+                                           ",".join(args.format or ["text"]),
+                                           " ".join(datasets))
+                if output == "-":
+                    sys.stdout.write(report + "\n")
+                else:
+                    with open(output, "w") as f:
+                        f.write(report)
+                passed.append(all("good" in ds for ds in datasets))
+                errors.append("error" in datasets[0])
+            if any(errors):
+                return 2
+            return 0 if all(passed) else 1
+
+        cchecker.CheckSuite = CheckSuite
+        cchecker.main = main
+        main.__module__ = cchecker.__name__
+        monkeypatch.setitem(sys.modules, cchecker.__name__, cchecker)
+        monkeypatch.setattr(check_engine, "load_cc_main", lambda: main)
+        return loaded
+
+    def test_suites_loaded_once(self, fake_cc, capsys):
+        checker = InProcessChecker()
+        assert checker.run(["--yaml", "a.yml", "--test", "a.yml_checks",
+                            "good1.nc"]) == 0
+        assert checker.run(["--yaml", "b.yml", "--test", "b.yml_checks",
+                            "good2.nc", "bad.nc"]) == 1
+        assert checker.run(["--yaml", "a.yml", "--test", "a.yml_checks",
+                            "good3.nc"]) == 0
+        assert checker.run(["--yaml", "a.yml", "--test", "a.yml_checks",
+                            "error.nc"]) == 2
+        assert fake_cc == ["all", "a.yml", "b.yml"]
+        # The script's CheckSuite is restored after each run
+        assert sys.modules["fake_cchecker"].CheckSuite.__name__ == "CheckSuite"
+
+        out, err = capsys.readouterr()
+        assert out.splitlines() == [
+            "a.yml_checks text good1.nc",
+            "b.yml_checks text good2.nc bad.nc",
+            "a.yml_checks text good3.nc",
+            "a.yml_checks text error.nc",
+        ]
+        assert "Running Compliance Checker on the datasets from" in err
+
+    def test_output_files(self, fake_cc, tmpdir):
+        checker = InProcessChecker()
+        out1 = str(tmpdir.join("out1"))
+        out2 = str(tmpdir.join("out2"))
+        args = ["--yaml", "a.yml", "--test", "a.yml_checks", "--format",
+                "json_new", "--output", out1, "--output", out2]
+        # Each dataset is checked separately when there is an output per
+        # dataset
+        assert checker.run(args + ["good.nc", "bad.nc"]) == 1
+        assert tmpdir.join("out1").read() == "a.yml_checks json_new good.nc"
+        assert tmpdir.join("out2").read() == "a.yml_checks json_new bad.nc"
+        # The number of outputs must match the number of datasets
+        assert checker.run(args + ["good.nc"]) == 2
+
+    def test_run_checks(self, fake_cc, capfd):
+        groups = {
+            ("prod-a", DeploymentModes.LAND): ["good1.nc", "good2.nc"],
+            ("prod-b", DeploymentModes.SEA): ["good3.nc", "bad.nc"],
+        }
+        runs = get_check_runs(groups, "yaml", 1)
+        for jobs in (1, 2):
+            results = run_checks(runs, jobs=jobs, engine="inprocess")
+            assert sorted((run.fnames, code) for run, code in results) == [
+                (["bad.nc"], 1), (["good1.nc"], 0), (["good2.nc"], 0),
+                (["good3.nc"], 0)
+            ]
+            lines = capfd.readouterr()[0].splitlines()
+            assert "bad.nc: failed (exit code 1)" in lines
+            assert "good3.nc: passed" in lines
+        # Each suite is loaded once by the main process
+        assert fake_cc == ["all",
+                           os.path.join("yaml", "AMF_product_prod-a_land.yml"),
+                           os.path.join("yaml", "AMF_product_prod-b_sea.yml")]
+
+        with pytest.raises(ValueError):
+            run_checks(runs, engine="unknown")
+
+    def test_status_per_dataset(self, fake_cc, tmpdir, monkeypatch, capsys):
+        # A good and a bad dataset for the same product and deployment mode
+        fnames = []
+        for inst in ("good", "bad"):
+            path = tmpdir.join("{}_wao_20180101000000_prod_v1.0.nc".format(inst))
+            path.write("")
+            fnames.append(str(path))
+        monkeypatch.setattr(amf_checker, "get_deployment_mode",
+                            lambda path: DeploymentModes.LAND)
+        monkeypatch.setattr(amf_checker, "is_available", lambda: True)
+
+        def check(*args):
+            argv = ["amf-checker", "--yaml-dir", str(tmpdir),
+                    "--engine", "inprocess"]
+            monkeypatch.setattr(sys, "argv", argv + list(args) + fnames)
+            with pytest.raises(SystemExit) as exc_info:
+                amf_checker.main()
+            assert exc_info.value.code == 1
+            # Leave out the reports printed by compliance-checker
+            return [line for line in capsys.readouterr()[0].splitlines()
+                    if line.startswith(tuple(fnames)) or "files passed" in line]
+
+        # Each dataset gets its own status by default
+        lines = check()
+        assert "{}: passed".format(fnames[0]) in lines
+        assert "{}: failed (exit code 1)".format(fnames[1]) in lines
+        assert lines[-1] == "1 files passed, 1 failed"
+
+        # Datasets checked in the same run share its status
+        lines = check("--files-per-run", "2")
+        shared = "failed (exit code 1, shared by the 2 datasets in this run)"
+        assert "{}: {}".format(fnames[0], shared) in lines
+        assert "{}: {}".format(fnames[1], shared) in lines
+        assert lines[-1] == "0 files passed, 2 failed"
+
+
+class TestComplianceCheckerEngines(BaseTest):
+    """
+    Run the installed compliance-checker with both engines, and check that
+    the results are the same
+    """
+    @pytest.fixture
+    def dataset(self, tmpdir):
+        netCDF4 = pytest.importorskip("netCDF4")
+        if not check_engine.is_available():
+            pytest.skip("compliance-checker is not installed")
+        path = tmpdir.join("dataset.nc")
+        ds = netCDF4.Dataset(str(path), "w", format="NETCDF4_CLASSIC")
+        ds.title = "Test dataset"
+        ds.createDimension("time", 2)
+        time_var = ds.createVariable("time", "f8", ("time",))
+        time_var.units = "days since 2000-01-01"
+        time_var[:] = [0, 1]
+        ds.close()
+        return path
+
+    def run_engines(self, tmpdir, cc_args, dataset):
+        """
+        Run a compliance-checker command line with both engines, checking the
+        exit codes and reports are the same
+        """
+        sub_out = tmpdir.join("subprocess.out")
+        code = subprocess.call([check_engine.CC_SCRIPT] + cc_args
+                               + ["--output", str(sub_out), str(dataset)])
+
+        checker = InProcessChecker()
+        # Suites are reused on the second run
+        for i in range(2):
+            out = tmpdir.join("inprocess-{}.out".format(i))
+            assert checker.run(cc_args + ["--output", str(out), str(dataset)]) == code
+            assert out.read() == sub_out.read()
+        return code
+
+    @pytest.mark.parametrize("output_format", ["text", "json_new"])
+    def test_builtin_suites(self, dataset, tmpdir, output_format):
+        self.run_engines(tmpdir, ["--test", "acdd", "--test", "cf",
+                                  "--format", output_format], dataset)
+
+    def test_yaml_suite(self, dataset, tmpdir):
+        pytest.importorskip("cc_yaml")
+        pytest.importorskip("checklib")
+        check = FileStructureCheck(["file", "structure"])
+        yaml_path = tmpdir.join(check.get_filename("yml"))
+        yaml_path.write(check.to_yaml_check())
+        code = self.run_engines(tmpdir, [
+            "--yaml", str(yaml_path), "--test", "{}_checks".format(check.namespace),
+            "--format", "json_new"
+        ], dataset)
+        assert code == 0
+
+
+class TestLazyImports(BaseTest):
+    def get_loaded_modules(self, module):
+        """
+        Import a module in a new interpreter, and return the set of modules
+        that were loaded
+        """
+        code = "import sys, {}; print(' '.join(sys.modules))".format(module)
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+        output = subprocess.check_output([sys.executable, "-c", code], env=env)
+        return set(output.decode("utf-8").split())
+
+    def test_amf_checker(self):
+        loaded = self.get_loaded_modules("amf_check_writer.amf_checker")
+        for module in ("netCDF4", "yaml", "multiprocessing.pool",
+                       "compliance_checker",
+                       "amf_check_writer.spreadsheet_handler"):
+            assert module not in loaded
+
+    def test_create_cvs(self):
+        loaded = self.get_loaded_modules("amf_check_writer.create_cvs")
+        assert "amf_check_writer.spreadsheet_handler" in loaded
+        for module in ("netCDF4", "yaml", "orjson", "pyessv",
+                       "multiprocessing.pool"):
+            assert module not in loaded
+
+    def test_xlsx_to_tsv(self):
+        loaded = self.get_loaded_modules("amf_check_writer.xlsx_to_tsv")
+        assert "multiprocessing.pool" not in loaded
+
+
+class TestDriveManifest(BaseTest):
+    def write_spreadsheet(self, out_dir, manifest, file_info):
+        """
+        Write TSVs for a spreadsheet in `out_dir` and record them in the
+        manifest. Return the spreadsheet directory
+        """
+        sheet_dir = out_dir.mkdir("spreadsheets").mkdir("prod.xlsx")
+        sheet_dir.join("Sheet1.tsv").write("a\tb")
+        sheet_dir.join("Sheet2.tsv").write("c\td")
+        raw_path = str(out_dir.mkdir("raw-spreadsheets").join("prod.xlsx"))
+        with open(raw_path, "w") as f:
+            f.write("raw")
+        manifest.update("abc", os.path.join("spreadsheets", "prod.xlsx"),
+                        file_info, ["Sheet1.tsv", "Sheet2.tsv"], raw_path)
+        return sheet_dir
+
+    def test_up_to_date(self, tmpdir):
+        out_dir = tmpdir.mkdir("out")
+        manifest = DriveManifest(str(out_dir))
+        file_info = {"name": "prod.xlsx", "version": "5",
+                     "modifiedTime": "2018-01-01T00:00:00.000Z"}
+        path = os.path.join("spreadsheets", "prod.xlsx")
+        assert not manifest.is_up_to_date("abc", path, file_info)
+
+        sheet_dir = self.write_spreadsheet(out_dir, manifest, file_info)
+        manifest.save()
+
+        # Reload from disk
+        manifest = DriveManifest(str(out_dir))
+        assert manifest.is_up_to_date("abc", path, file_info)
+        # New version on Drive
+        assert not manifest.is_up_to_date("abc", path,
+                                          dict(file_info, version="6"))
+        # Moved on Drive
+        assert not manifest.is_up_to_date("abc", "other", file_info)
+        # Local TSV modified
+        sheet_dir.join("Sheet2.tsv").write("changed")
+        assert not manifest.is_up_to_date("abc", path, file_info)
+        # Local TSV deleted
+        sheet_dir.join("Sheet2.tsv").remove()
+        assert not manifest.is_up_to_date("abc", path, file_info)
+
+    def test_stale_sheets_removed(self, tmpdir):
+        out_dir = tmpdir.mkdir("out")
+        manifest = DriveManifest(str(out_dir))
+        file_info = {"name": "prod.xlsx", "version": "1"}
+        sheet_dir = self.write_spreadsheet(out_dir, manifest, file_info)
+
+        # Sheet2 removed from the spreadsheet on Drive
+        manifest.update("abc", os.path.join("spreadsheets", "prod.xlsx"),
+                        dict(file_info, version="2"), ["Sheet1.tsv"],
+                        str(out_dir.join("raw-spreadsheets").join("prod.xlsx")))
+        assert sheet_dir.join("Sheet1.tsv").check()
+        assert not sheet_dir.join("Sheet2.tsv").check()
+
+    def test_remove_unseen(self, tmpdir):
+        out_dir = tmpdir.mkdir("out")
+        manifest = DriveManifest(str(out_dir))
+        file_info = {"name": "prod.xlsx", "version": "1"}
+        sheet_dir = self.write_spreadsheet(out_dir, manifest, file_info)
+
+        manifest.mark_seen("abc")
+        assert manifest.remove_unseen() == []
+        assert sheet_dir.check()
+
+        # Not seen in a later run
+        manifest.seen = set()
+        assert manifest.remove_unseen() == ["abc"]
+        assert not sheet_dir.check()
+        assert not out_dir.join("raw-spreadsheets").join("prod.xlsx").check()
+        assert manifest.get("abc") is None
+
+    def test_journal(self, tmpdir):
+        out_dir = tmpdir.mkdir("out")
+        manifest = DriveManifest(str(out_dir))
+        file_info = {"name": "prod.xlsx", "version": "1"}
+        path = os.path.join("spreadsheets", "prod.xlsx")
+        self.write_spreadsheet(out_dir, manifest, file_info)
+
+        # Killed before the manifest is saved, part way through writing a
+        # second record
+        manifest.journal.write('{"id": "def", "entr')
+        manifest.journal.close()
+        manifest = DriveManifest(str(out_dir))
+        assert manifest.resumed == 1
+        assert manifest.is_up_to_date("abc", path, file_info)
+        assert manifest.get("def") is None
+
+        # Saving the manifest removes the journal
+        manifest.save()
+        assert not out_dir.join(".drive-manifest.journal").check()
+        manifest = DriveManifest(str(out_dir))
+        assert manifest.resumed == 0
+        assert manifest.is_up_to_date("abc", path, file_info)
+
+        # Removals are journalled too
+        manifest.remove_local_files("abc")
+        assert DriveManifest(str(out_dir)).get("abc") is None
+
+
+class TestAtomicWrite(BaseTest):
+    def test_atomic_write(self, tmpdir):
+        path = tmpdir.join("file.tsv")
+        path.write("old")
+        with atomic_write(str(path)) as f:
+            f.write("new")
+            # Not visible until the block completes
+            assert path.read() == "old"
+        assert path.read() == "new"
+
+        with pytest.raises(ValueError):
+            with atomic_write(str(path)) as f:
+                f.write("partial")
+                raise ValueError()
+        assert path.read() == "new"
+        assert tmpdir.listdir() == [path]
+
+    def test_permissions(self, tmpdir):
+        # Files get the same permissions as normally created files, and the
+        # process umask is left alone
+        old_umask = os.umask(0o027)
+        try:
+            with atomic_write(str(tmpdir.join("file.tsv"))) as f:
+                f.write("new")
+            tmpdir.join("normal.tsv").write("new")
+            assert os.umask(0o027) == 0o027
+        finally:
+            os.umask(old_umask)
+        assert (tmpdir.join("file.tsv").stat().mode & 0o777 ==
+                tmpdir.join("normal.tsv").stat().mode & 0o777 == 0o640)
+
+
+class FakeClock(object):
+    """
+    Clock for testing RateLimiter without actually sleeping
+    """
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, n):
+        self.now += n
+
+
+class TestRateLimiter(BaseTest):
+    def test_sliding_window(self):
+        clock = FakeClock()
+        limiter = RateLimiter(max_requests=3, period=10, leeway=0,
+                              clock=clock.time, sleep=clock.sleep)
+        # First 3 requests go straight through
+        for _ in range(3):
+            assert limiter.acquire() == 0
+            clock.now += 1
+
+        # The 4th must wait until the first request falls out of the window
+        assert limiter.acquire() == 7
+        assert clock.now == 1010
+        assert limiter.total_wait == 7
+
+        # Next slot is 10 seconds after the second request
+        assert limiter.acquire() == 1
+        assert limiter.total_wait == 8
+
+    def test_slots_reserved_in_order(self):
+        clock = FakeClock()
+        limiter = RateLimiter(max_requests=2, period=10, leeway=0,
+                              clock=clock.time, sleep=lambda n: None)
+        # Callers that do not sleep (e.g. other threads arriving at the same
+        # time) are each given a later slot
+        waits = [limiter.acquire() for _ in range(6)]
+        assert waits == [0, 0, 10, 10, 20, 20]
+
+    def test_backoff(self):
+        clock = FakeClock()
+        limiter = RateLimiter(max_requests=100, period=10, base_delay=2,
+                              max_delay=8, clock=clock.time, sleep=clock.sleep)
+        delays = [limiter.backoff(attempt) for attempt in range(5)]
+        for delay, expected_max in zip(delays, (2, 4, 8, 8, 8)):
+            assert expected_max / 2.0 <= delay <= expected_max
+
+        # All callers are paused until the backoff has finished
+        assert limiter.acquire() == pytest.approx(max(delays))
+
+
+class TestXlsxToTsv(BaseTest):
+    WORKBOOK = (
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets>'
+        '<sheet name="Variables - Specific" sheetId="1" r:id="rId1"/>'
+        # Chartsheets are not converted
+        '<sheet name="Chart" sheetId="3" r:id="rId3"/>'
+        '<sheet name="Empty" sheetId="2" r:id="rId2"/>'
+        '</sheets></workbook>'
+    )
+    RELS = (
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Target="worksheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '<Relationship Id="rId2" Target="/xl/worksheets/sheet2.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet"/>'
+        '<Relationship Id="rId3" Target="chartsheets/sheet1.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/chartsheet"/>'
+        '<Relationship Id="rId4" Target="sharedStrings.xml" '
+        'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/sharedStrings"/>'
+        '</Relationships>'
+    )
+    SHARED_STRINGS = (
+        '<sst xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<si><t>Variable</t></si>'
+        '<si><t>Attribute</t></si>'
+        '<si><r><t>Val</t></r><r><t>ue</t></r></si>'
+        '<si><t xml:space="preserve"> wind_speed </t></si>'
+        '<si><t>one\ntwo</t></si>'
+        '</sst>'
+    )
+    SHEET1 = (
+        '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<sheetData>'
+        '<row r="1"><c r="A1" t="s"><v>0</v></c><c r="B1" t="s"><v>1</v></c>'
+        '<c r="C1" t="s"><v>2</v></c></row>'
+        '<row r="2"><c r="A2" t="s"><v>3</v></c><c r="B2"/></row>'
+        # Row 3 is missing from the file
+        '<row r="4"><c r="B4" t="inlineStr"><is><t>units</t></is></c>'
+        '<c r="C4"><v>1.5</v></c><c r="AA4" t="s"><v>0</v></c></row>'
+        '<row r="5"><c r="B5" t="b"><v>1</v></c><c r="C5" t="s"><v>4</v></c></row>'
+        # Trailing empty rows
+        '<row r="6"><c r="A6"/></row>'
+        '</sheetData></worksheet>'
+    )
+    SHEET2 = (
+        '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<sheetData/></worksheet>'
+    )
+    CHARTSHEET = (
+        '<chartsheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+        '<sheetViews><sheetView workbookViewId="0"/></sheetViews></chartsheet>'
+    )
+
+    def write_xlsx(self, path):
+        with zipfile.ZipFile(path, "w") as zf:
+            zf.writestr("xl/workbook.xml", self.WORKBOOK)
+            zf.writestr("xl/_rels/workbook.xml.rels", self.RELS)
+            zf.writestr("xl/sharedStrings.xml", self.SHARED_STRINGS)
+            zf.writestr("xl/worksheets/sheet1.xml", self.SHEET1)
+            zf.writestr("xl/worksheets/sheet2.xml", self.SHEET2)
+            zf.writestr("xl/chartsheets/sheet1.xml", self.CHARTSHEET)
+
+    def test_read_values(self, tmpdir):
+        path = str(tmpdir.join("prod.xlsx"))
+        self.write_xlsx(path)
+        reader = XlsxReader(path)
+        sheets = list(reader.read(max_cols=26))
+        reader.close()
+        assert sheets == [
+            ("Variables - Specific", [
+                ["Variable", "Attribute", "Value"],
+                [" wind_speed "],
+                [],
+                ["", "units", "1.5"],
+                ["", "TRUE", "one\ntwo"]
+            ]),
+            ("Empty", [])
+        ]
+
+    def test_max_rows(self, tmpdir):
+        path = str(tmpdir.join("prod.xlsx"))
+        self.write_xlsx(path)
+        reader = XlsxReader(path)
+        sheets = dict(reader.read(max_rows=2))
+        reader.close()
+        assert sheets["Variables - Specific"] == [
+            ["Variable", "Attribute", "Value"],
+            [" wind_speed "]
+        ]
+
+    def test_convert(self, tmpdir):
+        path = str(tmpdir.join("prod.xlsx"))
+        self.write_xlsx(path)
+        out_dir = tmpdir.join("spreadsheets").join("prod.xlsx")
+        tsv_names = convert_xlsx(path, str(out_dir))
+        assert tsv_names == ["Variables - Specific.tsv", "Empty.tsv"]
+        # Columns beyond Z are not truncated
+        assert out_dir.join("Variables - Specific.tsv").read() == os.linesep.join((
+            "Variable\tAttribute\tValue",
+            "wind_speed",
+            "",
+            "\t".join(["", "units", "1.5"] + [""] * 23 + ["Variable"]),
+            "\tTRUE\tone|two",
+            ""
+        ))
+        assert out_dir.join("Empty.tsv").read() == ""
+
+
+class TestDownloadFromDrive(BaseTest):
+    """
+    Test downloading spreadsheets from a local stand-in for Google's APIs
+    """
+    @pytest.fixture
+    def tree(self):
+        return FakeDriveTree.generate(depth=2, folders_per_folder=2,
+                                      spreadsheets_per_folder=2,
+                                      sheets_per_spreadsheet=2,
+                                      rows_per_sheet=10)
+
+    def download(self, server, out_dir, max_retries=6, **kwargs):
+        limiter = RateLimiter(max_requests=1000, period=1, base_delay=0.01,
+                              max_retries=max_retries)
+        cache = DiscoveryCache(str(out_dir.dirpath().join("discovery-cache")))
+        downloader = SheetDownloader(str(out_dir), api_root=server.url,
+                                     root_id=server.tree.root_id,
+                                     rate_limiter=limiter,
+                                     discovery_cache=cache, **kwargs)
+        with server.lock:
+            server.request_counts.clear()
+        downloader.run()
+        return dict(server.request_counts)
+
+    def expected_tsvs(self, tree):
+        """
+        Return a dict mapping TSV paths relative to the output directory to
+        their expected contents
+        """
+        def path(file_id):
+            f = tree.files[file_id]
+            if file_id == tree.root_id:
+                return ""
+            return os.path.join(path(f["parents"][0]), f["name"])
+
+        expected = {}
+        for file_id, f in tree.files.items():
+            for name, rows in f.get("sheets", {}).items():
+                lines = ["\t".join(c.strip().replace("\n", "|") for c in row)
+                         for row in rows]
+                expected[os.path.join(path(file_id), "{}.tsv".format(name))] = \
+                    "".join(line + os.linesep for line in lines)
+        return expected
+
+    def check_tsvs(self, tree, out_dir):
+        for rel_path, contents in self.expected_tsvs(tree).items():
+            tsv = out_dir.join(rel_path)
+            assert tsv.check(), rel_path
+            assert tsv.read() == contents
+
+    def test_download(self, tree, tmpdir):
+        out_dir = tmpdir.join("spreadsheets")
+        with FakeGoogleApiServer(tree) as server:
+            counts = self.download(server, out_dir, jobs=4)
+        self.check_tsvs(tree, out_dir)
+
+        n_spreadsheets = sum(1 for f in tree.files.values() if "sheets" in f)
+        assert counts["spreadsheets.get"] == n_spreadsheets
+        assert counts["spreadsheets.values.batchGet"] == n_spreadsheets
+        assert counts["files.export"] == n_spreadsheets
+        raw = tmpdir.join("raw-spreadsheets")
+        assert len(raw.listdir()) > 0
+
+    def test_one_http_per_thread(self, tree, tmpdir, monkeypatch):
+        # httplib2.Http objects are not thread-safe, so each worker thread
+        # must make its API requests with its own Http object
+        http_threads = {}
+        thread_https = {}
+        real_http = httplib2.Http
+
+        class RecordingHttp(real_http):
+            def request(self, uri, *args, **kwargs):
+                # Discovery documents are fetched before any threads start
+                if "/discovery/" not in uri:
+                    thread = threading.current_thread().ident
+                    http_threads.setdefault(id(self), set()).add(thread)
+                    thread_https.setdefault(thread, set()).add(id(self))
+                return real_http.request(self, uri, *args, **kwargs)
+
+        monkeypatch.setattr(download_from_drive.httplib2, "Http", RecordingHttp)
+        out_dir = tmpdir.join("spreadsheets")
+        with FakeGoogleApiServer(tree, latency=0.01) as server:
+            self.download(server, out_dir, jobs=4)
+        self.check_tsvs(tree, out_dir)
+
+        assert len(thread_https) > 1
+        for https in thread_https.values():
+            assert len(https) == 1
+        for threads in http_threads.values():
+            assert len(threads) == 1
+
+    def test_unchanged_spreadsheets_skipped(self, tree, tmpdir):
+        out_dir = tmpdir.join("spreadsheets")
+        with FakeGoogleApiServer(tree) as server:
+            self.download(server, out_dir)
+
+            # Nothing changed: only folders are listed
+            counts = self.download(server, out_dir)
+            assert set(counts) == set(["files.list", "changes.getStartPageToken"])
+
+            # Change one spreadsheet and delete another
+            ids = [file_id for file_id, f in tree.files.items() if "sheets" in f]
+            tree.update_spreadsheet(ids[0], OrderedDict([("New", [["a", "b"]])]))
+            tree.delete(ids[1])
+            counts = self.download(server, out_dir)
+            assert counts["spreadsheets.get"] == 1
+            self.check_tsvs(tree, out_dir)
+
+            # The removed sheets and spreadsheet are deleted locally
+            tsvs = [os.path.relpath(str(p), str(out_dir))
+                    for p in out_dir.visit("*.tsv")]
+            assert sorted(tsvs) == sorted(self.expected_tsvs(tree))
+
+    def test_changes_feed(self, tree, tmpdir):
+        out_dir = tmpdir.join("spreadsheets")
+        with FakeGoogleApiServer(tree) as server:
+            self.download(server, out_dir, use_changes=True)
+
+            # Nothing changed: a single request to the changes feed
+            counts = self.download(server, out_dir, use_changes=True)
+            assert counts == {"changes.list": 1}
+
+            # Add a spreadsheet in a new folder
+            folder_id = tree.add_folder(tree.root_id, "new-folder")
+            tree.add_spreadsheet(folder_id, "new.xlsx",
+                                 OrderedDict([("Sheet1", [["x"]])]))
+            counts = self.download(server, out_dir, use_changes=True)
+            assert "files.list" not in counts
+            assert counts["spreadsheets.get"] == 1
+            assert out_dir.join("new-folder").join("new.xlsx").join("Sheet1.tsv").check()
+
+            # Renaming a folder requires a full sync
+            tree.update(folder_id, name="renamed-folder")
+            counts = self.download(server, out_dir, use_changes=True)
+            assert "files.list" in counts
+            self.check_tsvs(tree, out_dir)
+            assert not out_dir.join("new-folder").join("new.xlsx").check()
+
+    def test_resume_after_interruption(self, tree, tmpdir, monkeypatch):
+        out_dir = tmpdir.join("spreadsheets")
+        real_export = SheetDownloader.export_spreadsheet
+        exports = []
+
+        def failing_export(downloader, sheet_id, out_file):
+            if len(exports) == 3:
+                raise RuntimeError("Connection lost")
+            real_export(downloader, sheet_id, out_file)
+            exports.append(sheet_id)
+
+        with FakeGoogleApiServer(tree) as server:
+            # Simulate the process being killed: the manifest is never saved
+            monkeypatch.setattr(SheetDownloader, "export_spreadsheet", failing_export)
+            monkeypatch.setattr(DriveManifest, "save", lambda manifest: None)
+            with pytest.raises(RuntimeError):
+                self.download(server, out_dir)
+            monkeypatch.undo()
+
+            # No partially written files are left behind
+            assert not list(tmpdir.visit("*.tmp"))
+
+            counts = self.download(server, out_dir, use_changes=True)
+        n_spreadsheets = sum(1 for f in tree.files.values() if "sheets" in f)
+        assert counts["spreadsheets.get"] == n_spreadsheets - 3
+        assert "files.list" in counts
+        self.check_tsvs(tree, out_dir)
+
+    def test_xlsx_only(self, tree, tmpdir):
+        out_dir = tmpdir.join("spreadsheets")
+        with FakeGoogleApiServer(tree) as server:
+            counts = self.download(server, out_dir, xlsx_only=True)
+        self.check_tsvs(tree, out_dir)
+        assert "spreadsheets.values.batchGet" not in counts
+
+    def test_retry_after_rate_limit_errors(self, tree, tmpdir):
+        out_dir = tmpdir.join("spreadsheets")
+        with FakeGoogleApiServer(tree, error_rate=0.3) as server:
+            self.download(server, out_dir, jobs=4, max_retries=10)
+            assert server.error_count > 0
+        self.check_tsvs(tree, out_dir)
+
+    def test_retry_on_rate_limit_responses(self):
+        def http_error(status, reason="rateLimitExceeded"):
+            content = json.dumps({"error": {"errors": [{"reason": reason}]}})
+            return HttpError(httplib2.Response({"status": status}),
+                             content.encode("utf-8"))
+
+        class FlakyDownloader(SheetDownloader):
+            def __init__(self, failures):
+                self.failures = list(failures)
+                self.calls = 0
+                self.clock = FakeClock()
+                self.rate_limiter = RateLimiter(
+                    max_requests=100, period=10, base_delay=1, max_retries=3,
+                    clock=self.clock.time, sleep=self.clock.sleep
+                )
+
+            @download_from_drive.api_call
+            def get_start_page_token(self):
+                self.calls += 1
+                if self.failures:
+                    raise self.failures.pop(0)
+                return "token"
+
+        # 429, and 403 with a rate limit reason, are retried after a backoff
+        downloader = FlakyDownloader([http_error(429),
+                                      http_error(403, "userRateLimitExceeded")])
+        start = downloader.clock.now
+        assert downloader.get_start_page_token() == "token"
+        assert downloader.calls == 3
+        assert downloader.clock.now > start
+
+        # Other errors are raised immediately
+        for error in (http_error(403, "insufficientPermissions"),
+                      http_error(500, "backendError")):
+            downloader = FlakyDownloader([error])
+            with pytest.raises(HttpError):
+                downloader.get_start_page_token()
+            assert downloader.calls == 1
+
+        # The error is raised once the retries have run out
+        downloader = FlakyDownloader([http_error(429)] * 4)
+        with pytest.raises(HttpError):
+            downloader.get_start_page_token()
+        assert downloader.calls == 4
+
+    def test_folder_listing_pages(self):
+        class PagedDownloader(SheetDownloader):
+            def __init__(self, pages):
+                self.pages = pages
+                self.queries = []
+
+            def get_files_page(self, query, page_token=None):
+                self.queries.append((query, page_token))
+                return self.pages[page_token]
+
+        def child(name, *parents):
+            return {"id": name, "name": name, "parents": list(parents)}
+
+        downloader = PagedDownloader({
+            None: {"files": [child("a1", "a"), child("b1", "b")],
+                   "nextPageToken": "p2"},
+            "p2": {"files": [child("a2", "a"), child("ab", "a", "b")]},
+        })
+        children = downloader.get_children_of_folders(["a", "b", "c"])
+
+        # The children of all folders are listed in one paginated query, and
+        # split back out by parent
+        assert downloader.queries == [
+            ("('a' in parents or 'b' in parents or 'c' in parents) and "
+             "trashed = false", None),
+            ("('a' in parents or 'b' in parents or 'c' in parents) and "
+             "trashed = false", "p2"),
+        ]
+        assert [f["id"] for f in children["a"]] == ["a1", "a2", "ab"]
+        assert [f["id"] for f in children["b"]] == ["b1", "ab"]
+        assert children["c"] == []
+
+    def test_large_sheets(self, tmpdir, monkeypatch):
+        # Sheets bigger than the old fixed range of A1:Z999, with a gap of
+        # empty rows spanning a whole chunk
+        tree = FakeDriveTree()
+        wide = [["col{}".format(i) for i in range(30)]]
+        long_rows = [[str(i), "x"] for i in range(1500)]
+        long_rows[100:400] = [[] for _ in range(300)]
+        tree.add_spreadsheet(tree.root_id, "big", OrderedDict([
+            ("Wide", wide), ("Long", long_rows), ("Tom's sheet", [["a"]])
+        ]))
+        monkeypatch.setattr(download_from_drive, "MAX_CELLS_PER_REQUEST", 5000)
+
+        out_dir = tmpdir.join("spreadsheets")
+        with FakeGoogleApiServer(tree) as server:
+            counts = self.download(server, out_dir)
+        self.check_tsvs(tree, out_dir)
+        assert counts["spreadsheets.values.batchGet"] > 1
+
+    def test_batches_split_at_cell_limit(self, monkeypatch):
+        class BatchRecorder(SheetDownloader):
+            def __init__(self):
+                self.batches = []
+
+            def get_sheet_values_batch(self, sheet_id, cell_ranges):
+                self.batches.append(cell_ranges)
+                return [[[r]] for r in cell_ranges]
+
+        def props(title, nrows, ncols):
+            return {"title": title,
+                    "gridProperties": {"rowCount": nrows, "columnCount": ncols}}
+
+        monkeypatch.setattr(download_from_drive, "MAX_CELLS_PER_REQUEST", 250)
+        downloader = BatchRecorder()
+        sheets = [props("A", 10, 10), props("B", 10, 10), props("C", 60, 10),
+                  props("Empty", 0, 0)]
+        values = downloader.get_all_sheet_values("sheet-id", sheets)
+
+        # Each batch stays within the limit, and a sheet larger than the
+        # limit is split over several batches
+        assert downloader.batches == [
+            ["'A'!A1:J10", "'B'!A1:J10"],
+            ["'C'!A1:J25"],
+            ["'C'!A26:J50"],
+            ["'C'!A51:J60"],
+        ]
+        # Values of split sheets are joined back together, with the rows
+        # before each range padded up to its first row
+        assert values[0] == [["'A'!A1:J10"]]
+        assert values[2] == ([["'C'!A1:J25"]] + [[]] * 24 + [["'C'!A26:J50"]]
+                             + [[]] * 24 + [["'C'!A51:J60"]])
+        assert values[3] == []
+
+    def test_get_sheet_ranges(self):
+        props = {"title": "Sheet 1",
+                 "gridProperties": {"rowCount": 1000, "columnCount": 26}}
+        assert get_sheet_ranges(props) == [("'Sheet 1'!A1:Z1000", 1000)]
+        assert get_sheet_ranges(props, max_cells=26 * 400) == [
+            ("'Sheet 1'!A1:Z400", 400),
+            ("'Sheet 1'!A401:Z800", 400),
+            ("'Sheet 1'!A801:Z1000", 200)
+        ]
+
+        props = {"title": "Bob's", "gridProperties": {"rowCount": 2, "columnCount": 28}}
+        assert get_sheet_ranges(props, max_cells=10) == [
+            ("'Bob''s'!A1:AB1", 1), ("'Bob''s'!A2:AB2", 1)
+        ]
+        assert get_sheet_ranges({"title": "Chart", "sheetType": "OBJECT"}) == []
+
+
+class TestDiscoveryCache(BaseTest):
+    def test_cache(self, tmpdir, capsys):
+        url = None
+        with FakeGoogleApiServer(FakeDriveTree()) as server:
+            url = server.url + "/discovery/{api}/{apiVersion}"
+            cache = DiscoveryCache(str(tmpdir))
+            doc = cache.get("drive", "v3", url)
+            assert doc["version"] == "v3"
+            assert cache.get("drive", "v3", url) == doc
+            assert DiscoveryCache(str(tmpdir)).get("drive", "v3", url) == doc
+            assert server.discovery_count == 1
+
+            # Expired documents are fetched again
+            expired = DiscoveryCache(str(tmpdir), max_age=0)
+            assert expired.get("drive", "v3", url) == doc
+            assert server.discovery_count == 2
+
+            # A different version or URL is not taken from the cache
+            cache.get("sheets", "v4", url)
+            cache.get("drive", "v3", url + "?other")
+            assert server.discovery_count == 4
+
+            # Errors name the URL the document was requested from
+            missing = server.url + "/missing/{api}/{apiVersion}"
+            with pytest.raises(HttpError) as exc_info:
+                cache.get("drive", "v3", missing)
+            assert exc_info.value.uri == server.url + "/missing/drive/v3"
+
+        # A stale copy is used if the document cannot be fetched
+        assert expired.get("drive", "v3", url) == doc
+        assert "using cached copy" in capsys.readouterr().err
+        with pytest.raises(Exception):
+            expired.get("drive", "v2", url)
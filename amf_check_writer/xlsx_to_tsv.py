@@ -0,0 +1,278 @@
+"""
+Convert XLSX spreadsheets, as exported by download-from-drive, to TSV files
+without using Google's APIs. Each worksheet is saved as `<sheet name>.tsv` in
+a directory for the spreadsheet, in the same format as download-from-drive
+writes.
+
+Given a directory, every .xlsx file under it is converted and the directory
+structure is preserved.
+"""
+from __future__ import print_function
+import os
+import re
+import sys
+import zipfile
+import argparse
+import posixpath
+from xml.etree.ElementTree import iterparse
+
+from amf_check_writer.file_utils import atomic_write
+
+
+CELL_REF_REGEX = re.compile(r"^(?P<col>[A-Z]+)(?P<row>\d+)$")
+
+
+def write_values_to_tsv(values, out_file):
+    """
+    Write a sheet to `out_file`. `values` is a list of lists representing a
+    range in the sheet. The file is replaced atomically
+    """
+    with atomic_write(out_file) as f:
+        for row in values:
+            f.write("\t".join([cell.strip().replace("\n", "|").encode("utf-8")
+                               for cell in row]))
+            f.write(os.linesep)
+
+
+def local_name(tag):
+    """
+    Strip the namespace from an XML tag
+    """
+    return tag.rsplit("}", 1)[-1]
+
+
+def get_attr(elem, name):
+    """
+    Get an attribute of an XML element by its name without namespace
+    """
+    for key, value in elem.attrib.items():
+        if local_name(key) == name:
+            return value
+    return None
+
+
+def column_index(letters):
+    """
+    Convert column letters to a zero-based index, e.g. 'A' -> 0, 'AB' -> 27
+    """
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord("A") + 1
+    return index - 1
+
+
+def column_letters(index):
+    """
+    Convert a zero-based column index to letters, e.g. 0 -> 'A', 27 -> 'AB'
+    """
+    letters = ""
+    index += 1
+    while index:
+        index, rem = divmod(index - 1, 26)
+        letters = chr(ord("A") + rem) + letters
+    return letters
+
+
+class XlsxReader(object):
+    """
+    Streaming reader for the cell values in an XLSX file. Cell values are
+    returned as strings in the same form as the Sheets API returns them: rows
+    are trimmed of trailing empty cells, and trailing empty rows are omitted.
+
+    Numbers are returned as they are stored in the file, so cells with date or
+    other custom number formats will differ from the formatted value shown in
+    Google Sheets.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.zip_file = zipfile.ZipFile(path)
+
+    def close(self):
+        self.zip_file.close()
+
+    def get_sheets(self):
+        """
+        Return a list of tuples (sheet name, path in archive) for each
+        worksheet, in the order they appear in the workbook. Other kinds of
+        sheet, such as chartsheets, are skipped, as download-from-drive only
+        downloads grid sheets
+        """
+        # Map relationship IDs of worksheets to paths within the archive
+        targets = {}
+        with self.zip_file.open("xl/_rels/workbook.xml.rels") as f:
+            for _, elem in iterparse(f):
+                if (local_name(elem.tag) == "Relationship"
+                        and elem.get("Type", "").endswith("/worksheet")):
+                    target = elem.get("Target")
+                    if target.startswith("/"):
+                        target = target[1:]
+                    else:
+                        target = posixpath.normpath(posixpath.join("xl", target))
+                    targets[elem.get("Id")] = target
+
+        sheets = []
+        with self.zip_file.open("xl/workbook.xml") as f:
+            for _, elem in iterparse(f):
+                if local_name(elem.tag) == "sheet":
+                    target = targets.get(get_attr(elem, "id"))
+                    if target:
+                        sheets.append((elem.get("name"), target))
+        return sheets
+
+    def get_shared_strings(self):
+        """
+        Return the list of shared strings in the workbook
+        """
+        if "xl/sharedStrings.xml" not in self.zip_file.namelist():
+            return []
+
+        strings = []
+        with self.zip_file.open("xl/sharedStrings.xml") as f:
+            for _, elem in iterparse(f):
+                if local_name(elem.tag) == "si":
+                    strings.append(self.get_text(elem))
+                    elem.clear()
+        return strings
+
+    @classmethod
+    def get_text(cls, elem):
+        """
+        Return the text of a string item (<si> or <is> element), which may be
+        split into several runs of rich text. Phonetic hints are ignored
+        """
+        parts = []
+        for child in elem:
+            name = local_name(child.tag)
+            if name == "t":
+                parts.append(child.text or "")
+            elif name == "r":
+                parts += [t.text or "" for t in child if local_name(t.tag) == "t"]
+        return "".join(parts)
+
+    def get_values(self, sheet_path, shared_strings, max_rows=None,
+                   max_cols=None):
+        """
+        Return the values in a worksheet as a list of lists of strings
+        :param sheet_path:     path to the worksheet in the archive
+        :param shared_strings: list of shared strings in the workbook
+        :param max_rows:       if given, only return this many rows
+        :param max_cols:       if given, only return this many columns
+        """
+        values = []
+        with self.zip_file.open(sheet_path) as f:
+            row = None
+            next_col = 0
+            for _, elem in iterparse(f):
+                name = local_name(elem.tag)
+                if name == "c":
+                    ref = CELL_REF_REGEX.match(elem.get("r") or "")
+                    col = column_index(ref.group("col")) if ref else next_col
+                    next_col = col + 1
+                    value = self.get_cell_value(elem, shared_strings)
+                    if value and (max_cols is None or col < max_cols):
+                        if row is None:
+                            row = {}
+                        row[col] = value
+                    elem.clear()
+
+                elif name == "row":
+                    index = int(elem.get("r")) - 1 if elem.get("r") else len(values)
+                    next_col = 0
+                    if row:
+                        if max_rows is not None and index >= max_rows:
+                            break
+                        # Pad with empty rows for any rows skipped in the file
+                        values += [[] for _ in range(index - len(values))]
+                        values.append([row.get(i, "") for i in range(max(row) + 1)])
+                    row = None
+                    elem.clear()
+        return values
+
+    @classmethod
+    def get_cell_value(cls, elem, shared_strings):
+        """
+        Return the value of a cell (<c> element) as a string
+        """
+        cell_type = elem.get("t", "n")
+        if cell_type == "inlineStr":
+            for child in elem:
+                if local_name(child.tag) == "is":
+                    return cls.get_text(child)
+            return ""
+
+        raw = None
+        for child in elem:
+            if local_name(child.tag) == "v":
+                raw = child.text
+        if raw is None:
+            return ""
+        if cell_type == "s":
+            return shared_strings[int(raw)]
+        if cell_type == "b":
+            return "TRUE" if raw == "1" else "FALSE"
+        return raw
+
+    def read(self, max_rows=None, max_cols=None):
+        """
+        Yield a tuple (sheet name, values) for each worksheet in the workbook
+        """
+        shared_strings = self.get_shared_strings()
+        for name, sheet_path in self.get_sheets():
+            yield name, self.get_values(sheet_path, shared_strings,
+                                        max_rows=max_rows, max_cols=max_cols)
+
+
+def convert_xlsx(xlsx_path, out_dir, max_rows=None, max_cols=None):
+    """
+    Save each worksheet of an XLSX file as a TSV file in `out_dir`. As with
+    download-from-drive, every row and column of each sheet is converted
+    unless `max_rows` or `max_cols` are given
+    :return: list of TSV filenames written
+    """
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    tsv_names = []
+    reader = XlsxReader(xlsx_path)
+    try:
+        for name, values in reader.read(max_rows=max_rows, max_cols=max_cols):
+            tsv_name = "{}.tsv".format(name)
+            write_values_to_tsv(values, os.path.join(out_dir, tsv_name))
+            tsv_names.append(tsv_name)
+    finally:
+        reader.close()
+    return tsv_names
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "input",
+        help="XLSX file, or directory containing XLSX files (e.g. the "
+             "'raw-spreadsheets' directory written by download-from-drive)"
+    )
+    parser.add_argument(
+        "output_dir",
+        help="Directory to write spreadsheets to"
+    )
+    args = parser.parse_args(sys.argv[1:])
+
+    if os.path.isfile(args.input):
+        xlsx_files = [(args.input, os.path.basename(args.input))]
+    elif os.path.isdir(args.input):
+        xlsx_files = []
+        for dirpath, _dirnames, filenames in os.walk(args.input):
+            for fname in sorted(filenames):
+                if fname.endswith(".xlsx"):
+                    path = os.path.join(dirpath, fname)
+                    xlsx_files.append((path, os.path.relpath(path, args.input)))
+    else:
+        parser.error("No such file or directory '{}'".format(args.input))
+
+    for path, rel_path in xlsx_files:
+        out_dir = os.path.join(args.output_dir, rel_path)
+        print("Saving sheets from {} to {}...".format(path, out_dir))
+        convert_xlsx(path, out_dir)
+
+if __name__ == "__main__":
+    main()
@@ -4,13 +4,64 @@ import re
 from operator import attrgetter
 from collections import OrderedDict
 
-import yaml
-
 from amf_check_writer.exceptions import InvalidRowError
 from amf_check_writer.base_file import AmfFile
 from amf_check_writer.cvs.base import StripWhitespaceReader
 
 
+# Filenames that are always emitted as plain YAML scalars, so can be
+# substituted into a pre-rendered __INCLUDE__ line
+PLAIN_FILENAME_REGEX = re.compile(r"^AMF_[a-zA-Z0-9_.-]+$")
+INCLUDE_PLACEHOLDER = "AMF_placeholder.yml"
+
+_include_template = None
+
+
+def get_dumper():
+    """
+    Return the libyaml emitter if available, or the pure-Python one otherwise.
+    yaml is imported on first use, since CVs are YamlCheck objects but most
+    uses of them do not write YAML
+    """
+    import yaml
+    try:
+        return yaml.CDumper
+    except AttributeError:
+        return yaml.Dumper
+
+
+def dump_yaml(data):
+    """
+    Return `data` as a YAML string, using the libyaml emitter if available
+    """
+    import yaml
+    return yaml.dump(data, Dumper=get_dumper())
+
+
+def render_checks(checks):
+    """
+    Return the YAML for the 'checks' key of a check suite, exactly as it
+    appears in the output of `dump_yaml` for the whole suite
+    :param checks: list of check dictionaries
+    """
+    if not checks:
+        return dump_yaml({"checks": []})
+    return "checks:\n" + dump_yaml(checks)
+
+
+def render_include(filename):
+    """
+    Return the YAML for an item in the 'checks' list that includes checks
+    from another file
+    """
+    global _include_template
+    if not PLAIN_FILENAME_REGEX.match(filename):
+        return dump_yaml([{"__INCLUDE__": filename}])
+    if _include_template is None:
+        _include_template = dump_yaml([{"__INCLUDE__": INCLUDE_PLACEHOLDER}])
+    return _include_template.replace(INCLUDE_PLACEHOLDER, filename)
+
+
 class YamlCheck(AmfFile):
     """
     A YAML file that can be used with cc-yaml to run a suite of checks
@@ -20,11 +71,17 @@ class YamlCheck(AmfFile):
         Use `get_yaml_checks` to write a YAML check suite for use with cc-yaml
         :return: the YAML document as a string
         """
-        return yaml.dump({
+        suite_info = {
             "suite_name": "{}_checks".format(self.namespace),
             "description": "Check '{}' in AMF files".format(" ".join(self.facets)),
-            "checks": list(self.get_yaml_checks())
-        })
+        }
+        # 'checks' sorts before the other keys, so the rendered checks can be
+        # prepended to the rest of the document
+        checks_yaml = self.render_checks()
+        if checks_yaml is None:
+            suite_info["checks"] = list(self.get_yaml_checks())
+            return dump_yaml(suite_info)
+        return checks_yaml + dump_yaml(suite_info)
 
     def get_yaml_checks(self):
         """
@@ -33,6 +90,28 @@ class YamlCheck(AmfFile):
         """
         raise NotImplementedError
 
+    def render_checks(self):
+        """
+        Return the YAML for the 'checks' key of the suite without going
+        through `dump_yaml` for the whole list, or None if this is not
+        possible. May be implemented in child classes as an optimisation.
+        """
+        return None
+
+
+class StaticYamlCheck(YamlCheck):
+    """
+    Check suite whose checks do not depend on any data from the spreadsheets,
+    so only need to be rendered once for each class
+    """
+    _rendered_checks = {}
+
+    def render_checks(self):
+        cls = type(self)
+        if cls not in StaticYamlCheck._rendered_checks:
+            StaticYamlCheck._rendered_checks[cls] = render_checks(list(self.get_yaml_checks()))
+        return StaticYamlCheck._rendered_checks[cls]
+
 
 class WrapperYamlCheck(YamlCheck):
     """
@@ -46,8 +125,16 @@ class WrapperYamlCheck(YamlCheck):
         for check in sorted(self.child_checks, key=attrgetter("namespace")):
             yield {"__INCLUDE__": check.get_filename("yml")}
 
+    def render_checks(self):
+        if not self.child_checks:
+            return render_checks([])
+        return "checks:\n" + "".join(
+            render_include(check.get_filename("yml"))
+            for check in sorted(self.child_checks, key=attrgetter("namespace"))
+        )
+
 
-class FileInfoCheck(YamlCheck):
+class FileInfoCheck(StaticYamlCheck):
     """
     Checks for general properties of files. Note that this is entirely static
     and does not depend on any data from the spreadsheets
@@ -75,7 +162,7 @@ class FileInfoCheck(YamlCheck):
         }
 
 
-class FileStructureCheck(YamlCheck):
+class FileStructureCheck(StaticYamlCheck):
     """
     Check a dataset is a valid NetCDF4 file. Note that this is entirely static
     and does not depend on any data from the spreadsheets
@@ -0,0 +1,126 @@
+"""
+Benchmark download-from-drive against a local stand-in for Google's APIs (see
+amf_check_writer/fake_google_api.py), reporting the wall time, number of API
+calls and time spent waiting for the rate limiter.
+
+Example:
+
+    python benchmarks/bench_download.py --jobs 1 4 8 --latency 0.05
+"""
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+from amf_check_writer.download_from_drive import SheetDownloader
+from amf_check_writer.rate_limiter import RateLimiter
+from amf_check_writer.discovery_cache import DiscoveryCache
+from amf_check_writer.fake_google_api import FakeDriveTree, FakeGoogleApiServer
+
+
+def run_once(server, out_dir, cache, args, jobs, **kwargs):
+    """
+    Run the downloader once and return a dict of results
+    """
+    with server.lock:
+        server.request_counts.clear()
+        server.error_count = 0
+    limiter = RateLimiter(max_requests=args.rate_limit[0], period=args.rate_limit[1])
+    downloader = SheetDownloader(out_dir, jobs=jobs, api_root=server.url,
+                                 root_id=server.tree.root_id,
+                                 rate_limiter=limiter, discovery_cache=cache,
+                                 xlsx_only=args.xlsx_only,
+                                 folders_per_query=args.folders_per_query,
+                                 **kwargs)
+
+    stdout = sys.stdout
+    if not args.verbose:
+        sys.stdout = open(os.devnull, "w")
+    start = time.time()
+    try:
+        downloader.run()
+    finally:
+        if not args.verbose:
+            sys.stdout.close()
+            sys.stdout = stdout
+
+    return {
+        "time": time.time() - start,
+        "calls": server.total_requests,
+        "errors": server.error_count,
+        "wait": limiter.total_wait,
+        "counts": dict(server.request_counts)
+    }
+
+
+def report(label, result):
+    print("{:<28} {:>8.2f}s {:>7} calls {:>5} 429s {:>8.2f}s waiting".format(
+        label, result["time"], result["calls"], result["errors"], result["wait"]
+    ))
+    counts = ", ".join("{}={}".format(k, v) for k, v in sorted(result["counts"].items()))
+    print("    {}".format(counts))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 4],
+                        help="Numbers of worker threads to benchmark")
+    parser.add_argument("--depth", type=int, default=3,
+                        help="Depth of the folder tree")
+    parser.add_argument("--folders", type=int, default=3,
+                        help="Number of sub-folders in each folder")
+    parser.add_argument("--spreadsheets", type=int, default=3,
+                        help="Number of spreadsheets in each folder")
+    parser.add_argument("--sheets", type=int, default=5,
+                        help="Number of sheets in each spreadsheet")
+    parser.add_argument("--rows", type=int, default=100,
+                        help="Number of rows in each sheet")
+    parser.add_argument("--latency", type=float, default=0.02,
+                        help="Seconds to wait before responding to each request")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="Probability of a request failing with a 429 error")
+    parser.add_argument("--rate-limit", type=int, nargs=2, default=[100, 120],
+                        metavar=("REQUESTS", "SECONDS"),
+                        help="Rate limit used by the downloader, and enforced "
+                             "by the server [default: 100 120]")
+    parser.add_argument("--folders-per-query", type=int, default=20)
+    parser.add_argument("--xlsx-only", action="store_true",
+                        help="Benchmark the --xlsx-only mode")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Show the downloader's output")
+    args = parser.parse_args(sys.argv[1:])
+
+    tree = FakeDriveTree.generate(depth=args.depth,
+                                  folders_per_folder=args.folders,
+                                  spreadsheets_per_folder=args.spreadsheets,
+                                  sheets_per_spreadsheet=args.sheets,
+                                  rows_per_sheet=args.rows)
+    n_spreadsheets = sum(1 for f in tree.files.values() if "sheets" in f)
+    print("Tree has {} files, {} spreadsheets".format(len(tree.files), n_spreadsheets))
+
+    cache_dir = tempfile.mkdtemp()
+    cache = DiscoveryCache(cache_dir)
+    with FakeGoogleApiServer(tree, latency=args.latency,
+                             error_rate=args.error_rate,
+                             quota=tuple(args.rate_limit)) as server:
+        for jobs in args.jobs:
+            tmp_dir = tempfile.mkdtemp()
+            out_dir = os.path.join(tmp_dir, "spreadsheets")
+            try:
+                report("full sync, jobs={}".format(jobs),
+                       run_once(server, out_dir, cache, args, jobs))
+                report("no changes, jobs={}".format(jobs),
+                       run_once(server, out_dir, cache, args, jobs))
+                report("changes feed, jobs={}".format(jobs),
+                       run_once(server, out_dir, cache, args, jobs, use_changes=True))
+            finally:
+                shutil.rmtree(tmp_dir)
+    shutil.rmtree(cache_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Benchmark the time taken to import the module of each console script, and
+list the heavy dependencies that are loaded as a side effect. Each import is
+timed in a new interpreter, and the fastest of several runs is reported.
+
+Example:
+
+    python benchmarks/bench_import.py --repeat 10
+"""
+from __future__ import print_function
+import os
+import sys
+import json
+import argparse
+import subprocess
+
+
+# Console script names and their modules (see setup.py)
+ENTRY_POINTS = [
+    ("amf-checker", "amf_check_writer.amf_checker"),
+    ("create-all", "amf_check_writer.create_all"),
+    ("create-cvs", "amf_check_writer.create_cvs"),
+    ("create-yaml-checks", "amf_check_writer.create_yaml_checks"),
+    ("download-from-drive", "amf_check_writer.download_from_drive"),
+    ("xlsx-to-tsv", "amf_check_writer.xlsx_to_tsv"),
+]
+
+# Modules that are slow to import, and should only be loaded when used
+HEAVY_MODULES = ["netCDF4", "yaml", "orjson", "pyessv", "multiprocessing.pool",
+                 "apiclient", "compliance_checker",
+                 "amf_check_writer.spreadsheet_handler"]
+
+TIME_IMPORT = """
+import sys, time, json
+start = time.time()
+import {module}
+elapsed = time.time() - start
+print(json.dumps({{"time": elapsed,
+                  "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+
+def time_import(module, env):
+    """
+    Import `module` in a new interpreter
+    :return: tuple (time taken in seconds, list of heavy modules loaded)
+    """
+    code = TIME_IMPORT.format(module=module, heavy=HEAVY_MODULES)
+    output = subprocess.check_output([sys.executable, "-c", code], env=env)
+    result = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+    return result["time"], result["heavy"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=5,
+                        help="Number of times to import each module")
+    args = parser.parse_args(sys.argv[1:])
+
+    # Import the package from this source tree
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [root, env.get("PYTHONPATH")]))
+
+    for script, module in ENTRY_POINTS:
+        try:
+            results = [time_import(module, env) for _ in range(args.repeat)]
+        except subprocess.CalledProcessError:
+            print("{:<20} failed to import {}".format(script, module))
+            continue
+        best = min(elapsed for elapsed, _ in results)
+        heavy = results[0][1]
+        print("{:<20} {:>8.1f}ms  loads: {}".format(
+            script, best * 1000, ", ".join(heavy) or "-"
+        ))
+
+
+if __name__ == "__main__":
+    main()
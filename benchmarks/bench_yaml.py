@@ -0,0 +1,93 @@
+"""
+Benchmark generating YAML check suites: the product/deployment mode wrapper
+checks, the static global checks and per-product variable checks. Each is
+timed using `YamlCheck.to_yaml_check`, and using yaml.dump with the
+pure-Python dumper on the whole suite for comparison.
+
+Example:
+
+    python benchmarks/bench_yaml.py --products 2000
+"""
+from __future__ import print_function
+import sys
+import time
+import argparse
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+import yaml
+
+from amf_check_writer.base_file import AmfFile
+from amf_check_writer.cvs import VariablesCV
+from amf_check_writer.yaml_check import (get_dumper, WrapperYamlCheck,
+                                         FileInfoCheck, FileStructureCheck)
+
+
+def reference_yaml(check):
+    return yaml.dump({
+        "suite_name": "{}_checks".format(check.namespace),
+        "description": "Check '{}' in AMF files".format(" ".join(check.facets)),
+        "checks": list(check.get_yaml_checks())
+    }, Dumper=yaml.Dumper)
+
+
+def make_checks(args):
+    """
+    Return a dict mapping kinds of check suite to lists of checks
+    """
+    wrappers = []
+    variables = []
+    global_checks = []
+    for i in range(args.products):
+        name = "product-{}".format(i)
+        children = [AmfFile(["file_info"]), AmfFile(["file_structure"]),
+                    AmfFile(["global_attrs"]),
+                    AmfFile(["product", name, "variable"]),
+                    AmfFile(["product", name, "dimension"]),
+                    AmfFile(["product", "common", "variable", "land"]),
+                    AmfFile(["product", "common", "dimension", "land"])]
+        wrappers.append(WrapperYamlCheck(children, ["product", name, "land"]))
+        global_checks += [FileInfoCheck(["file_info"]),
+                          FileStructureCheck(["file_structure"])]
+
+    rows = ["Variable\tAttribute\tValue"]
+    for i in range(args.variables):
+        rows += ["var_{}\t\t".format(i), "\ttype\tfloat32", "\tunits\tm"]
+    tsv = "\n".join(rows)
+    for i in range(args.products // 10 or 1):
+        variables.append(VariablesCV(StringIO(tsv), ["product", "p{}".format(i), "variable"]))
+
+    return [("wrapper", wrappers), ("static", global_checks), ("variables", variables)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--products", type=int, default=1000,
+                        help="Number of products to generate suites for")
+    parser.add_argument("--variables", type=int, default=20,
+                        help="Number of variables in each variables suite")
+    args = parser.parse_args(sys.argv[1:])
+
+    print("Using {}".format(get_dumper().__name__))
+    for kind, checks in make_checks(args):
+        start = time.time()
+        fast = [check.to_yaml_check() for check in checks]
+        fast_time = time.time() - start
+
+        start = time.time()
+        reference = [reference_yaml(check) for check in checks]
+        reference_time = time.time() - start
+
+        assert fast == reference
+        print("{:<10} {:>6} suites {:>8.3f}s (yaml.Dumper: {:>8.3f}s, {:.1f}x)".format(
+            kind, len(checks), fast_time, reference_time,
+            reference_time / fast_time if fast_time else float("inf")
+        ))
+
+
+if __name__ == "__main__":
+    main()
@@ -10,14 +10,19 @@ setup(
     packages=find_packages(),
     install_requires=requirements,
     extras_require={
-        "test": ["pytest"]
+        "test": ["pytest"],
+        "orjson": ["orjson"],
+        # Version the in-process check engine has been tested with
+        "inprocess": ["compliance-checker==4.1.1"]
     },
     entry_points={
         "console_scripts": [
             "amf-checker=amf_check_writer.amf_checker:main",
+            "create-all=amf_check_writer.create_all:main",
             "create-cvs=amf_check_writer.create_cvs:main",
             "create-yaml-checks=amf_check_writer.create_yaml_checks:main",
             "download-from-drive=amf_check_writer.download_from_drive:main",
+            "xlsx-to-tsv=amf_check_writer.xlsx_to_tsv:main",
         ]
     }
 )